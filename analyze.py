@@ -0,0 +1,105 @@
+# Batch analysis of positions: reads one FEN per line from a file (or stdin) and writes
+# one JSON line per position with its legal moves, check/checkmate/stalemate status
+# and, with --depth, the engine's score and best move.
+#
+#   python3 analyze.py positions.fen [--depth N] [--workers N] [--chunk-size N] > out.jsonl
+#   zcat dump.fen.gz | python3 analyze.py - > out.jsonl
+#
+# The input is read lazily in chunks that are analysed by a pool of worker processes.
+# Only a few chunks per worker are ever in flight and results are written in input
+# order as soon as every chunk before them is done, so memory use stays flat however
+# large the input is. Blank lines and lines starting with # are skipped; lines that
+# aren't valid FEN, or fail to analyse for any other reason, get an "error" entry instead.
+
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from itertools import islice
+
+from position import Position
+from movegen import legal_moves, position_status, transposition_table
+from perft import move_name
+
+def analyze_fen(fen: str, depth: int) -> dict:
+    position = Position.from_fen(fen)
+    status = position_status(position)
+    result = {
+        "fen": fen,
+        "moves": [move_name(move) for move in legal_moves(position)],
+        "check": status.in_check,
+        "checkmate": status.checkmate,
+        "stalemate": status.stalemate,
+    }
+    if depth and result["moves"]:
+        from engine import search
+
+        # start every search from an empty table, so a score doesn't depend on which
+        # positions the same worker happened to search before
+        transposition_table.clear()
+        found = search(position, float("inf"), depth)
+        result["score"] = found.score
+        result["best"] = move_name(found.best_move)
+    return result
+
+# runs in a worker: every line of the chunk as one block of JSON lines
+def analyze_chunk(lines: list, depth: int) -> str:
+    output = []
+    for line in lines:
+        fen = line.strip()
+        if not fen or fen.startswith("#"):
+            continue
+        # one bad line gets an error entry and the rest of the chunk carries on
+        try:
+            result = analyze_fen(fen, depth)
+        except ValueError as error:
+            result = {"fen": fen, "error": str(error)}
+        except Exception as error:
+            result = {"fen": fen, "error": "%s: %s" % (type(error).__name__, error)}
+        output.append(json.dumps(result, separators=(",", ":")))
+    return "\n".join(output) + "\n" if output else ""
+
+def chunks(lines, size: int):
+    while True:
+        chunk = list(islice(lines, size))
+        if not chunk:
+            return
+        yield chunk
+
+def analyze_stream(lines, output, depth: int = 0, workers: int = 1, chunk_size: int = 1000):
+    if workers <= 1:
+        for chunk in chunks(lines, chunk_size):
+            output.write(analyze_chunk(chunk, depth))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # a few chunks per worker keeps every worker busy without reading far ahead
+    max_in_flight = workers * 3
+    pending = deque()
+    with ProcessPoolExecutor(workers) as pool:
+        for chunk in chunks(lines, chunk_size):
+            pending.append(pool.submit(analyze_chunk, chunk, depth))
+            if len(pending) >= max_in_flight:
+                output.write(pending.popleft().result())
+        while pending:
+            output.write(pending.popleft().result())
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse a file of FEN positions.")
+    parser.add_argument("input", help="file with one FEN per line, or - for stdin")
+    parser.add_argument("--depth", type=int, default=0,
+                        help="also search every position this many plies deep and report its score")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=1000, help="positions per work unit")
+    args = parser.parse_args()
+
+    if args.input == "-":
+        analyze_stream(sys.stdin, sys.stdout, args.depth, args.workers, args.chunk_size)
+    else:
+        with open(args.input) as lines:
+            analyze_stream(lines, sys.stdout, args.depth, args.workers, args.chunk_size)
+
+if __name__ == "__main__":
+    main()
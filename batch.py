@@ -0,0 +1,434 @@
+# Attack maps, check detection and move masks for many positions at once, with NumPy.
+#
+# A PositionBatch holds N positions as an N x 12 array of uint64 bitplanes (white pawn,
+# knight, bishop, rook, queen, king, then the same for black) plus the side to move,
+# en passant square and unmoved king/rook squares of each. Squares are numbered as in
+# position.py with white at the bottom, so white pawns move towards row 0.
+#
+# Everything is computed for the whole batch with shifts and masks: steppers shift
+# their bitboards by fixed offsets, sliders use Kogge-Stone fills, and per-square
+# results (move masks) loop over the 64 squares rather than over positions.
+#
+# NumPy is only needed here, nothing else in the rules imports this module.
+#
+#   python3 batch.py --check 2000    compare with movegen and Piece.valid_moves
+#   python3 batch.py --bench 100000  positions per second
+
+from __future__ import annotations
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from position import WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING
+
+_ALL = (1 << 64) - 1
+FILE_A = 0x0101010101010101
+FILE_B = FILE_A << 1
+FILE_G = FILE_A << 6
+FILE_H = FILE_A << 7
+NOT_A = _ALL ^ FILE_A
+NOT_H = _ALL ^ FILE_H
+NOT_AB = _ALL ^ FILE_A ^ FILE_B
+NOT_GH = _ALL ^ FILE_G ^ FILE_H
+
+def _row(row: int) -> int:
+    return 0xFF << (row * 8)
+
+# (shift, wrap mask) pairs: a positive shift moves down the board, a negative one up,
+# and the mask drops squares that wrapped around from the other edge
+ROOK_STEPS = [(-8, _ALL), (8, _ALL), (1, NOT_A), (-1, NOT_H)]
+BISHOP_STEPS = [(-7, NOT_A), (-9, NOT_H), (9, NOT_A), (7, NOT_H)]
+KING_STEPS = ROOK_STEPS + BISHOP_STEPS
+KNIGHT_STEPS = [(-17, NOT_H), (-15, NOT_A), (-10, NOT_GH), (-6, NOT_AB),
+                (6, NOT_GH), (10, NOT_AB), (15, NOT_H), (17, NOT_A)]
+# squares attacked by a white (upward) or black (downward) pawn
+PAWN_STEPS = [[(-9, NOT_H), (-7, NOT_A)], [(7, NOT_H), (9, NOT_A)]]
+
+# castling as (king square, rook square, squares that must be empty, squares the king
+# crosses that must not be attacked) for each color
+CASTLING = [[(60, 63, [61, 62], [61, 62]), (60, 56, [57, 58, 59], [59, 58])],
+            [(4, 7, [5, 6], [5, 6]), (4, 0, [1, 2, 3], [3, 2])]]
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("batch.py needs NumPy (pip install numpy)")
+
+def _u64(value: int):
+    return np.uint64(value)
+
+def _shift(bb, step: int):
+    if step > 0:
+        return bb << _u64(step)
+    return bb >> _u64(-step)
+
+def _steps(bb, steps):
+    result = np.zeros_like(bb)
+    for step, wrap in steps:
+        result |= _shift(bb, step) & _u64(wrap)
+    return result
+
+# squares reached from the pieces in gen sliding one way until they hit something in
+# the occupied squares (which are included)
+def _slide(gen, empty, step: int, wrap: int):
+    wrap = _u64(wrap)
+    empty = empty & wrap
+    gen = gen | (empty & _shift(gen, step))
+    empty = empty & _shift(empty, step)
+    gen = gen | (empty & _shift(gen, 2 * step))
+    empty = empty & _shift(empty, 2 * step)
+    gen = gen | (empty & _shift(gen, 4 * step))
+    return _shift(gen, step) & wrap
+
+def _slides(gen, empty, steps):
+    result = np.zeros_like(gen)
+    for step, wrap in steps:
+        result |= _slide(gen, empty, step, wrap)
+    return result
+
+def _popcount(bb):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(bb).astype(np.int64)
+    bytes_ = np.ascontiguousarray(bb).view(np.uint8).reshape(bb.shape + (8,))
+    return np.unpackbits(bytes_, axis=-1).sum(axis=-1).astype(np.int64)
+
+def _lowest_bit(bb):
+    return bb & (~bb + _u64(1))
+
+# index of the single set bit of every bitboard (0 for empty ones)
+def _square_of(bb):
+    return np.log2(np.where(bb == 0, _u64(1), bb).astype(np.float64)).astype(np.int64)
+
+class PositionBatch:
+    __slots__ = ("planes", "turn", "ep", "unmoved")
+
+    def __init__(self, planes, turn, ep=None, unmoved=None):
+        _require_numpy()
+        self.planes = np.ascontiguousarray(planes, dtype=np.uint64)
+        count = len(self.planes)
+        self.turn = np.asarray(turn, dtype=np.uint8)
+        # en passant square, -1 for none
+        self.ep = np.full(count, -1, dtype=np.int16) if ep is None else np.asarray(ep, dtype=np.int16)
+        self.unmoved = np.zeros(count, dtype=np.uint64) if unmoved is None else \
+                       np.asarray(unmoved, dtype=np.uint64)
+
+    def __len__(self) -> int:
+        return len(self.planes)
+
+    @classmethod
+    def from_positions(cls, positions) -> "PositionBatch":
+        planes, turn, ep, unmoved = [], [], [], []
+        for position in positions:
+            planes.append(position.boards[WHITE] + position.boards[BLACK])
+            turn.append(position.turn)
+            ep.append(-1 if position.ep_square is None else position.ep_square)
+            unmoved.append(position.unmoved)
+        return cls(np.array(planes, dtype=np.uint64).reshape(-1, 12), turn, ep, unmoved)
+
+    # from an N x 8 x 8 array of piece codes: 0 for an empty square, 1-6 for a white
+    # pawn, knight, bishop, rook, queen or king and 7-12 for the black ones
+    @classmethod
+    def from_codes(cls, codes, turn, ep=None, unmoved=None) -> "PositionBatch":
+        _require_numpy()
+        codes = np.asarray(codes).reshape(-1, 64)
+        planes = np.empty((len(codes), 12), dtype=np.uint64)
+        for plane in range(12):
+            bits = np.packbits(codes == plane + 1, axis=1, bitorder="little")
+            planes[:, plane] = np.ascontiguousarray(bits).view("<u8")[:, 0]
+        return cls(planes, turn, ep, unmoved)
+
+    # the planes of the side to move and of the other side, N x 6 each
+    def sides(self):
+        white_to_move = (self.turn == WHITE)[:, None]
+        ours = np.where(white_to_move, self.planes[:, :6], self.planes[:, 6:])
+        theirs = np.where(white_to_move, self.planes[:, 6:], self.planes[:, :6])
+        return ours, theirs
+
+# squares attacked by the pieces in `pieces` (N x 6), whose pawns move up where
+# `upward` is true, with `occupied` blocking the sliders
+def _attacks(pieces, upward, occupied):
+    empty = ~occupied
+    pawns = pieces[:, PAWN]
+    attacks = np.where(upward, _steps(pawns, PAWN_STEPS[WHITE]), _steps(pawns, PAWN_STEPS[BLACK]))
+    attacks |= _steps(pieces[:, KNIGHT], KNIGHT_STEPS) | _steps(pieces[:, KING], KING_STEPS)
+    attacks |= _slides(pieces[:, ROOK] | pieces[:, QUEEN], empty, ROOK_STEPS)
+    attacks |= _slides(pieces[:, BISHOP] | pieces[:, QUEEN], empty, BISHOP_STEPS)
+    return attacks
+
+# squares attacked by white and by black in every position
+def attack_maps(batch: PositionBatch):
+    planes = batch.planes
+    occupied = np.bitwise_or.reduce(planes, axis=1)
+    count = len(planes)
+    white = _attacks(planes[:, :6], np.ones(count, dtype=bool), occupied)
+    black = _attacks(planes[:, 6:], np.zeros(count, dtype=bool), occupied)
+    return white, black
+
+# pieces of the side not to move that attack the king of the side to move
+def _checkers(ours, theirs, white_to_move, occupied):
+    king = ours[:, KING]
+    empty = ~occupied
+    pawn_sources = np.where(white_to_move, _steps(king, PAWN_STEPS[WHITE]), _steps(king, PAWN_STEPS[BLACK]))
+    return (pawn_sources & theirs[:, PAWN]) | \
+           (_steps(king, KNIGHT_STEPS) & theirs[:, KNIGHT]) | \
+           (_slides(king, empty, ROOK_STEPS) & (theirs[:, ROOK] | theirs[:, QUEEN])) | \
+           (_slides(king, empty, BISHOP_STEPS) & (theirs[:, BISHOP] | theirs[:, QUEEN]))
+
+def in_check(batch: PositionBatch):
+    ours, theirs = batch.sides()
+    occupied = np.bitwise_or.reduce(batch.planes, axis=1)
+    return _checkers(ours, theirs, batch.turn == WHITE, occupied) != 0
+
+_between = None
+
+def _between_table():
+    global _between
+
+    if _between is None:
+        from movegen import BETWEEN
+        _between = np.array(BETWEEN, dtype=np.uint64)
+    return _between
+
+# N x 64 bitboards of where the piece on each square of the side to move can go. with
+# legal=False, moves that leave the own king in check are included too (castling is
+# only ever listed when it is legal). promotions show up once, as the pawn's move to
+# the last row.
+def move_masks(batch: PositionBatch, legal: bool = True):
+    count = len(batch)
+    rows = np.arange(count)
+    white_to_move = batch.turn == WHITE
+    ours, theirs = batch.sides()
+    own = np.bitwise_or.reduce(ours, axis=1)
+    enemy = np.bitwise_or.reduce(theirs, axis=1)
+    occupied = own | enemy
+    empty = ~occupied
+    king = ours[:, KING]
+    king_sq = _square_of(king)
+    checkers = _checkers(ours, theirs, white_to_move, occupied)
+    enemy_straight = theirs[:, ROOK] | theirs[:, QUEEN]
+    enemy_diagonal = theirs[:, BISHOP] | theirs[:, QUEEN]
+    masks = np.zeros((count, 64), dtype=np.uint64)
+
+    if legal:
+        # other pieces may only capture a single checker or step in its way
+        checks = _popcount(checkers)
+        checker_sq = _square_of(_lowest_bit(checkers))
+        block = checkers | _between_table()[king_sq, checker_sq]
+        target = np.where(checks == 0, ~own, np.where(checks == 1, block, _u64(0)))
+
+        # a piece between our king and an enemy slider may only move along that line:
+        # slide from the king to the first piece, then again looking through it
+        pins = []
+        for steps, sliders in ((ROOK_STEPS, enemy_straight), (BISHOP_STEPS, enemy_diagonal)):
+            for step, wrap in steps:
+                ray = _slide(king, empty, step, wrap)
+                first = ray & own
+                through = _slide(king, empty | first, step, wrap)
+                pinned = np.where((through & sliders) != 0, first, _u64(0))
+                pins.append((pinned, through))
+        # the king may not stay on the line of a slider either, so it is lifted off the
+        # board when working out which squares are attacked
+        danger = _attacks(theirs, ~white_to_move, occupied & ~king)
+    else:
+        target = ~own
+        pins = []
+        danger = np.zeros(count, dtype=np.uint64)
+
+    straight = ours[:, ROOK] | ours[:, QUEEN]
+    diagonal = ours[:, BISHOP] | ours[:, QUEEN]
+    pawns = ours[:, PAWN]
+    # rows a pawn of the side to move lands on after its first single step
+    double_step_row = np.where(white_to_move, _u64(_row(5)), _u64(_row(2)))
+    pieces = own & ~king
+    for sq in range(64):
+        bit = _u64(1 << sq)
+        # only the positions with a piece on this square
+        at = np.flatnonzero(pieces & bit)
+        if not len(at):
+            continue
+        gen = np.full(len(at), bit)
+        here_empty = empty[at]
+        here_own = own[at]
+        here_white = white_to_move[at]
+
+        reach = np.where((ours[at, KNIGHT] & bit) != 0, _steps(gen, KNIGHT_STEPS), _u64(0))
+        rooks = gen & straight[at]
+        if rooks.any():
+            reach |= _slides(rooks, here_empty, ROOK_STEPS)
+        bishops = gen & diagonal[at]
+        if bishops.any():
+            reach |= _slides(bishops, here_empty, BISHOP_STEPS)
+        reach &= ~here_own
+
+        pawn = gen & pawns[at]
+        if pawn.any():
+            single = np.where(here_white, pawn >> _u64(8), pawn << _u64(8)) & here_empty
+            first_step = single & double_step_row[at]
+            double = np.where(here_white, first_step >> _u64(8), first_step << _u64(8)) & here_empty
+            captures = np.where(here_white, _steps(pawn, PAWN_STEPS[WHITE]),
+                                _steps(pawn, PAWN_STEPS[BLACK])) & enemy[at]
+            reach |= single | double | captures
+
+        reach &= target[at]
+        for pinned, line in pins:
+            reach = np.where((pinned[at] & bit) != 0, reach & line[at], reach)
+        masks[at, sq] = reach
+
+    masks[rows, king_sq] = _steps(king, KING_STEPS) & ~own & ~danger
+
+    # en passant: at most two pawns can take, and whether it's legal is settled by
+    # looking at the king with both pawns gone and ours on the en passant square
+    has_ep = batch.ep >= 0
+    ep_bit = np.where(has_ep, _u64(1) << np.where(has_ep, batch.ep, 0).astype(np.uint64), _u64(0))
+    takers = np.where(white_to_move, _steps(ep_bit, PAWN_STEPS[BLACK]),
+                      _steps(ep_bit, PAWN_STEPS[WHITE])) & pawns
+    taken = np.where(white_to_move, ep_bit << _u64(8), ep_bit >> _u64(8))
+    for _ in range(2):
+        taker = _lowest_bit(takers)
+        takers ^= taker
+        allowed = taker != 0
+        if legal:
+            after = (occupied ^ taker ^ taken) | ep_bit
+            sliders = (_slides(king, ~after, ROOK_STEPS) & enemy_straight) | \
+                      (_slides(king, ~after, BISHOP_STEPS) & enemy_diagonal)
+            others = checkers & (theirs[:, KNIGHT] | theirs[:, PAWN]) & ~taken
+            allowed &= (sliders == 0) & (others == 0)
+        taker_sq = _square_of(taker)
+        masks[rows, taker_sq] |= np.where(allowed, ep_bit, _u64(0))
+
+    # castling, for whichever side is to move
+    attacked = _attacks(theirs, ~white_to_move, occupied)
+    for color in (WHITE, BLACK):
+        side = white_to_move if color == WHITE else ~white_to_move
+        for king_from, rook_sq, between, crossed in CASTLING[color]:
+            king_bit, rook_bit = _u64(1 << king_from), _u64(1 << rook_sq)
+            path = _u64(sum(1 << sq for sq in between))
+            crossed_bits = _u64(sum(1 << sq for sq in crossed))
+            allowed = side & (checkers == 0) & ((king & king_bit) != 0) & \
+                      ((batch.unmoved & king_bit) != 0) & ((batch.unmoved & rook_bit) != 0) & \
+                      ((ours[:, ROOK] & rook_bit) != 0) & ((occupied & path) == 0) & \
+                      ((attacked & crossed_bits) == 0)
+            destination = _u64(1 << (king_from + (2 if rook_sq > king_from else -2)))
+            masks[:, king_from] |= np.where(allowed, destination, _u64(0))
+
+    return masks
+
+# number of moves for the side to move, counting each promotion four times like
+# movegen.legal_moves does
+def move_counts(batch: PositionBatch, legal: bool = True):
+    masks = move_masks(batch, legal)
+    counts = _popcount(masks).sum(axis=1)
+    ours, _ = batch.sides()
+    white_to_move = batch.turn == WHITE
+    for sq in range(8, 16):
+        promoting = white_to_move & ((ours[:, PAWN] >> _u64(sq)) & _u64(1) != 0)
+        counts += 3 * np.where(promoting, _popcount(masks[:, sq]), 0)
+    for sq in range(48, 56):
+        promoting = ~white_to_move & ((ours[:, PAWN] >> _u64(sq)) & _u64(1) != 0)
+        counts += 3 * np.where(promoting, _popcount(masks[:, sq]), 0)
+    return counts
+
+# random positions from random games
+def _random_positions(count: int, seed: int):
+    import random
+
+    from movegen import legal_moves
+    from rules import new_position
+
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        position = new_position()
+        for _ in range(rng.randrange(1, 120)):
+            moves = legal_moves(position)
+            if not moves:
+                break
+            position.make_move(rng.choice(moves))
+            if rng.random() < 0.1:
+                positions.append(position.copy())
+    return positions[:count]
+
+# compare against movegen and the Piece view on random positions. returns the number
+# of mismatches.
+def cross_check(count: int, seed: int = 1) -> int:
+    from movegen import legal_moves, is_attacked
+    from rules import is_in_mate, piece_at
+
+    positions = _random_positions(count, seed)
+    batch = PositionBatch.from_positions(positions)
+    checks = in_check(batch)
+    masks = move_masks(batch)
+    counts = move_counts(batch)
+    white_attacks, black_attacks = attack_maps(batch)
+
+    failures = 0
+    for index, position in enumerate(positions):
+        problems = []
+
+        king_row, king_col = divmod(position.king_square(position.turn), 8)
+        if bool(checks[index]) != is_in_mate(king_row, king_col, position):
+            problems.append("in check")
+        if counts[index] != len(legal_moves(position)):
+            problems.append("move count %d, expected %d" % (counts[index], len(legal_moves(position))))
+        for color, attacks in ((WHITE, white_attacks), (BLACK, black_attacks)):
+            expected = sum(1 << sq for sq in range(64) if is_attacked(position, sq, color))
+            if int(attacks[index]) != expected:
+                problems.append("%s attack map" % ("white" if color == WHITE else "black"))
+        for sq in range(64):
+            piece = piece_at(position, sq // 8, sq % 8)
+            if piece is None or piece.color != position.turn:
+                continue
+            expected = sum(1 << (row * 8 + col) for row, col in piece.valid_moves(position))
+            if int(masks[index, sq]) != expected:
+                problems.append("moves of the %s on %d" % (piece.name, sq))
+
+        if problems:
+            failures += 1
+            if failures <= 10:
+                print(position.to_fen(), "-", ", ".join(problems))
+    return failures
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Batch move generation with NumPy.")
+    parser.add_argument("--check", type=int, default=0,
+                        help="cross-check this many random positions against movegen")
+    parser.add_argument("--bench", type=int, default=0,
+                        help="time move counting for this many positions, against movegen")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    _require_numpy()
+
+    if args.check:
+        failures = cross_check(args.check, args.seed)
+        print("%d positions, %d mismatches" % (args.check, failures))
+        raise SystemExit(1 if failures else 0)
+
+    if args.bench:
+        from movegen import legal_moves
+
+        positions = _random_positions(min(args.bench, 5000), args.seed)
+        positions = (positions * (args.bench // len(positions) + 1))[:args.bench]
+        batch = PositionBatch.from_positions(positions)
+        start = time.perf_counter()
+        attack_maps(batch)
+        in_check(batch)
+        maps = time.perf_counter() - start
+
+        start = time.perf_counter()
+        move_counts(batch)
+        batched = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for position in positions:
+            len(legal_moves(position))
+        single = time.perf_counter() - start
+        print("attack maps + check  %9.0f positions/s" % (len(positions) / maps))
+        print("batch move counts    %9.0f positions/s" % (len(positions) / batched))
+        print("movegen.legal_moves  %9.0f positions/s" % (len(positions) / single))
+
+if __name__ == "__main__":
+    main()
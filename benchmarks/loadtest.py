@@ -0,0 +1,233 @@
+# Load test for the relay server: N games of headless bots on localhost.
+#
+# Starts server.py in a subprocess (or uses --server host:port), connects two bots per
+# game and has them play random legal games with the rules core, replying as soon as
+# the opponent's move arrives. Reports:
+#
+#   moves/s      moves relayed per second over all games
+#   latency      time from a bot writing a move until its opponent has decoded it,
+#                i.e. the trip through the server and back out
+#   CPU/memory   server CPU time and resident memory per game (only when the server
+#                runs as our subprocess)
+#
+# and writes everything to a JSON report. The bots share one event loop, so at high
+# game counts part of the latency is the bots themselves falling behind; the client
+# CPU figure shows how busy they were.
+#
+#   python3 benchmarks/loadtest.py [--games N] [--plies N] [--report loadtest.json]
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from movegen import legal_moves
+from protocol import FrameBuffer, START, MOVES, ERROR
+from protocol import encode_hello, encode_join, encode_moves, decode_start, decode_moves, decode_error
+from rules import new_position, is_draw
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+
+class Bot:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.frames = FrameBuffer()
+        self.pending = []
+        self.color = None
+        self.opponent = None
+        self.position = new_position()
+        # perf_counter of our last move, read by the opponent when it arrives
+        self.sent_at = 0.0
+
+    async def next_frame(self):
+        while not self.pending:
+            data = await self.reader.read(4096)
+            if not data:
+                return None
+            self.pending.extend(self.frames.feed(data))
+        return self.pending.pop(0)
+
+    async def wait_for_start(self):
+        while True:
+            frame = await self.next_frame()
+            if frame is None:
+                raise ConnectionError("server closed the connection before START")
+            kind, payload = frame
+            if kind == START:
+                self.color = decode_start(payload)
+                return
+
+    async def play(self, plies: int, latencies: list, errors: list) -> int:
+        try:
+            return await self.play_moves(plies, latencies, errors)
+        finally:
+            # the server then ends the game for the opponent too
+            self.writer.close()
+
+    async def play_moves(self, plies: int, latencies: list, errors: list) -> int:
+        position = self.position
+        moves = 0
+        while len(position.history) < plies:
+            if position.turn == self.color:
+                choices = legal_moves(position)
+                if not choices or is_draw(position):
+                    break
+                move = random.choice(choices)
+                position.make_move(move)
+                self.sent_at = time.perf_counter()
+                self.writer.write(encode_moves([move]))
+                moves += 1
+                continue
+
+            frame = await self.next_frame()
+            if frame is None:
+                break
+            kind, payload = frame
+            if kind == MOVES:
+                for move in decode_moves(payload):
+                    position.make_move(move)
+                latencies.append(time.perf_counter() - self.opponent.sent_at)
+            elif kind == ERROR:
+                errors.append(decode_error(payload))
+                break
+        return moves
+
+async def connect(host: str, port: int) -> Bot:
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(encode_hello() + encode_join())
+    return Bot(reader, writer)
+
+# games are set up one at a time so the two bots of each game know they face each other
+async def setup_games(host: str, port: int, games: int) -> list:
+    pairs = []
+    for _ in range(games):
+        first = await connect(host, port)
+        second = await connect(host, port)
+        await asyncio.gather(first.wait_for_start(), second.wait_for_start())
+        first.opponent, second.opponent = second, first
+        pairs.append((first, second))
+    return pairs
+
+# server_pid is sampled for resident memory once every game is under way
+async def run_games(host: str, port: int, games: int, plies: int, server_pid=None) -> dict:
+    pairs = await setup_games(host, port, games)
+    busy_kib = resident_kib(server_pid) if server_pid else None
+    latencies = []
+    errors = []
+    bots = [bot for pair in pairs for bot in pair]
+
+    start = time.perf_counter()
+    moves = await asyncio.gather(*(bot.play(plies, latencies, errors) for bot in bots))
+    elapsed = time.perf_counter() - start
+    return {"moves": sum(moves), "seconds": elapsed, "latencies": latencies, "errors": errors,
+            "busy_kib": busy_kib}
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+# resident memory of a process in KiB, where /proc is available
+def resident_kib(pid: int):
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def start_server():
+    process = subprocess.Popen([sys.executable, "-u", SERVER, "--host", "127.0.0.1", "--port", "0"],
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    match = re.search(r"(\d+)\)\s*$", line)
+    if not match:
+        process.kill()
+        raise RuntimeError("server did not start: %r" % line)
+    return process, int(match.group(1))
+
+def main():
+    parser = argparse.ArgumentParser(description="Play many bot games against the relay server.")
+    parser.add_argument("--games", type=int, default=200)
+    parser.add_argument("--plies", type=int, default=80, help="stop each game after this many plies")
+    parser.add_argument("--server", help="host:port of a running server instead of starting one")
+    parser.add_argument("--report", default="loadtest.json", help="where to write the JSON report")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    process = None
+    if args.server:
+        host, port = args.server.rsplit(":", 1)
+        port = int(port)
+    else:
+        process, port = start_server()
+        host = "127.0.0.1"
+    idle_kib = resident_kib(process.pid) if process else None
+
+    client_start = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        result = asyncio.run(run_games(host, port, args.games, args.plies,
+                                       process.pid if process else None))
+    finally:
+        if process:
+            process.terminate()
+    client_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    latencies = result["latencies"]
+    report = {
+        "games": args.games,
+        "plies": args.plies,
+        "moves": result["moves"],
+        "seconds": round(result["seconds"], 3),
+        "moves_per_second": round(result["moves"] / result["seconds"], 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.5) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(max(latencies) * 1000, 3),
+        } if latencies else None,
+        "errors": len(result["errors"]),
+        "client_cpu_seconds": round(client_end.ru_utime + client_end.ru_stime -
+                                    client_start.ru_utime - client_start.ru_stime, 3),
+    }
+
+    if process:
+        _, _, usage = os.wait4(process.pid, 0)
+        cpu = usage.ru_utime + usage.ru_stime
+        report["server"] = {
+            "cpu_seconds": round(cpu, 3),
+            "cpu_ms_per_game": round(cpu * 1000 / args.games, 3),
+            # ru_maxrss is in KiB on Linux
+            "peak_rss_kib": usage.ru_maxrss,
+            "rss_kib_per_game": round((result["busy_kib"] - idle_kib) / args.games, 2)
+                                if idle_kib and result["busy_kib"] else None,
+        }
+
+    with open(args.report, "w") as output:
+        json.dump(report, output, indent=2)
+
+    print("%d games, %d moves in %.2f s: %.0f moves/s" %
+          (args.games, report["moves"], result["seconds"], report["moves_per_second"]))
+    if latencies:
+        print("latency ms: p50 %.3f  p99 %.3f  max %.3f" %
+              (report["latency_ms"]["p50"], report["latency_ms"]["p99"], report["latency_ms"]["max"]))
+    if process:
+        server = report["server"]
+        print("server: %.1f ms CPU/game, peak RSS %d KiB, %s KiB/game" %
+              (server["cpu_ms_per_game"], server["peak_rss_kib"], server["rss_kib_per_game"]))
+    if result["errors"]:
+        print("%d bots got errors, first: %s" % (len(result["errors"]), result["errors"][0]))
+    print("report written to", args.report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Loopback latency benchmark for receiving the opponent's moves.
+#
+# A peer thread sends a 4-byte move at random moments over a localhost TCP socket and
+# the receiver records how long each move took to be picked up. Two receivers are
+# compared:
+#
+#   poll   what listen_and_decode used to do: select() with a 10 ms timeout, then
+#          sleep 100 ms before looking again (root.after(100, ...))
+#   event  wait for the socket to become readable, which is what the Tk file handler
+#          does for the client now
+#
+# It also reports how much CPU each receiver burns while no moves arrive at all.
+#
+#   python3 benchmarks/loopback_latency.py [--moves N]
+
+import argparse
+import random
+import select
+import selectors
+import socket
+import statistics
+import struct
+import threading
+import time
+
+def socket_pair():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    sender = socket.create_connection(server.getsockname())
+    receiver, _ = server.accept()
+    server.close()
+    for sock in (sender, receiver):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sender, receiver
+
+# each message is the send time in microseconds, so the receiver can work out latency
+def send_moves(sock, count: int, gap: float):
+    for _ in range(count):
+        time.sleep(random.uniform(0, gap))
+        sock.sendall(struct.pack("<Q", time.perf_counter_ns() // 1000))
+    sock.close()
+
+def record(data: bytes, latencies: list):
+    now = time.perf_counter_ns() // 1000
+    for (sent,) in struct.iter_unpack("<Q", data):
+        latencies.append((now - sent) / 1000.0)
+
+def poll_receiver(sock, latencies: list):
+    while True:
+        readable, _, _ = select.select([sock], [], [], 0.01)
+        if readable:
+            data = sock.recv(4096)
+            if not data:
+                return
+            record(data, latencies)
+        else:
+            time.sleep(0.1)
+
+def event_receiver(sock, latencies: list):
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    while True:
+        selector.select()
+        data = sock.recv(4096)
+        if not data:
+            return
+        record(data, latencies)
+
+RECEIVERS = {"poll": poll_receiver, "event": event_receiver}
+
+def measure_latency(name: str, moves: int, gap: float) -> list:
+    sender, receiver = socket_pair()
+    latencies = []
+    peer = threading.Thread(target=send_moves, args=(sender, moves, gap))
+    peer.start()
+    RECEIVERS[name](receiver, latencies)
+    peer.join()
+    receiver.close()
+    return latencies
+
+# CPU time the receiver uses over `seconds` with nothing arriving
+def measure_idle_cpu(name: str, seconds: float) -> float:
+    sender, receiver = socket_pair()
+    used = []
+
+    def run():
+        start = time.thread_time()
+        RECEIVERS[name](receiver, [])
+        used.append(time.thread_time() - start)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(seconds)
+    sender.close()
+    thread.join()
+    receiver.close()
+    return used[0]
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare polled and event-driven move receiving.")
+    parser.add_argument("--moves", type=int, default=50)
+    parser.add_argument("--gap", type=float, default=0.05, help="max seconds between moves")
+    parser.add_argument("--idle", type=float, default=2.0, help="seconds to measure idle CPU")
+    args = parser.parse_args()
+
+    for name in RECEIVERS:
+        latencies = measure_latency(name, args.moves, args.gap)
+        idle = measure_idle_cpu(name, args.idle)
+        print("%-6s latency ms: mean %7.2f  p50 %7.2f  p99 %7.2f  max %7.2f   idle CPU %.1f ms/s" %
+              (name, statistics.mean(latencies), percentile(latencies, 0.5),
+               percentile(latencies, 0.99), max(latencies), idle * 1000 / args.idle))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# Time-to-depth of the engine's root-split parallel search against worker count.
+#
+# Every position is searched to a fixed depth with 1, 2, 4, ... worker processes (up to
+# the number of cores) and the speedup over one worker is reported. The worker pool is
+# warmed up before timing, so process start-up doesn't count.
+#
+#   python3 benchmarks/parallel_search.py [--depth N] [--max-workers N]
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import engine
+from perft import REFERENCE_POSITIONS
+from position import Position
+
+def time_to_depth(fens: list, depth: int, workers: int) -> float:
+    for future in engine.warm_up_pool(workers):
+        future.result()
+    start = time.perf_counter()
+    for fen in fens:
+        search = engine.start_parallel_search(Position.from_fen(fen), 3600.0, depth, workers)
+        search.result()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure parallel search speedup.")
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--max-workers", type=int, default=engine.worker_count())
+    args = parser.parse_args()
+
+    fens = [fen for _, fen, _ in REFERENCE_POSITIONS]
+    counts = []
+    workers = 1
+    while workers < args.max_workers:
+        counts.append(workers)
+        workers *= 2
+    counts.append(args.max_workers)
+
+    baseline = None
+    for workers in counts:
+        seconds = time_to_depth(fens, args.depth, workers)
+        baseline = baseline or seconds
+        print("%2d workers  %7.2fs  speedup %5.2fx" % (workers, seconds, baseline / seconds))
+
+if __name__ == "__main__":
+    main()
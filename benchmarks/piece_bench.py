@@ -0,0 +1,104 @@
+# Micro-benchmark and memory measurement for rules.Piece.
+#
+#   speed   generates every move of a set of positions one Piece at a time (the way the
+#           UI and perft's "pieces" backend do) and reports positions per second, along
+#           with how long the type/color tests themselves take on int fields compared
+#           to the strings Piece used to hold.
+#   memory  builds piece_map() for many positions and reports the bytes per position
+#           and per piece (tracemalloc), next to the same pieces stored the old way:
+#           a __dict__ per piece holding name, piece_type and color strings.
+#
+#   python3 benchmarks/piece_bench.py [--positions N] [--seed N]
+
+import argparse
+import os
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from position import COLOR_NAMES, PIECE_NAMES, QUEEN
+from movegen import legal_moves
+from rules import Piece, piece_map, new_position
+from perft import piece_moves
+
+# the layout Piece had before: three strings per piece and an instance __dict__
+class StringPiece:
+    def __init__(self, name: str, piece_type: str, color: str, row: int, col: int):
+        self.name = name
+        self.piece_type = piece_type
+        self.color = color
+        self.row = row
+        self.col = col
+        self.first_move = True
+        self.en_passant = False
+
+def string_piece_map(position) -> dict:
+    pieces = {}
+    for (row, col), (color, piece_type) in position.piece_squares().items():
+        # built like the old piece_at did, so the name is a new string for every piece
+        pieces[(row, col)] = StringPiece(PIECE_NAMES[piece_type] + "_" + COLOR_NAMES[color],
+                                         PIECE_NAMES[piece_type], COLOR_NAMES[color], row, col)
+    return pieces
+
+def random_positions(count: int, seed: int) -> list:
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        position = new_position()
+        for _ in range(rng.randrange(10, 80)):
+            moves = legal_moves(position)
+            if not moves:
+                break
+            position.make_move(rng.choice(moves))
+        position.history.clear()
+        positions.append(position)
+    return positions
+
+def bench_speed(positions: list):
+    start = time.perf_counter()
+    moves = sum(len(piece_moves(position)) for position in positions)
+    elapsed = time.perf_counter() - start
+    print("speed: %d positions (%d moves) through Piece.valid_moves in %.2fs, %.0f positions/s"
+          % (len(positions), moves, elapsed, len(positions) / elapsed))
+
+    new = Piece(QUEEN, 0, 0, 0)
+    old = StringPiece("queen_white", "queen", "white", 0, 0)
+    color = "".join(["wh", "ite"])  # a string that isn't the interned literal, like my_color
+    loops = 1000000
+    int_time = timeit.timeit(lambda: new.piece_type == QUEEN and new.color != 1, number=loops)
+    string_time = timeit.timeit(lambda: old.piece_type == "queen" and old.color != color, number=loops)
+    print("type/color test: %.0f ns with ints, %.0f ns with strings (lambda call included)"
+          % (int_time / loops * 1e9, string_time / loops * 1e9))
+
+def measure(build, positions: list) -> tuple:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    maps = [build(position) for position in positions]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    pieces = sum(len(pieces) for pieces in maps)
+    return used / len(positions), used / pieces
+
+def bench_memory(positions: list):
+    for label, build in (("Piece (__slots__, ints)", piece_map),
+                         ("old string pieces", string_piece_map)):
+        per_position, per_piece = measure(build, positions)
+        print("memory: %-24s %7.0f bytes per position, %5.0f bytes per piece"
+              % (label, per_position, per_piece))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Piece view of a position.")
+    parser.add_argument("--positions", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    positions = random_positions(args.positions, args.seed)
+    bench_speed(positions)
+    bench_memory(positions)
+
+if __name__ == "__main__":
+    main()
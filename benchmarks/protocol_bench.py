@@ -0,0 +1,123 @@
+# Fuzz and throughput benchmark for the wire protocol.
+#
+#   fuzz        builds a random stream of valid frames, feeds it to a FrameBuffer in
+#               randomly sized pieces and checks every frame comes out intact. Then it
+#               feeds random garbage and checks the only error ever raised is
+#               ProtocolError.
+#   throughput  encodes and decodes MOVES frames (one move each and batches of 16)
+#               and reports frames and moves per second.
+#
+#   python3 benchmarks/protocol_bench.py [--seed N] [--rounds N]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol
+from protocol import FrameBuffer, ProtocolError
+from rules import new_position
+
+def random_frame(rng: random.Random) -> tuple:
+    kind = rng.choice([protocol.START, protocol.MOVES, protocol.CLOCK, protocol.POSITION,
+                       protocol.RESYNC, protocol.ERROR, protocol.JOIN])
+    if kind == protocol.START:
+        frame = protocol.encode_start(rng.randrange(2))
+    elif kind == protocol.MOVES:
+        frame = protocol.encode_moves([rng.randrange(1 << 15) for _ in range(rng.randint(1, 40))])
+    elif kind == protocol.CLOCK:
+        frame = protocol.encode_clock(rng.randrange(1 << 32), rng.randrange(1 << 32))
+    elif kind == protocol.POSITION:
+        frame = protocol.encode_position(new_position())
+    elif kind == protocol.RESYNC:
+        frame = protocol.encode_resync()
+    elif kind == protocol.JOIN:
+        frame = protocol.encode_join()
+    else:
+        frame = protocol.encode_error("x" * rng.randint(0, 300))
+    return kind, frame[3:], frame
+
+def fuzz(rng: random.Random, rounds: int):
+    for _ in range(rounds):
+        frames = [random_frame(rng) for _ in range(rng.randint(1, 50))]
+        stream = protocol.encode_hello() + b"".join(frame for _, _, frame in frames)
+
+        buffer = FrameBuffer()
+        received = []
+        at = 0
+        while at < len(stream):
+            size = rng.choice([1, 2, 3, rng.randint(1, 64), rng.randint(1, 4096)])
+            received += buffer.feed(stream[at:at + size])
+            at += size
+
+        expected = [(protocol.HELLO, protocol.MAGIC + bytes([protocol.PROTOCOL_VERSION]))]
+        expected += [(kind, payload) for kind, payload, _ in frames]
+        assert received == expected, "frames changed in transit"
+        assert not buffer.buffer, "bytes left over in the buffer"
+
+    rejected = 0
+    for _ in range(rounds):
+        buffer = FrameBuffer()
+        if rng.random() < 0.8:
+            buffer.feed(protocol.encode_hello())
+        # either pure noise, or a valid stream with a few bytes corrupted
+        if rng.random() < 0.3:
+            garbage = bytes(rng.randrange(256) for _ in range(rng.randint(1, 200)))
+        else:
+            garbage = bytearray(b"".join(random_frame(rng)[2] for _ in range(rng.randint(1, 10))))
+            for _ in range(rng.randint(1, 4)):
+                garbage[rng.randrange(len(garbage))] = rng.randrange(256)
+        try:
+            for kind, payload in buffer.feed(bytes(garbage)):
+                decode_payload(kind, payload)
+        except ProtocolError:
+            rejected += 1
+    print("fuzz: %d valid streams round-tripped; %d corrupt streams raised %d ProtocolErrors "
+          "(the rest decoded or were waiting for more bytes) and no other exceptions" % (rounds, rounds, rejected))
+
+DECODERS = {protocol.HELLO: protocol.decode_hello, protocol.START: protocol.decode_start,
+            protocol.MOVES: protocol.decode_moves, protocol.CLOCK: protocol.decode_clock,
+            protocol.POSITION: protocol.decode_position, protocol.ERROR: protocol.decode_error}
+
+def decode_payload(kind: int, payload: bytes):
+    if kind in DECODERS:
+        DECODERS[kind](payload)
+
+def throughput(batch: int, count: int):
+    moves = [random.randrange(1 << 15) for _ in range(batch)]
+
+    start = time.perf_counter()
+    frames = [protocol.encode_moves(moves) for _ in range(count)]
+    encode_time = time.perf_counter() - start
+
+    stream = protocol.encode_hello() + b"".join(frames)
+    start = time.perf_counter()
+    buffer = FrameBuffer()
+    decoded = 0
+    for at in range(0, len(stream), 4096):
+        for kind, payload in buffer.feed(stream[at:at + 4096]):
+            if kind == protocol.MOVES:
+                decoded += len(protocol.decode_moves(payload))
+    decode_time = time.perf_counter() - start
+    assert decoded == batch * count
+
+    print("batch %2d: encode %9.0f frames/s %10.0f moves/s | decode %9.0f frames/s %10.0f moves/s | %.1f bytes/move" %
+          (batch, count / encode_time, count * batch / encode_time,
+           count / decode_time, count * batch / decode_time, len(frames[0]) / batch))
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuzz and benchmark the wire protocol.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=300)
+    parser.add_argument("--frames", type=int, default=100000)
+    args = parser.parse_args()
+
+    fuzz(random.Random(args.seed), args.rounds)
+    throughput(1, args.frames)
+    throughput(16, args.frames // 4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# Cold-start benchmark for the headless rules core.
+#
+# Starts a fresh interpreter for every run and times `import rules` (which pulls in
+# position, movegen and cache) against an interpreter that imports nothing, so the
+# difference is what the core costs a server or a test at startup.
+#
+#   python3 benchmarks/startup.py [--runs N] [--module rules]
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def time_interpreter(code: str, runs: int) -> list:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=repo_root, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+# import time of the module itself, measured inside the child so process startup noise
+# doesn't drown it out
+def time_import(module: str, runs: int) -> list:
+    code = ("import time; start = time.perf_counter(); import " + module +
+            "; print(time.perf_counter() - start)")
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], cwd=repo_root, check=True,
+                             capture_output=True, text=True).stdout
+        times.append(float(out))
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--module", default="rules")
+    args = parser.parse_args()
+
+    # compile once up front so every measured run reads cached bytecode
+    time_interpreter("import " + args.module, 1)
+
+    baseline = time_interpreter("pass", args.runs)
+    with_core = time_interpreter("import " + args.module, args.runs)
+    imports = time_import(args.module, args.runs)
+
+    print("interpreter startup:      %6.2f ms" % (statistics.median(baseline) * 1e3))
+    print("startup + import %-8s %6.2f ms" % (args.module + ":", statistics.median(with_core) * 1e3))
+    print("import %-18s %6.2f ms (median), %.2f ms (best)" %
+          (args.module + " alone:", statistics.median(imports) * 1e3, min(imports) * 1e3))
+
+    # the core must stay usable on machines without a display or tkinter at all
+    code = "import sys, " + args.module + "; print('tkinter' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=repo_root, check=True,
+                         capture_output=True, text=True).stdout.strip()
+    print("imports tkinter:          %s" % out)
+
+if __name__ == "__main__":
+    main()
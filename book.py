@@ -0,0 +1,233 @@
+# Opening book: the moves played from each early position of a collection of games,
+# with how often each was played.
+#
+# The book file is a 16-byte header (magic, version, entry count) followed by fixed-size
+# entries sorted by (position hash, move):
+#
+#   key     u64  Zobrist hash of the position
+#   move    u16  position.encode_move
+#   weight  u32  number of games that played the move, or its weight
+#
+# OpeningBook maps the file read-only and finds a position's moves by binary search,
+# so opening a book costs nothing, a lookup is a few microseconds, and every process
+# using the same book shares one copy of it in the page cache.
+#
+# build_book makes a book from PGN in one streaming pass. Counts are kept in memory up
+# to max_entries at a time; past that they are spilled to sorted run files that are
+# merged at the end, so collections of any size can be ingested.
+#
+#   python3 book.py build book.bin games.pgn [more.pgn ...] [--plies 20] [--min-games 2]
+#   python3 book.py probe book.bin [--fen FEN]
+
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+
+from position import Position
+
+MAGIC = b"CHBK"
+# version 2: en passant squares nobody can capture on stopped counting towards the hash
+VERSION = 2
+
+_HEADER = struct.Struct(">4sB3xQ")
+_ENTRY = struct.Struct(">QHI")
+_MAX_WEIGHT = (1 << 32) - 1
+
+class OpeningBook:
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count = _HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError("%s is not a version %d opening book" % (path, VERSION))
+        if len(self.map) < _HEADER.size + self.count * _ENTRY.size:
+            self.map.close()
+            raise ValueError("%s is truncated" % path)
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    # (move, weight) for every book move of a hash, most played first
+    def lookup(self, key: int) -> list[tuple[int, int]]:
+        data, unpack, size, base = self.map, _ENTRY.unpack_from, _ENTRY.size, _HEADER.size
+        # first entry with this key
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) >> 1
+            if unpack(data, base + middle * size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        moves = []
+        while low < self.count:
+            entry_key, move, weight = unpack(data, base + low * size)
+            if entry_key != key:
+                break
+            moves.append((move, weight))
+            low += 1
+        moves.sort(key=lambda entry: -entry[1])
+        return moves
+
+    # book moves of a position. moves that aren't legal there (which only a hash
+    # collision could cause) are left out.
+    def moves(self, position: Position) -> list[tuple[int, int]]:
+        from movegen import cached_legal_moves
+
+        found = self.lookup(position.zobrist)
+        legal = cached_legal_moves(position)
+        return [(move, weight) for move, weight in found if move in legal]
+
+    # a book move picked at random in proportion to its weight, or None when out of book
+    def choose(self, position: Position, rng=None):
+        found = self.moves(position)
+        if not found:
+            return None
+        if rng is None:
+            import random
+            rng = random
+        pick = rng.random() * sum(weight for _, weight in found)
+        for move, weight in found:
+            pick -= weight
+            if pick < 0:
+                return move
+        return found[-1][0]
+
+# the entries of every sorted source merged into one sorted stream, with the weights of
+# equal (key, move) pairs added up
+def _merged(sources):
+    import heapq
+
+    last = None
+    weight = 0
+    for key, move, count in heapq.merge(*sources):
+        if (key, move) == last:
+            weight += count
+            continue
+        if last is not None:
+            yield last[0], last[1], weight
+        last, weight = (key, move), count
+    if last is not None:
+        yield last[0], last[1], weight
+
+def _read_run(file):
+    file.seek(0)
+    while True:
+        data = file.read(_ENTRY.size * 4096)
+        if not data:
+            return
+        yield from _ENTRY.iter_unpack(data)
+
+# Build a book from the lines of PGN files: every move of the first `plies` plies of
+# every game, counted. Moves played in fewer than min_games games are left out. Returns
+# (games read, entries written).
+def build_book(lines, output_path: str, plies: int = 20, min_games: int = 1,
+               max_entries: int = 2000000) -> tuple[int, int]:
+    import tempfile
+    from pgn import read_games, start_position, san_to_move
+
+    counts = {}
+    runs = []
+    games = 0
+
+    def spill():
+        run = tempfile.TemporaryFile()
+        for (key, move), count in sorted(counts.items()):
+            run.write(_ENTRY.pack(key, move, min(count, _MAX_WEIGHT)))
+        runs.append(run)
+        counts.clear()
+
+    for tags, san_moves, _ in read_games(lines):
+        games += 1
+        try:
+            position = start_position(tags)
+        except ValueError:
+            continue
+        for san in san_moves[:plies]:
+            try:
+                move = san_to_move(position, san)
+            except ValueError:
+                break
+            entry = (position.zobrist, move)
+            counts[entry] = counts.get(entry, 0) + 1
+            position.make_move(move)
+        position.history.clear()
+        if len(counts) >= max_entries:
+            spill()
+
+    in_memory = [(key, move, count) for (key, move), count in sorted(counts.items())]
+    counts.clear()
+    written = 0
+    temporary = output_path + ".tmp"
+    with open(temporary, "wb") as output:
+        output.write(_HEADER.pack(MAGIC, VERSION, 0))
+        for key, move, weight in _merged([_read_run(run) for run in runs] + [in_memory]):
+            if weight >= min_games:
+                output.write(_ENTRY.pack(key, move, min(weight, _MAX_WEIGHT)))
+                written += 1
+        output.seek(0)
+        output.write(_HEADER.pack(MAGIC, VERSION, written))
+    for run in runs:
+        run.close()
+    # readers that have the old book mapped keep their copy until they reopen it
+    os.replace(temporary, output_path)
+    return games, written
+
+def main():
+    import argparse
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser(description="Build or query an opening book.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="make a book from PGN files (- for stdin)")
+    build.add_argument("book")
+    build.add_argument("pgn", nargs="+")
+    build.add_argument("--plies", type=int, default=20, help="how deep into each game to read")
+    build.add_argument("--min-games", type=int, default=1,
+                       help="leave out moves played in fewer games than this")
+    probe = commands.add_parser("probe", help="list the book moves of a position")
+    probe.add_argument("book")
+    probe.add_argument("--fen")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        def lines():
+            for name in args.pgn:
+                if name == "-":
+                    yield from sys.stdin
+                else:
+                    with open(name, encoding="utf-8", errors="replace") as file:
+                        yield from file
+
+        start = time.perf_counter()
+        games, written = build_book(lines(), args.book, args.plies, args.min_games)
+        print("%d games, %d book entries in %.1fs" % (games, written, time.perf_counter() - start))
+        return
+
+    from rules import new_position
+    from pgn import move_to_san
+
+    position = Position.from_fen(args.fen) if args.fen else new_position()
+    with OpeningBook(args.book) as book:
+        start = time.perf_counter()
+        found = book.moves(position)
+        elapsed = time.perf_counter() - start
+        total = sum(weight for _, weight in found) or 1
+        for move, weight in found:
+            print("%-8s %8d  %5.1f%%" % (move_to_san(position, move), weight, 100 * weight / total))
+        print("%d book moves (lookup took %.1f us)" % (len(found), elapsed * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# Small caches for results that only depend on the position.
+
+_missing = object()
+
+# dict with a maximum size that throws out the least recently used entry when full.
+# plain dicts keep insertion order, so the first key is always the least recently used.
+class LRUCache:
+    def __init__(self, max_size: int):
+        assert(max_size > 0)
+        self.max_size = max_size
+        self.entries = {}
+
+    def get(self, key, default=None):
+        value = self.entries.pop(key, _missing)
+        if value is _missing:
+            return default
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            del self.entries[next(iter(self.entries))]
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+# bounds stored with search scores
+EXACT, LOWER_BOUND, UPPER_BOUND = 0, 1, 2
+
+class TTEntry:
+    __slots__ = ("key", "depth", "score", "bound", "best_move", "moves", "status", "age")
+
+    def __init__(self, key: int, age: int):
+        self.key = key
+        self.depth = -1
+        self.score = 0
+        self.bound = EXACT
+        self.best_move = None
+        self.moves = None
+        self.status = None
+        self.age = age
+
+# Fixed-size hash table of per-position results, indexed by the low bits of the
+# position's Zobrist hash. Each index has two slots: one that keeps the deepest search
+# result (unless it is left over from an older search) and one that is always
+# overwritten, so cheap entries like move lists never push out expensive ones.
+class TranspositionTable:
+    def __init__(self, size_bits: int = 16):
+        self.mask = (1 << size_bits) - 1
+        self.slots = [None] * (2 << size_bits)
+        self.age = 0
+
+    # call at the start of every search so old deep entries can be replaced
+    def new_search(self):
+        self.age += 1
+
+    def clear(self):
+        self.slots = [None] * len(self.slots)
+
+    def probe(self, key: int):
+        index = (key & self.mask) << 1
+        entry = self.slots[index]
+        if entry is not None and entry.key == key:
+            return entry
+        entry = self.slots[index + 1]
+        if entry is not None and entry.key == key:
+            return entry
+        return None
+
+    # find the entry for key, or make room for one that will be stored at this depth
+    def entry_for(self, key: int, depth: int = -1) -> TTEntry:
+        entry = self.probe(key)
+        if entry is not None:
+            return entry
+
+        index = (key & self.mask) << 1
+        entry = TTEntry(key, self.age)
+        deep = self.slots[index]
+        if deep is None or depth >= deep.depth or deep.age != self.age:
+            # the old deep entry still gets a second chance in the other slot
+            if deep is not None:
+                self.slots[index + 1] = deep
+            self.slots[index] = entry
+        else:
+            self.slots[index + 1] = entry
+        return entry
+
+    def store_moves(self, key: int, moves):
+        self.entry_for(key).moves = moves
+
+    def store_status(self, key: int, status):
+        self.entry_for(key).status = status
+
+    def store_search(self, key: int, depth: int, score: int, bound: int, best_move):
+        entry = self.entry_for(key, depth)
+        if depth >= entry.depth:
+            entry.depth = depth
+            entry.score = score
+            entry.bound = bound
+            entry.best_move = best_move
+        entry.age = self.age
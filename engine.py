@@ -0,0 +1,532 @@
+# Computer opponent: iterative deepening alpha-beta search on top of movegen.
+#
+# The search plays moves on a single copy of the position with make_move/unmake_move,
+# stores results in movegen's transposition table, tries the most promising moves
+# first (table move, captures by most valuable victim/least valuable attacker, killer
+# moves, then quiet moves by history score) and follows captures past the nominal depth
+# with a quiescence search. It deepens one ply at a time until the time budget runs out
+# and plays the best move of the deepest search it finished.
+#
+# start_parallel_search splits the root moves between worker processes instead, each
+# searching its share of the moves with its own table, and picks the best of their
+# answers once they are done.
+#
+# Positions down to three pieces are scored exactly from the endgame tablebases, once
+# they have been built with tablebase.py.
+#
+#   python3 engine.py [--fen FEN] [--time SECONDS] [--depth N] [--workers N]
+
+from __future__ import annotations
+
+import os
+import time
+
+from cache import EXACT, LOWER_BOUND, UPPER_BOUND
+from movegen import cached_legal_moves, in_check, transposition_table
+from position import Position, WHITE, BLACK, PAWN
+
+PIECE_VALUES = [100, 320, 330, 500, 900, 0]
+
+MATE = 100000
+MAX_PLY = 64
+INFINITY = MATE + 1
+
+# piece-square bonuses in centipawns for white, which moves towards row 0 (the first
+# row of each table)
+PAWN_TABLE = [
+     0,  0,  0,  0,  0,  0,  0,  0,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    10, 10, 20, 30, 30, 20, 10, 10,
+     5,  5, 10, 25, 25, 10,  5,  5,
+     0,  0,  0, 20, 20,  0,  0,  0,
+     5, -5,-10,  0,  0,-10, -5,  5,
+     5, 10, 10,-20,-20, 10, 10,  5,
+     0,  0,  0,  0,  0,  0,  0,  0,
+]
+KNIGHT_TABLE = [
+   -50,-40,-30,-30,-30,-30,-40,-50,
+   -40,-20,  0,  0,  0,  0,-20,-40,
+   -30,  0, 10, 15, 15, 10,  0,-30,
+   -30,  5, 15, 20, 20, 15,  5,-30,
+   -30,  0, 15, 20, 20, 15,  0,-30,
+   -30,  5, 10, 15, 15, 10,  5,-30,
+   -40,-20,  0,  5,  5,  0,-20,-40,
+   -50,-40,-30,-30,-30,-30,-40,-50,
+]
+BISHOP_TABLE = [
+   -20,-10,-10,-10,-10,-10,-10,-20,
+   -10,  0,  0,  0,  0,  0,  0,-10,
+   -10,  0,  5, 10, 10,  5,  0,-10,
+   -10,  5,  5, 10, 10,  5,  5,-10,
+   -10,  0, 10, 10, 10, 10,  0,-10,
+   -10, 10, 10, 10, 10, 10, 10,-10,
+   -10,  5,  0,  0,  0,  0,  5,-10,
+   -20,-10,-10,-10,-10,-10,-10,-20,
+]
+ROOK_TABLE = [
+     0,  0,  0,  0,  0,  0,  0,  0,
+     5, 10, 10, 10, 10, 10, 10,  5,
+    -5,  0,  0,  0,  0,  0,  0, -5,
+    -5,  0,  0,  0,  0,  0,  0, -5,
+    -5,  0,  0,  0,  0,  0,  0, -5,
+    -5,  0,  0,  0,  0,  0,  0, -5,
+    -5,  0,  0,  0,  0,  0,  0, -5,
+     0,  0,  0,  5,  5,  0,  0,  0,
+]
+QUEEN_TABLE = [
+   -20,-10,-10, -5, -5,-10,-10,-20,
+   -10,  0,  0,  0,  0,  0,  0,-10,
+   -10,  0,  5,  5,  5,  5,  0,-10,
+    -5,  0,  5,  5,  5,  5,  0, -5,
+     0,  0,  5,  5,  5,  5,  0, -5,
+   -10,  5,  5,  5,  5,  5,  0,-10,
+   -10,  0,  5,  0,  0,  0,  0,-10,
+   -20,-10,-10, -5, -5,-10,-10,-20,
+]
+KING_TABLE = [
+   -30,-40,-40,-50,-50,-40,-40,-30,
+   -30,-40,-40,-50,-50,-40,-40,-30,
+   -30,-40,-40,-50,-50,-40,-40,-30,
+   -30,-40,-40,-50,-50,-40,-40,-30,
+   -20,-30,-30,-40,-40,-30,-30,-20,
+   -10,-20,-20,-20,-20,-20,-20,-10,
+    20, 20,  0,  0,  0,  0, 20, 20,
+    20, 30, 10,  0,  0, 10, 30, 20,
+]
+PIECE_SQUARE_TABLES = [PAWN_TABLE, KNIGHT_TABLE, BISHOP_TABLE, ROOK_TABLE, QUEEN_TABLE, KING_TABLE]
+
+# SQUARE_SCORES[color][piece_type][sq] is the piece's value plus its square bonus. the
+# tables are written for white, so black's are mirrored top to bottom
+SQUARE_SCORES = [[[PIECE_VALUES[piece_type] + table[sq ^ mirror] for sq in range(64)]
+                  for piece_type, table in enumerate(PIECE_SQUARE_TABLES)]
+                 for mirror in (0, 56)]
+
+# material and piece placement from the point of view of the side to move
+def evaluate(position: Position) -> int:
+    score = 0
+    for color in (WHITE, BLACK):
+        scores = SQUARE_SCORES[color]
+        total = 0
+        for piece_type, bb in enumerate(position.boards[color]):
+            table = scores[piece_type]
+            while bb:
+                low = bb & -bb
+                total += table[low.bit_length() - 1]
+                bb ^= low
+        score += total if color == position.turn else -total
+    return score
+
+def _piece_type_on(boards: list[int], sq: int) -> int:
+    for piece_type in range(6):
+        if boards[piece_type] >> sq & 1:
+            return piece_type
+    return -1
+
+# mate scores count plies from the root while searching but plies from the position
+# itself in the table, so the same entry is right wherever the position turns up
+def _score_to_table(score: int, ply: int) -> int:
+    if score >= MATE - MAX_PLY:
+        return score + ply
+    if score <= -MATE + MAX_PLY:
+        return score - ply
+    return score
+
+def _score_from_table(score: int, ply: int) -> int:
+    if score >= MATE - MAX_PLY:
+        return score - ply
+    if score <= -MATE + MAX_PLY:
+        return score + ply
+    return score
+
+# Endgame tablebases (see tablebase.py) are opened the first time the search gets down
+# to three pieces, if any have been built; until then this costs one bit count per node.
+_tablebases = None
+
+def endgame_tablebases():
+    global _tablebases
+
+    if _tablebases is None:
+        from tablebase import Tablebases, TABLEBASE_DIR
+
+        _tablebases = Tablebases(TABLEBASE_DIR) if os.path.isdir(TABLEBASE_DIR) else False
+    return _tablebases
+
+# the exact score of a position the tablebases cover, or None
+def _tablebase_score(position: Position, ply: int):
+    tablebases = endgame_tablebases()
+    found = tablebases.probe(position) if tablebases else None
+    if found is None:
+        return None
+    result, plies = found
+    return result * (MATE - ply - plies) if result else 0
+
+class SearchTimeout(Exception):
+    pass
+
+class SearchResult:
+    __slots__ = ("best_move", "score", "depth", "nodes", "seconds")
+
+    def __init__(self, best_move, score: int, depth: int, nodes: int, seconds: float):
+        self.best_move = best_move
+        self.score = score
+        self.depth = depth
+        self.nodes = nodes
+        self.seconds = seconds
+
+class Search:
+    def __init__(self, position: Position, deadline: float, root_moves=None):
+        self.position = position
+        self.deadline = deadline
+        # only these moves are searched at the root, if given
+        self.root_moves = root_moves
+        self.nodes = 0
+        # two quiet moves per ply that recently caused a beta cutoff
+        self.killers = [[None, None] for _ in range(MAX_PLY + 1)]
+        # cutoff counts for quiet moves, indexed by from | to << 6
+        self.history = [0] * 4096
+        self.root_best = None
+
+    def check_time(self):
+        if time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+
+    # moves sorted most promising first
+    def order(self, moves: list[int], table_move, ply: int) -> list[int]:
+        position = self.position
+        us = position.turn
+        theirs = position.occupied[1 - us]
+        ours = position.boards[us]
+        enemy = position.boards[1 - us]
+        killers = self.killers[ply]
+        history = self.history
+        scored = []
+        for move in moves:
+            to = (move >> 6) & 63
+            if move == table_move:
+                score = 1 << 30
+            elif theirs >> to & 1:
+                score = (1 << 24) + 16 * PIECE_VALUES[_piece_type_on(enemy, to)] - \
+                        _piece_type_on(ours, move & 63)
+            elif move >> 12:
+                score = (1 << 24) + PIECE_VALUES[move >> 12]
+            elif to == position.ep_square and ours[PAWN] >> (move & 63) & 1:
+                score = (1 << 24) + 16 * PIECE_VALUES[PAWN]
+            elif move == killers[0]:
+                score = (1 << 23) + 1
+            elif move == killers[1]:
+                score = 1 << 23
+            else:
+                score = history[move & 4095]
+            scored.append((score, move))
+        scored.sort(reverse=True)
+        return [move for _, move in scored]
+
+    # captures and promotions, most valuable victim first
+    def noisy_moves(self, moves: list[int]) -> list[int]:
+        position = self.position
+        us = position.turn
+        theirs = position.occupied[1 - us]
+        ours = position.boards[us]
+        enemy = position.boards[1 - us]
+        scored = []
+        for move in moves:
+            to = (move >> 6) & 63
+            if theirs >> to & 1:
+                scored.append((16 * PIECE_VALUES[_piece_type_on(enemy, to)] + PIECE_VALUES[move >> 12] -
+                               _piece_type_on(ours, move & 63), move))
+            elif move >> 12:
+                scored.append((PIECE_VALUES[move >> 12], move))
+        scored.sort(reverse=True)
+        return [move for _, move in scored]
+
+    def quiescence(self, alpha: int, beta: int, ply: int) -> int:
+        self.nodes += 1
+        if not self.nodes & 1023:
+            self.check_time()
+        position = self.position
+
+        moves = cached_legal_moves(position)
+        if not moves:
+            return -MATE + ply if in_check(position, position.turn) else 0
+
+        stand_pat = evaluate(position)
+        if stand_pat >= beta or ply >= MAX_PLY:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+
+        for move in self.noisy_moves(moves):
+            position.make_move(move)
+            score = -self.quiescence(-beta, -alpha, ply + 1)
+            position.unmake_move()
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def negamax(self, depth: int, alpha: int, beta: int, ply: int) -> int:
+        self.nodes += 1
+        if not self.nodes & 1023:
+            self.check_time()
+        position = self.position
+        key = position.zobrist
+
+        # a repetition inside the search (or of a game position) counts as a draw
+        if ply and (position.repetitions.get(key, 0) > 1 or position.halfmove_clock >= 100):
+            return 0
+        if ply and (position.occupied[WHITE] | position.occupied[BLACK]).bit_count() <= 3:
+            score = _tablebase_score(position, ply)
+            if score is not None:
+                return score
+
+        checked = in_check(position, position.turn)
+        if checked and ply < MAX_PLY:
+            depth += 1
+        if depth <= 0 or ply >= MAX_PLY:
+            return self.quiescence(alpha, beta, ply)
+
+        table_move = None
+        entry = transposition_table.probe(key)
+        if entry is not None:
+            table_move = entry.best_move
+            if ply and entry.depth >= depth:
+                score = _score_from_table(entry.score, ply)
+                if entry.bound == EXACT or \
+                   (entry.bound == LOWER_BOUND and score >= beta) or \
+                   (entry.bound == UPPER_BOUND and score <= alpha):
+                    return score
+
+        if ply == 0 and self.root_moves is not None:
+            moves = self.root_moves
+        else:
+            moves = cached_legal_moves(position)
+        if not moves:
+            return -MATE + ply if checked else 0
+
+        original_alpha = alpha
+        best_score = -INFINITY
+        best_move = None
+        theirs = position.occupied[1 - position.turn]
+        for move in self.order(moves, table_move, ply):
+            position.make_move(move)
+            score = -self.negamax(depth - 1, -beta, -alpha, ply + 1)
+            position.unmake_move()
+
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if ply == 0:
+                    self.root_best = move
+            if score > alpha:
+                alpha = score
+                if alpha >= beta:
+                    if not theirs >> ((move >> 6) & 63) & 1 and not move >> 12:
+                        killers = self.killers[ply]
+                        if killers[0] != move:
+                            killers[1] = killers[0]
+                            killers[0] = move
+                        self.history[move & 4095] += depth * depth
+                    break
+
+        # a root that only searched some of its moves hasn't found the position's score
+        if ply == 0 and self.root_moves is not None:
+            return best_score
+        if best_score <= original_alpha:
+            bound = UPPER_BOUND
+        elif best_score >= beta:
+            bound = LOWER_BOUND
+        else:
+            bound = EXACT
+        transposition_table.store_search(key, depth, _score_to_table(best_score, ply), bound, best_move)
+        return best_score
+
+# search for the best move for the side to move, deepening until time_limit seconds
+# have passed. on_depth(result) is called after every finished depth. root_moves
+# limits the search to some of the legal moves.
+def search(position: Position, time_limit: float = 1.0, max_depth: int = MAX_PLY,
+           on_depth=None, root_moves=None) -> SearchResult:
+    start = time.perf_counter()
+    # searching a copy means running out of time halfway down a line is harmless
+    searcher = Search(position.copy(), start + time_limit, root_moves)
+    transposition_table.new_search()
+
+    moves = cached_legal_moves(position) if root_moves is None else root_moves
+    result = SearchResult(moves[0] if moves else None, 0, 0, 0, 0.0)
+    # a single legal move is still searched, so its score is real. only the UI's move
+    # picker (start_parallel_search) plays a forced move without thinking.
+    if not moves:
+        return result
+
+    for depth in range(1, max_depth + 1):
+        searcher.root_best = None
+        try:
+            score = searcher.negamax(depth, -INFINITY, INFINITY, 0)
+        except SearchTimeout:
+            # a move that beat the previous best at the unfinished depth is still better
+            if searcher.root_best is not None:
+                result.best_move = searcher.root_best
+            break
+        result = SearchResult(searcher.root_best, score, depth, searcher.nodes,
+                              time.perf_counter() - start)
+        if on_depth is not None:
+            on_depth(result)
+        if abs(score) >= MATE - MAX_PLY:
+            break
+
+    result.nodes = searcher.nodes
+    result.seconds = time.perf_counter() - start
+    return result
+
+# Parallel search. Workers get the position as Position.pack() bytes (plus the
+# repetition counts, which pack leaves out) and a share of the root moves, and send
+# back (depth, move, score, nodes) for every depth they finished. The deadline is
+# wall-clock time shared by every share, so one that only starts once another share
+# has finished (the pool doesn't promise one share per process) gets what is left of
+# the budget rather than a budget of its own.
+def _search_share(packed: bytes, repetitions: dict, root_moves: list[int], deadline: float,
+                  max_depth: int) -> list[tuple]:
+    position = Position.unpack(packed)
+    position.repetitions.update(repetitions)
+    depths = []
+    search(position, max(deadline - time.time(), 0.0), max_depth,
+           lambda result: depths.append((result.depth, result.best_move, result.score, result.nodes)),
+           root_moves)
+    return depths
+
+_pool = None
+_pool_workers = 0
+
+def worker_count() -> int:
+    return os.cpu_count() or 1
+
+# the worker processes are started once and kept, along with their tables
+def search_pool(workers: int | None = None):
+    global _pool
+    global _pool_workers
+
+    workers = workers or worker_count()
+    if _pool is None or _pool_workers != workers:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        # spawn rather than fork, so workers don't inherit a running Tk
+        _pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        _pool_workers = workers
+    return _pool
+
+# drop the worker processes, e.g. after one died and broke the pool. the next search
+# starts a fresh set.
+def close_pool():
+    global _pool
+
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def _ready() -> bool:
+    return True
+
+# start the worker processes now rather than on the first search. returns futures that
+# are done once the workers are up.
+def warm_up_pool(workers: int | None = None) -> list:
+    pool = search_pool(workers)
+    return [pool.submit(_ready) for _ in range(_pool_workers)]
+
+class ParallelSearch:
+    def __init__(self, futures, start: float, fallback):
+        self.futures = futures
+        self.start = start
+        self.fallback = fallback
+
+    def done(self) -> bool:
+        return all(future.done() for future in self.futures)
+
+    # waits for every worker, then merges their answers. a share that stopped early
+    # because it found a mate keeps that score at every deeper depth; otherwise moves
+    # are compared at the deepest depth every share finished.
+    def result(self) -> SearchResult:
+        shares = [future.result() for future in self.futures]
+        shares = [depths for depths in shares if depths]
+        seconds = time.perf_counter() - self.start
+        if not shares:
+            return SearchResult(self.fallback, 0, 0, 0, seconds)
+
+        def mated(depths):
+            return abs(depths[-1][2]) >= MATE - MAX_PLY
+
+        unfinished = [len(depths) for depths in shares if not mated(depths)]
+        depth = min(unfinished) if unfinished else max(len(depths) for depths in shares)
+        best = None
+        for depths in shares:
+            if len(depths) < depth and not mated(depths):
+                continue
+            entry = depths[min(depth, len(depths)) - 1]
+            if best is None or entry[2] > best[2]:
+                best = entry
+        nodes = sum(depths[-1][3] for depths in shares)
+        return SearchResult(best[1], best[2], depth, nodes, seconds)
+
+# split the root moves between worker processes and search them all at once. returns
+# a ParallelSearch to poll with done() and collect with result(), so a UI can keep
+# running while the workers think.
+def start_parallel_search(position: Position, time_limit: float = 1.0, max_depth: int = MAX_PLY,
+                          workers: int | None = None) -> ParallelSearch:
+    start = time.perf_counter()
+    moves = cached_legal_moves(position)
+    pool = search_pool(workers)
+    # one share per worker process, never more
+    shares = min(_pool_workers, len(moves))
+    packed = position.pack()
+    deadline = time.time() + time_limit
+    futures = []
+    if len(moves) > 1:
+        # dealing the moves out keeps captures and quiet moves spread over the workers
+        for index in range(shares):
+            futures.append(pool.submit(_search_share, packed, position.repetitions,
+                                       moves[index::shares], deadline, max_depth))
+    return ParallelSearch(futures, start, moves[0] if moves else None)
+
+def main():
+    import argparse
+    from perft import START_FEN, move_name
+
+    parser = argparse.ArgumentParser(description="Search a position for the best move.")
+    parser.add_argument("--fen", default=START_FEN)
+    parser.add_argument("--time", type=float, default=5.0, help="seconds to think")
+    parser.add_argument("--depth", type=int, default=MAX_PLY)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="search in this many processes, splitting the root moves")
+    parser.add_argument("--book", help="play from this opening book (see book.py) when it has the position")
+    args = parser.parse_args()
+
+    def report(result: SearchResult):
+        rate = result.nodes / result.seconds if result.seconds > 0 else 0
+        print("depth %2d  score %6d  nodes %9d  %6.2fs  %7.0f nodes/s  best %s" %
+              (result.depth, result.score, result.nodes, result.seconds, rate,
+               move_name(result.best_move)))
+
+    position = Position.from_fen(args.fen)
+    if args.book:
+        from book import OpeningBook
+
+        with OpeningBook(args.book) as book:
+            found = book.moves(position)
+        if found:
+            print("bestmove", move_name(found[0][0]), "(book)")
+            return
+
+    if args.workers > 1:
+        result = start_parallel_search(position, args.time, args.depth, args.workers).result()
+        report(result)
+    else:
+        result = search(position, args.time, args.depth, report)
+    if result.best_move is None:
+        print("no legal moves")
+    else:
+        print("bestmove", move_name(result.best_move))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+# Game database: an append-only log of games plus a fixed-size index, read through mmap.
+#
+# <path>.log holds one record per game, written once and never changed:
+#
+#   header     tag bytes (u16), result (u8), flags (u8), plies (u32), snapshots (u16)
+#   tags       utf-8 "name\tvalue\n" lines
+#   start      Position.pack() of the starting position, only if it isn't the usual one
+#   moves      one big-endian u16 per ply, packed like position.encode_move
+#   snapshots  Position.pack() after every SNAPSHOT_INTERVAL plies
+#
+# <path>.idx has 16 bytes per game: where its record starts, how long it is and how many
+# plies it has. Game N is found with one lookup, and the position at any ply by
+# unpacking the nearest snapshot at or before it and replaying at most
+# SNAPSHOT_INTERVAL - 1 moves. Both files are memory-mapped for reading, so opening a
+# database with millions of games costs next to nothing and only the pages actually
+# read are loaded.
+#
+# A record is written (and synced) before its index entry, so a crash can at worst leave
+# a record without an entry; that tail of the log is cut off the next time the
+# database is opened for writing. Writers hold an exclusive lock on the index for the
+# whole append, so two clients saving to the same database can't interleave records
+# (where fcntl exists; elsewhere one writer at a time is assumed).
+#
+#   python3 gamedb.py games --import games.pgn
+#   python3 gamedb.py games --export out.pgn
+#   python3 gamedb.py games --show N [--ply K]
+
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from position import Position
+from rules import new_position
+from pgn import RESULTS
+
+SNAPSHOT_INTERVAL = 32
+
+_HEADER = struct.Struct(">HBBIH")
+_INDEX = struct.Struct(">QII")
+_SNAPSHOT_SIZE = len(new_position().pack())
+
+# record flags
+CUSTOM_START = 1
+
+class GameDatabase:
+    def __init__(self, path: str):
+        self.log_path = path + ".log"
+        self.index_path = path + ".idx"
+        for name in (self.log_path, self.index_path):
+            if not os.path.exists(name):
+                open(name, "wb").close()
+        self.log_map = None
+        self.index_map = None
+        self.count = 0
+        self.standard_start = new_position().pack()
+        self._map()
+
+    def _map(self):
+        self.close()
+        size = os.path.getsize(self.index_path)
+        self.count = size // _INDEX.size
+        if self.count:
+            with open(self.index_path, "rb") as index:
+                self.index_map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+            with open(self.log_path, "rb") as log:
+                self.log_map = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        for mapped in (self.log_map, self.index_map):
+            if mapped is not None:
+                mapped.close()
+        self.log_map = self.index_map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    # Writing
+
+    # the record for a game, with snapshots taken by replaying its moves
+    def _record(self, moves: list[int], start: Position, tags: dict, result: str) -> bytes:
+        tag_bytes = "".join("%s\t%s\n" % (name, str(value).replace("\n", " "))
+                            for name, value in tags.items()).encode("utf-8")
+        packed_start = start.pack()
+        flags = CUSTOM_START if packed_start != self.standard_start else 0
+
+        position = start.copy()
+        snapshots = []
+        for ply, move in enumerate(moves, 1):
+            position.make_move(move)
+            if ply % SNAPSHOT_INTERVAL == 0:
+                snapshots.append(position.pack())
+        position.history.clear()
+
+        parts = [_HEADER.pack(len(tag_bytes), RESULTS.index(result), flags, len(moves), len(snapshots)),
+                 tag_bytes]
+        if flags & CUSTOM_START:
+            parts.append(packed_start)
+        parts.append(struct.pack(">%dH" % len(moves), *moves))
+        parts.extend(snapshots)
+        return b"".join(parts)
+
+    # add games, each (moves, start position or None, tags, result)
+    def append_games(self, games, sync: bool = True) -> int | None:
+        with open(self.index_path, "r+b") as index, open(self.log_path, "r+b") as log:
+            # held until the files are closed, so counting, truncating and writing are one step
+            if fcntl is not None:
+                fcntl.flock(index.fileno(), fcntl.LOCK_EX)
+            count = os.fstat(index.fileno()).st_size // _INDEX.size
+            index.truncate(count * _INDEX.size)
+            # drop anything written after the last indexed record
+            end = 0
+            if count:
+                index.seek((count - 1) * _INDEX.size)
+                offset, size, _ = _INDEX.unpack(index.read(_INDEX.size))
+                end = offset + size
+            log.truncate(end)
+            log.seek(end)
+            index.seek(count * _INDEX.size)
+
+            entries = []
+            added = 0
+            for moves, start, tags, result in games:
+                if start is None:
+                    start = new_position()
+                record = self._record(moves, start, tags, result)
+                log.write(record)
+                entries.append(_INDEX.pack(end, len(record), len(moves)))
+                end += len(record)
+                added += 1
+                # keep the index a step behind the log, in batches
+                if len(entries) >= 4096:
+                    self._flush(log, index, entries, sync)
+            self._flush(log, index, entries, sync)
+        self._map()
+        return self.count - 1 if added else None
+
+    # the log first, then the index entries that point into it
+    def _flush(self, log, index, entries: list, sync: bool):
+        log.flush()
+        if sync:
+            os.fsync(log.fileno())
+        index.write(b"".join(entries))
+        index.flush()
+        if sync:
+            os.fsync(index.fileno())
+        entries.clear()
+
+    # add one game and return its number
+    def append(self, moves: list[int], start: Position | None = None, tags: dict | None = None,
+               result: str = "*") -> int:
+        return self.append_games([(moves, start, tags or {}, result)])
+
+    # Reading
+
+    def _entry(self, game: int) -> tuple[int, int, int]:
+        if not 0 <= game < self.count:
+            raise IndexError("no game %d in a database of %d" % (game, self.count))
+        return _INDEX.unpack_from(self.index_map, game * _INDEX.size)
+
+    # (offset of the tags, header fields) of a game's record
+    def _header(self, game: int):
+        offset, _, _ = self._entry(game)
+        return offset + _HEADER.size, _HEADER.unpack_from(self.log_map, offset)
+
+    def plies(self, game: int) -> int:
+        return self._entry(game)[2]
+
+    def result(self, game: int) -> str:
+        _, (_, result, _, _, _) = self._header(game)
+        return RESULTS[result]
+
+    def tags(self, game: int) -> dict:
+        start, (tag_length, _, _, _, _) = self._header(game)
+        text = self.log_map[start:start + tag_length].decode("utf-8")
+        return dict(line.split("\t", 1) for line in text.splitlines() if "\t" in line)
+
+    # where the starting snapshot, the moves and the snapshots of a game begin
+    def _layout(self, game: int):
+        start, (tag_length, _, flags, plies, snapshots) = self._header(game)
+        start += tag_length
+        moves = start + (_SNAPSHOT_SIZE if flags & CUSTOM_START else 0)
+        snapshot_start = moves + 2 * plies
+        return start if flags & CUSTOM_START else None, moves, plies, snapshot_start, snapshots
+
+    def start_position(self, game: int) -> Position:
+        start, _, _, _, _ = self._layout(game)
+        if start is None:
+            return new_position()
+        return Position.unpack(self.log_map[start:start + _SNAPSHOT_SIZE])
+
+    def moves(self, game: int, first: int = 0, last: int | None = None) -> list[int]:
+        _, moves, plies, _, _ = self._layout(game)
+        last = plies if last is None else min(last, plies)
+        if first >= last:
+            return []
+        return list(struct.unpack_from(">%dH" % (last - first), self.log_map, moves + 2 * first))
+
+    # the position after `ply` moves of a game (the final position by default)
+    def position(self, game: int, ply: int | None = None) -> Position:
+        start, _, plies, snapshot_start, snapshots = self._layout(game)
+        ply = plies if ply is None else ply
+        if not 0 <= ply <= plies:
+            raise IndexError("game %d has %d plies, not %d" % (game, plies, ply))
+
+        snapshot = min(ply // SNAPSHOT_INTERVAL, snapshots)
+        if snapshot:
+            offset = snapshot_start + (snapshot - 1) * _SNAPSHOT_SIZE
+            position = Position.unpack(self.log_map[offset:offset + _SNAPSHOT_SIZE])
+        else:
+            position = self.start_position(game)
+        for move in self.moves(game, snapshot * SNAPSHOT_INTERVAL, ply):
+            position.make_move(move)
+        return position
+
+    # PGN
+
+    def export_pgn(self, output, games=None):
+        from pgn import write_game
+
+        for game in range(self.count) if games is None else games:
+            output.write(write_game(self.tags(game), self.moves(game), self.result(game),
+                                    self.start_position(game)))
+
+    # read every game of a PGN file; returns (games added, games skipped as unreadable)
+    def import_pgn(self, lines) -> tuple[int, int]:
+        from pgn import read_games, parse_moves, start_position
+
+        skipped = [0]
+
+        def games():
+            for tags, san_moves, result in read_games(lines):
+                try:
+                    moves = parse_moves(tags, san_moves)
+                    start = start_position(tags)
+                except ValueError:
+                    skipped[0] += 1
+                    continue
+                tags.pop("Result", None)
+                tags.pop("FEN", None)
+                tags.pop("SetUp", None)
+                yield moves, start, tags, result if result in RESULTS else "*"
+
+        before = self.count
+        self.append_games(games(), sync=False)
+        with open(self.log_path, "rb") as log, open(self.index_path, "rb") as index:
+            os.fsync(log.fileno())
+            os.fsync(index.fileno())
+        return self.count - before, skipped[0]
+
+def main():
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Game database tools.")
+    parser.add_argument("database", help="path of the database, without .log/.idx")
+    parser.add_argument("--import", dest="import_path", help="add the games of a PGN file (- for stdin)")
+    parser.add_argument("--export", help="write every game to a PGN file (- for stdout)")
+    parser.add_argument("--show", type=int, help="print a game's tags and the FEN at --ply")
+    parser.add_argument("--ply", type=int)
+    args = parser.parse_args()
+
+    with GameDatabase(args.database) as db:
+        if args.import_path:
+            lines = sys.stdin if args.import_path == "-" else open(args.import_path, encoding="utf-8",
+                                                                   errors="replace")
+            with lines:
+                added, skipped = db.import_pgn(lines)
+            print("imported %d games, skipped %d" % (added, skipped), file=sys.stderr)
+        if args.export:
+            if args.export == "-":
+                db.export_pgn(sys.stdout)
+            else:
+                with open(args.export, "w") as output:
+                    db.export_pgn(output)
+        if args.show is not None:
+            for name, value in db.tags(args.show).items():
+                print("%s: %s" % (name, value))
+            print("Result:", db.result(args.show))
+            print("Plies:", db.plies(args.show))
+            print(db.position(args.show, args.ply).to_fen())
+        if not (args.import_path or args.export or args.show is not None):
+            print("%d games" % len(db))
+
+if __name__ == "__main__":
+    main()
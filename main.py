@@ -5,440 +5,555 @@ host_ip = "localhost"
 host_port = 12345
 
 import tkinter as tk
-from typing import List
-from typing import Tuple
 
+import os
 import socket
 import select
-import copy
+import sys
+import time
 
-root = tk.Tk()
-root.title("Multiplayer Chess")
-root.resizable(False, False)
+from position import square, board_size
+from position import WHITE, BLACK, COLOR_NAMES
+from movegen import position_status, cached_legal_moves, move_map
+from protocol import FrameBuffer, Outbox, ProtocolError, START, MOVES, POSITION, RESYNC, ERROR, PING
+from protocol import encode_hello, encode_start, encode_watch, encode_join, encode_resync, encode_position
+from protocol import encode_ping, encode_pong, decode_moves, decode_start, decode_position, decode_error
+from rules import is_draw, new_position, board_move, IMAGE_KEYS
+from engine import search, start_parallel_search, warm_up_pool, close_pool, endgame_tablebases
+from gamedb import GameDatabase
+
+# The window, canvas and piece images are only created once the UI starts (see
+# start_ui), so importing this module doesn't open a window or decode any images.
+root = None
 
 
-board_size = 8
 cell_size = 60
 
 clicked_row, clicked_col = None, None
 
 my_color = "white"
 my_turn = True
-my_king_pos = (7, 4) # for quick retrieval later
+# spectators of a game on a relay server only watch, they never move
+spectating = False
 on_title_screen = True
+# playing against the engine instead of someone over a socket
+playing_computer = False
+# seconds the computer thinks about each move
+computer_think_time = 2.0
+# the computer thinks in worker processes; Tk checks on them this often
+search_poll_ms = 20
+pending_search = None
+# the computer plays from this opening book (see book.py) while it has the position
+book_path = "book.bin"
+opening_book = None
 
 canvas = None
 
 my_socket = None
 
-class Piece:
-    def __init__(self, name: str, piece_type: str, color: str, row: int, col: int):
-        self.name = name
-        self.piece_type = piece_type
-        self.color = color
-        self.row = row
-        self.col = col
-        self.first_move = True
-        self.en_passant = False
-        assert(color == "black" or color == "white")
-    
-    # return all valid moves for this piece
-    def valid_moves(self, piece_positions) -> List[Tuple[int, int]]:
-        moves = []
-        if self.piece_type == "rook":
-            moves = self.rook_moves(piece_positions)
-        elif self.piece_type == "knight":
-            moves = self.knight_moves(piece_positions)
-        elif self.piece_type == "queen":
-            moves = self.rook_moves(piece_positions) + self.bishop_moves(piece_positions)
-        elif self.piece_type == "king":
-            moves = self.king_moves(piece_positions)
-        elif self.piece_type == "bishop":
-            moves = self.bishop_moves(piece_positions)
-        else:
-            moves = self.pawn_moves(piece_positions)
-
-        moves = self.prune_check_moves(moves, piece_positions)
-        return moves
-
-    # prune any moves that would result in a check so that we don't display them when trying
-    # to make a move.
-    # 
-    # unfortunately, there's no better way to do this than brute forcing all next positions and
-    # seeing if they would result in a check. but since the upper bound of moves is low, this 
-    # isn't a huge deal.
-    def prune_check_moves(self, moves: List[Tuple[int, int]], piece_positions) -> List[Tuple[int, int]]:
-        global my_king_pos
-
-        final_moves = copy.deepcopy(moves)
-
-        king_row, king_col = my_king_pos
-
-        old_row, old_col = self.row, self.col
-
-        is_king = self.piece_type == "king"
-
-        scratch = copy.deepcopy(piece_positions)
-        scratch.pop((self.row, self.col))
-
-        for (row, col) in moves:
-            piece = scratch.get((row, col))
-            if piece:
-                scratch.pop((row, col))
-
-            self.row, self.col = row, col
-            scratch[(row, col)] = self
-
-            if is_king:
-                king_row, king_col = row, col
-
-            if is_in_mate(king_row, king_col, scratch):
-                final_moves.remove((row, col))
-
-            scratch.pop((row, col))
-            if piece:
-                scratch[(row, col)] = piece
-
-        self.row, self.col = old_row, old_col
-        return final_moves
-    
-    # all the proceeding code "X"_moves is just for getting the valid moves of the 
-    # given piece type "X"
-    def rook_moves(self, piece_positions) -> List[Tuple[int, int]]:
-        moves = []
-        dxs_dys = [(-1, 0), (1, 0), (0, -1), (0, 1)]
-
-        for (dx, dy) in dxs_dys:
-            row, col = self.row, self.col
-            while row + dx >= 0 and row + dx <= board_size and col + dy >= 0 and col + dy <= board_size:
-                row += dx
-                col += dy
-                piece = piece_positions.get((row, col))
-                if piece:
-                    if piece.color != self.color:
-                        moves.append((row, col))
-                    break
-                moves.append((row, col))
-
-        return moves
-
-    def knight_moves(self, piece_positions) -> List[Tuple[int, int]]:
-        moves = []
-
-        offsets = [
-            (-2, -1), (-1, -2), (1, -2), (2, -1),
-            (2, 1), (1, 2), (-1, 2), (-2, 1)
-        ]
-
-        for (dx, dy) in offsets:
-            new_row, new_col = self.row + dx, self.col + dy
-
-            if 0 <= new_row < board_size and 0 <= new_col < board_size:
-                piece = piece_positions.get((new_row, new_col))
-                if not piece or piece.color != self.color:
-                    moves.append((new_row, new_col))
-
-        return moves
-
-    def bishop_moves(self, piece_positions) -> List[Tuple[int, int]]:
-        moves = []
-
-        dxs_dys = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
-
-        for (dx, dy) in dxs_dys:
-            row, col = self.row, self.col
-            while row + dx >= 0 and row + dx <= board_size and col + dy >= 0 and col + dy <= board_size:
-                row += dx
-                col += dy
-                piece = piece_positions.get((row, col))
-                if piece:
-                    if piece.color != self.color:
-                        moves.append((row, col))
-                    break
-                moves.append((row, col))
-
-        return moves
-
-    def king_moves(self, piece_positions) -> List[Tuple[int, int]]:
-        moves = []
-
-        offsets = [
-            (-1, -1), (-1, 0), (-1, 1),
-            (0, 1), (0, -1),
-            (1, -1), (1, 0), (1, 1),
-        ]
-
-        for (dx, dy) in offsets:
-            new_row, new_col = self.row + dx, self.col + dy
-
-            if 0 <= new_row < board_size and 0 <= new_col < board_size:
-                piece = piece_positions.get((new_row, new_col))
-                if not piece or piece.color != self.color:
-                    moves.append((new_row, new_col))
-
-        return moves
-
-    def pawn_moves(self, piece_positions) -> List[Tuple[int, int]]:
-        moves = []
-        if (self.row - 1, self.col) not in piece_positions:
-            moves.append((self.row - 1, self.col))
-            if self.first_move and (self.row - 2, self.col) not in piece_positions:
-                moves.append((self.row - 2, self.col))
-
-        piece_diag_left = piece_positions.get((self.row - 1, self.col - 1))
-        piece_diag_right = piece_positions.get((self.row - 1, self.col + 1))
-
-        piece_check = [piece_diag_left, piece_diag_right]
-
-        for piece in piece_check:
-            if piece and piece.color != self.color:
-                moves.append((self.row - 1, piece.col))
-
-        # Check for en passant
-        piece_left = piece_positions.get((self.row, self.col - 1))
-        piece_right = piece_positions.get((self.row, self.col + 1))
-        piece_check = [piece_left, piece_right]
-
-        for piece in piece_check:
-            if piece and piece.en_passant and piece.color != self.color:
-                moves.append((self.row - 1, piece.col))
-            
-        return moves
-    
-    def is_valid_move(self, row: int, col: int, piece_positions) -> bool:
-        return (row, col) in self.valid_moves(piece_positions)
-
-piece_positions = {
-    (0, 0): Piece("rook_black", "rook", "black", 0, 0),
-    (0, 1): Piece("knight_black", "knight", "black", 0, 1),
-    (0, 2): Piece("bishop_black", "bishop", "black", 0, 2),
-    (0, 3): Piece("queen_black", "queen", "black", 0, 3),
-    (0, 4): Piece("king_black", "king", "black", 0, 4),
-    (0, 5): Piece("bishop_black", "bishop", "black", 0, 5),
-    (0, 6): Piece("knight_black", "knight", "black", 0, 6),
-    (0, 7): Piece("rook_black", "rook", "black", 0, 7),
-    (1, 0): Piece("pawn_black", "pawn", "black", 1, 0),
-    (1, 1): Piece("pawn_black", "pawn", "black", 1, 1),
-    (1, 2): Piece("pawn_black", "pawn", "black", 1, 2),
-    (1, 3): Piece("pawn_black", "pawn", "black", 1, 3),
-    (1, 4): Piece("pawn_black", "pawn", "black", 1, 4),
-    (1, 5): Piece("pawn_black", "pawn", "black", 1, 5),
-    (1, 6): Piece("pawn_black", "pawn", "black", 1, 6),
-    (1, 7): Piece("pawn_black", "pawn", "black", 1, 7),
-    (7, 0): Piece("rook_white", "rook", "white", 7, 0),
-    (7, 1): Piece("knight_white", "knight", "white", 7, 1),
-    (7, 2): Piece("bishop_white", "bishop", "white", 7, 2),
-    (7, 3): Piece("queen_white", "queen", "white", 7, 3),
-    (7, 4): Piece("king_white", "king", "white", 7, 4),
-    (7, 5): Piece("bishop_white", "bishop", "white", 7, 5),
-    (7, 6): Piece("knight_white", "knight", "white", 7, 6),
-    (7, 7): Piece("rook_white", "rook", "white", 7, 7),
-    (6, 0): Piece("pawn_white", "pawn", "white", 6, 0),
-    (6, 1): Piece("pawn_white", "pawn", "white", 6, 1),
-    (6, 2): Piece("pawn_white", "pawn", "white", 6, 2),
-    (6, 3): Piece("pawn_white", "pawn", "white", 6, 3),
-    (6, 4): Piece("pawn_white", "pawn", "white", 6, 4),
-    (6, 5): Piece("pawn_white", "pawn", "white", 6, 5),
-    (6, 6): Piece("pawn_white", "pawn", "white", 6, 6),
-    (6, 7): Piece("pawn_white", "pawn", "white", 6, 7),
-}
+position = new_position()
+
+# every game played is added to this database (games.log and games.idx) when it ends
+game_db_path = "games"
+# the game so far: where it started (None for the usual start) and every move since
+recorded_start = None
+recorded_moves = []
+game_saved = False
+
+# Set CHESS_METRICS=timers (or =profile to run cProfile as well) to time move
+# generation, drawing and the network code; see metrics.py. The numbers are written to
+# metrics_file every metrics_interval_ms and on exit, and with CHESS_METRICS_PORT also
+# served on http://127.0.0.1:<port>/metrics. A PING goes out every ping_interval_ms to
+# time the round trip to the other side. Without it nothing is timed at all.
+metrics_mode = os.environ.get("CHESS_METRICS")
+metrics_port = int(os.environ.get("CHESS_METRICS_PORT", "0"))
+metrics_file = "metrics.prom"
+profile_file = "profile.pstats"
+metrics_interval_ms = 30000
+ping_interval_ms = 5000
 
 piece_images = {}
-piece_images["king_white"] = tk.PhotoImage(file="assets/king_white.png").subsample(32)
-piece_images["queen_white"] = tk.PhotoImage(file="assets/queen_white.png").subsample(32)
-piece_images["rook_white"] = tk.PhotoImage(file="assets/rook_white.png").subsample(32)
-piece_images["bishop_white"] = tk.PhotoImage(file="assets/bishop_white.png").subsample(32)
-piece_images["knight_white"] = tk.PhotoImage(file="assets/knight_white.png").subsample(32)
-piece_images["pawn_white"] = tk.PhotoImage(file="assets/pawn_white.png").subsample(32)
-piece_images["king_black"] = tk.PhotoImage(file="assets/king_black.png").subsample(32)
-piece_images["queen_black"] = tk.PhotoImage(file="assets/queen_black.png").subsample(32)
-piece_images["rook_black"] = tk.PhotoImage(file="assets/rook_black.png").subsample(32)
-piece_images["bishop_black"] = tk.PhotoImage(file="assets/bishop_black.png").subsample(32)
-piece_images["knight_black"] = tk.PhotoImage(file="assets/knight_black.png").subsample(32)
-piece_images["pawn_black"] = tk.PhotoImage(file="assets/pawn_black.png").subsample(32)
+
+def load_piece_images():
+    for name in ["king", "queen", "rook", "bishop", "knight", "pawn"]:
+        for color in ["white", "black"]:
+            key = name + "_" + color
+            piece_images[key] = tk.PhotoImage(file="assets/" + key + ".png").subsample(32)
 
 def handle_click(event):
     global clicked_col  
     global clicked_row
-    global piece_positions
+    global position
     global my_socket
     global my_turn
-    global my_king_pos
 
-    assert(my_socket)
+    assert(my_socket or playing_computer)
 
     highlight_list = []
+
+    if spectating:
+        return
+
+    # Nothing left to click on once the game is over.
+    status = position_status(position, COLOR_NAMES.index(my_color))
+    if status.checkmate or status.stalemate or is_draw(position):
+        return
     
+    # Both clicks are lookups in the map of legal moves, which prepare_moves has
+    # usually built already while the player was thinking. clicked_row/clicked_col and
+    # the highlights are screen squares; the moves are board squares.
     if clicked_row is None:
         # Player hasn't selected anything yet. Highlight any clicked piece.
         clicked_col = event.x // cell_size
         clicked_row = event.y // cell_size
-        piece = piece_positions.get((clicked_row, clicked_col))
-        if not piece or piece.color != my_color or not my_turn:
+        targets = move_map(position).get(view_square(square(clicked_row, clicked_col))) \
+            if 0 <= clicked_row < board_size and 0 <= clicked_col < board_size else None
+        if not targets or not my_turn:
             clicked_row, clicked_col = None, None
         else:
-            highlight_list = piece.valid_moves(piece_positions)
+            highlight_list = [divmod(view_square(to_sq), board_size) for to_sq in targets]
     else:
         # Player wants to move a piece or unselect the piece.
         assert(clicked_col is not None)
         move_col = event.x // cell_size
         move_row = event.y // cell_size
-        piece = piece_positions.get((clicked_row, clicked_col))
-        # If it's a valid move, then make the move & send. Extra check for removing an 
-        # en passant piece, since it kills a target on a square other than the square moved to.
-        if piece and piece.is_valid_move(move_row, move_col, piece_positions):
-            msg = str(piece.row) + str(piece.col) + str(move_row) + str(move_col)
+        from_sq = view_square(square(clicked_row, clicked_col))
+        # If it's a valid move, then make the move & send. The position takes care of
+        # removing an en passant target, which sits on a square other than the one moved to,
+        # and of bringing the rook along when castling.
+        if 0 <= move_row < board_size and 0 <= move_col < board_size and \
+           view_square(square(move_row, move_col)) in move_map(position).get(from_sq, ()):
+            to_sq = view_square(square(move_row, move_col))
+            move = board_move(position, from_sq, to_sq)
+            position.make_move(move)
+            recorded_moves.append(move)
+
+            if playing_computer:
+                # give Tk a moment to draw our move before the computer starts thinking
+                root.after(50, computer_move)
+            else:
+                outbox.queue_move(move)
+                schedule_flush()
+            my_turn = False
 
-            if piece.piece_type == "pawn" and move_col != piece.col:
-                en_passant_piece = piece_positions.get((piece.row, move_col))
-                if en_passant_piece:
-                    piece_positions.pop((piece.row, move_col))
 
-                    
-            piece.row = move_row
-            piece.col = move_col
+        clicked_row, clicked_col = None, None
 
-            piece.first_move = False
-            piece_positions.pop((clicked_row, clicked_col))
-            piece_positions[(move_row, move_col)] = piece
+    draw_board(None, highlight_list)
 
-            for (_, piece) in piece_positions.items():
-                piece.en_passant = False
+def computer_move():
+    global pending_search
 
-            if piece.piece_type == "king":
-                my_king_pos = (piece.row, piece.col)
+    status = position_status(position)
+    if status.checkmate or status.stalemate or is_draw(position):
+        return
 
-            my_socket.sendall(msg.encode())
-            my_turn = False
+    move = book_move() or tablebase_move()
+    if move is not None:
+        play_computer_move(move)
+        return
 
+    pending_search = start_parallel_search(position, computer_think_time)
+    root.after(search_poll_ms, finish_computer_move)
+
+# a move from the opening book, or None once the game has left it (or there is no book)
+def book_move():
+    global opening_book
+
+    if opening_book is None:
+        if not os.path.exists(book_path):
+            return None
+        from book import OpeningBook
+
+        try:
+            opening_book = OpeningBook(book_path)
+        except (OSError, ValueError) as error:
+            print("Couldn't open the opening book:", error)
+            return None
+    return opening_book.choose(position)
+
+# the perfect move when the tablebases cover the position
+def tablebase_move():
+    if position.all_occupied().bit_count() > 3:
+        return None
+    tablebases = endgame_tablebases()
+    return tablebases.best_move(position) if tablebases else None
+
+# "White mates in 5" and so on when the tablebases know how the game ends
+def tablebase_verdict() -> str:
+    if position.all_occupied().bit_count() > 3:
+        return ""
+    tablebases = endgame_tablebases()
+    found = tablebases.probe(position) if tablebases else None
+    if found is None:
+        return ""
+    result, plies = found
+    if not result:
+        return "Drawn with best play"
+    winner = position.turn if result > 0 else 1 - position.turn
+    return "%s mates in %d" % (COLOR_NAMES[winner].capitalize(), (plies + 1) // 2)
+
+def finish_computer_move():
+    global pending_search
+
+    if not pending_search.done():
+        root.after(search_poll_ms, finish_computer_move)
+        return
 
-        clicked_row, clicked_col = None, None
+    finished, pending_search = pending_search, None
+    try:
+        move = finished.result().best_move
+    except Exception as error:
+        # a worker died or raised: think in this process instead, and start new
+        # workers for the next move
+        print("Search workers failed:", repr(error))
+        close_pool()
+        move = search(position, computer_think_time).best_move or finished.fallback
+    play_computer_move(move)
+
+def play_computer_move(move: int):
+    global my_turn
 
-    draw_board(None, highlight_list)
+    position.make_move(move)
+    recorded_moves.append(move)
+    my_turn = True
+    draw_board()
+    schedule_prepare_moves()
+
+# The position is always stored with white at the bottom, the same as on the wire and
+# on the other player's screen. The black player sees the board upside down, which
+# only changes where each square is drawn and what a click lands on: this turns a
+# board square into the screen square it is drawn on, and back.
+def view_square(sq: int) -> int:
+    return sq ^ 56 if my_color == "black" else sq
+
+# handle one frame from the opponent
+def decode_message(kind: int, payload: bytes):
+    global position
+    global my_turn
+    global my_color
 
-def decode_message(msg: str):
-    global piece_positions
-    # Message format is just the rows and columns of the move
-    # e.g. 1234 moves (1,2) to (3,4)
-    row_1, col_1 = 7 - int(msg[0]), int(msg[1])
-    row_2, col_2 = 7 - int(msg[2]), int(msg[3])
+    if kind == START:
+        # the host (or a relay server) says which side we play
+        # which only decides which way up the board is drawn
+        my_color = COLOR_NAMES[decode_start(payload)]
+    elif kind == MOVES:
+        for move in decode_moves(payload):
+            if move not in cached_legal_moves(position):
+                # Our boards disagree, ask for the opponent's copy
+                print("Received an illegal move, resynchronising.")
+                outbox.queue(encode_resync())
+                schedule_flush()
+                break
+            position.make_move(move)
+            recorded_moves.append(move)
+    elif kind == POSITION:
+        position = decode_position(payload)
+        # the moves before the snapshot are lost, so the record starts over from it
+        record_from(position)
+    elif kind == RESYNC:
+        outbox.queue(encode_position(position))
+        schedule_flush()
+    elif kind == PING:
+        outbox.queue(encode_pong(payload))
+        schedule_flush()
+    elif kind == ERROR:
+        print("Opponent reported an error:", decode_error(payload))
+
+    my_turn = not spectating and position.turn == COLOR_NAMES.index(my_color)
+    if my_turn:
+        schedule_prepare_moves()
+
+# As soon as it's our turn, work out every legal move (and whether there are any) once
+# Tk is idle, so the clicks that follow only look them up.
+prepare_scheduled = False
+
+def schedule_prepare_moves():
+    global prepare_scheduled
+
+    if not prepare_scheduled:
+        prepare_scheduled = True
+        root.after_idle(prepare_moves)
+
+def prepare_moves():
+    global prepare_scheduled
+
+    prepare_scheduled = False
+    move_map(position)
+    position_status(position)
+
+def record_from(start):
+    global recorded_start
+    global recorded_moves
+
+    recorded_start = start.copy()
+    recorded_start.history.clear()
+    recorded_moves = []
+
+def game_result() -> str:
+    status = position_status(position)
+    if status.checkmate:
+        return "0-1" if position.turn == WHITE else "1-0"
+    if status.stalemate or is_draw(position):
+        return "1/2-1/2"
+    return "*"
+
+# add the game to the database; only once, however many ways it ends
+def save_game():
+    global game_saved
+
+    if game_saved or not recorded_moves:
+        return
+    game_saved = True
 
-    piece = piece_positions.get((row_1, col_1))
-    assert(piece)
+    if playing_computer:
+        opponent = "Computer"
+    else:
+        opponent = "Opponent"
+    names = {"white": "?", "black": "?"}
+    if not spectating:
+        names = {color: "Local player" if color == my_color else opponent for color in names}
+    tags = {"Event": "Casual game", "Date": time.strftime("%Y.%m.%d"),
+            "White": names["white"], "Black": names["black"]}
+    try:
+        with GameDatabase(game_db_path) as db:
+            db.append(recorded_moves, recorded_start, tags, game_result())
+    except OSError as error:
+        print("Couldn't save the game:", error)
+
+# Outgoing frames are queued and written together once Tk is idle, so everything
+# produced while handling one event goes out in a single send.
+outbox = Outbox()
+flush_scheduled = False
+receive_buffer = FrameBuffer()
+# bytes taken from the outbox that the socket had no room for yet. while there are any
+# the socket is watched for writability too, and they go out before anything newer.
+unsent = bytearray()
+watching_writable = False
+
+def schedule_flush():
+    global flush_scheduled
+
+    if not flush_scheduled:
+        flush_scheduled = True
+        root.after_idle(flush_outbox)
+
+def flush_outbox():
+    global flush_scheduled
+    global watching_writable
+
+    flush_scheduled = False
+    if not connected():
+        return
+    if outbox.pending():
+        unsent.extend(outbox.take())
+    if not unsent:
+        return
+    try:
+        sent = my_socket.send(unsent)
+    except BlockingIOError:
+        sent = 0
+    except OSError as error:
+        drop_connection("Connection lost: %s" % error)
+        return
+    del unsent[:sent]
+
+    # whatever the socket couldn't take goes out as soon as it has room again
+    if bool(unsent) != watching_writable:
+        watching_writable = bool(unsent)
+        unwatch_socket(my_socket)
+        if unsent:
+            watch_socket(my_socket, tk.READABLE | tk.WRITABLE, socket_ready)
+        else:
+            watch_socket(my_socket, tk.READABLE, listen_and_decode)
 
-    piece_positions.pop((row_1, col_1))
+# the socket is readable, or writable again while bytes are waiting to go out
+def socket_ready():
+    if unsent:
+        flush_outbox()
+    if connected():
+        listen_and_decode()
 
-    if piece_positions.get((row_2, col_2)):
-        piece_positions.pop((row_2, col_2))
+def connected() -> bool:
+    return my_socket is not None and my_socket.fileno() != -1
 
-    piece.en_passant = piece.first_move and \
-                       piece.piece_type == "pawn" and \
-                       row_2 == piece.row + 2
+# stop talking to the other side for good, keeping the game so far
+def drop_connection(reason: str):
+    print(reason)
+    unwatch_socket(my_socket)
+    my_socket.close()
+    unsent.clear()
+    save_game()
 
-    # special case for en passant, since captured piece is diff
-    if piece.piece_type == "pawn" and col_2 != piece.col:
-        en_passant_piece = piece_positions.get((piece.row, col_2))
-        if en_passant_piece:
-            piece_positions.pop((piece.row, col_2))
+# Sockets are watched with Tk file handlers, so Tk calls us back as soon as there is
+# something to read (or a connection to accept) and the app sleeps while nothing
+# happens. Tk on Windows has no file handlers, so there we fall back to polling.
+poll_interval_ms = 20
+socket_watchers = {}
 
-    piece.first_move = False
-    piece.row = row_2
-    piece.col = col_2
-    piece_positions[(row_2, col_2)] = piece
+def watch_socket(sock, mask, callback):
+    try:
+        root.tk.createfilehandler(sock, mask, lambda _sock, _mask: callback())
+        socket_watchers[sock] = None
+    except AttributeError:
+        socket_watchers[sock] = root.after(poll_interval_ms, poll_socket, sock, mask, callback)
 
+def unwatch_socket(sock):
+    if sock not in socket_watchers:
+        return
+    pending = socket_watchers.pop(sock)
+    if pending is None:
+        root.tk.deletefilehandler(sock)
+    else:
+        root.after_cancel(pending)
+
+def poll_socket(sock, mask, callback):
+    readers = [sock] if mask & tk.READABLE else []
+    writers = [sock] if mask & tk.WRITABLE else []
+    readable, writable, _ = select.select(readers, writers, [], 0)
+    if readable or writable:
+        callback()
+    # the callback may have stopped watching this socket
+    if sock in socket_watchers:
+        socket_watchers[sock] = root.after(poll_interval_ms, poll_socket, sock, mask, callback)
+
+# called by Tk whenever the opponent's socket has data
 def listen_and_decode():
-    global my_turn
     global my_socket
 
     assert(my_socket)
 
-    if not my_turn:
-        readable, _, _ = select.select([my_socket], [], [], 0.01)
-        if readable:
-            # Read data from the client
-            data = my_socket.recv(4)
-            if data:
-                decode_message(data.decode())
-                my_turn = True
-                draw_board()
-            else:
-                # Client disconnected, game can't continue
-                return
-        else:
-            root.after(100, listen_and_decode)
+    try:
+        data = my_socket.recv(4096)
+    except BlockingIOError:
+        return
+    except OSError as error:
+        # a reset or any other socket error ends the game just like a clean disconnect
+        drop_connection("Connection lost: %s" % error)
+        return
 
-def is_in_mate(king_row, king_col, piece_positions) -> bool:
-    global my_color
-    king = piece_positions.get((king_row, king_col))
-    assert(king and king.piece_type == "king" and king.color == my_color)
-
-    # Check for pawns first in the unlikely case that happens.
-    dxs_dys = [(-1, -1), (-1, 1)]
-    for (dx, dy) in dxs_dys:
-        pawn = piece_positions.get((king_row + dx, king_col + dy))
-        if pawn and pawn.color != my_color and pawn.piece_type == "pawn":
-            return True
-
-    # We can actually reuse the rook/bishop/knight move functions for the rest.
-    for (row, col) in king.rook_moves(piece_positions):
-        piece = piece_positions.get((row, col))
-        if piece and piece.color != my_color and (piece.piece_type == "rook" or piece.piece_type == "queen"):
-            return True
-
-    for (row, col) in king.bishop_moves(piece_positions):
-        piece = piece_positions.get((row, col))
-        if piece and piece.color != my_color and (piece.piece_type == "bishop" or piece.piece_type == "queen"):
-            return True
-
-    for (row, col) in king.knight_moves(piece_positions):
-        piece = piece_positions.get((row, col))
-        if piece and piece.color != my_color and piece.piece_type == "knight":
-            return True
-
-    for (row, col) in king.king_moves(piece_positions):
-        piece = piece_positions.get((row, col))
-        if piece and piece.color != my_color and piece.piece_type == "king":
-            return True
-
-    # Can't be captured if we get here
-    return False
-
-def is_in_checkmate(piece_positions) -> bool:
-    for (_, piece) in piece_positions.items():
-        if piece.color != my_color:
-            continue
-        moves = piece.valid_moves(piece_positions)
-        if len(moves) > 0:
-            return False
-    return True
+    if not data:
+        # Client disconnected, game can't continue
+        drop_connection("Opponent disconnected.")
+        return
+
+    # A read can hold part of a frame or several frames, the buffer sorts that out.
+    try:
+        frames = receive_buffer.feed(data)
+    except ProtocolError as error:
+        drop_connection("Bad data from opponent, disconnecting: %s" % error)
+        return
+
+    for kind, payload in frames:
+        decode_message(kind, payload)
+
+    if frames:
+        draw_board()
+
+# Canvas items stay around between redraws: one rectangle per square and one image per
+# piece, keyed by (row, col). A redraw only touches the items whose fill color, image
+# or position actually changed.
+square_items = {}
+square_fills = {}
+piece_items = {}
+piece_names = {}
+drawn_cell_size = None
+
+# highlighted squares, kept so that a resize redraw doesn't drop them
+current_highlights = []
+
+# how long to wait for a burst of <Configure> events to settle before redrawing
+resize_delay_ms = 50
+pending_resize = None
+
+def schedule_redraw(_=None):
+    global pending_resize
+
+    if pending_resize is not None:
+        root.after_cancel(pending_resize)
+    pending_resize = root.after(resize_delay_ms, redraw_after_resize)
+
+def redraw_after_resize():
+    global pending_resize
+
+    pending_resize = None
+    draw_board(None, current_highlights)
+
+# move every square and piece item to where it belongs for the given cell size
+def layout_board(new_cell_size: int):
+    global drawn_cell_size
+    global cell_size
+
+    for (row, col), item in square_items.items():
+        x1 = col * new_cell_size
+        y1 = row * new_cell_size
+        canvas.coords(item, x1, y1, x1 + new_cell_size, y1 + new_cell_size)
+
+    for (row, col), item in piece_items.items():
+        canvas.coords(item, col * new_cell_size + new_cell_size // 2,
+                      row * new_cell_size + new_cell_size // 2)
+
+    # clicks are mapped back to squares with the same size
+    drawn_cell_size = cell_size = new_cell_size
 
 def draw_board(_=None, highlight_list=[]):
     global clicked_col
     global clicked_row
-    global piece_positions
-    global my_king_pos
+    global position
     global canvas
     global on_title_screen
     global my_socket
     global my_turn
+    global current_highlights
 
     if on_title_screen:
         draw_title_screen()
         return
 
+    if not piece_images:
+        load_piece_images()
+
     if not canvas:
        canvas = tk.Canvas(root, width=board_size * cell_size, height=board_size * cell_size)
        canvas.bind("<Button-1>", handle_click)
+       canvas.pack(fill=tk.BOTH, expand=True)
 
-    canvas.delete("all")
-
-    canvas.pack(fill=tk.BOTH, expand=True)
+    current_highlights = highlight_list
 
     canvas_width = canvas.winfo_width()
     canvas_height = canvas.winfo_height()
 
     new_board_size = min(canvas_width, canvas_height)
     new_cell_size = new_board_size // board_size
+    # the canvas reports a 1x1 size until it has been mapped on screen
+    if new_cell_size <= 0:
+        new_cell_size = cell_size
+
+    if new_cell_size != drawn_cell_size:
+        layout_board(new_cell_size)
+
+    piece_positions = position.piece_squares()
+
+    # Check/checkmate only change when the position does, so this is a cache lookup on
+    # every redraw after the first.
+    my_side = COLOR_NAMES.index(my_color)
+    status = position_status(position, my_side)
+    if status.checkmate:
+        print("Checkmate! You lose.")
+    elif status.stalemate:
+        print("Stalemate! It's a draw.")
+    elif position.is_threefold_repetition():
+        print("Threefold repetition! It's a draw.")
+    elif position.is_fifty_move_draw():
+        print("Fifty moves without a capture or pawn move! It's a draw.")
+    # saved as soon as the game is over, whichever side won
+    if game_result() != "*":
+        save_game()
+
+    verdict = tablebase_verdict()
+    root.title("Multiplayer Chess" + (" - " + verdict if verdict else ""))
+
+    king_square = divmod(view_square(position.king_square(my_side)), board_size)
 
     # Draw chessboard
     for row in range(board_size):
@@ -448,9 +563,6 @@ def draw_board(_=None, highlight_list=[]):
             x2 = x1 + new_cell_size
             y2 = y1 + new_cell_size
 
-            # Draw the chess pieces
-            piece = piece_positions.get((row, col))
-
             if (row + col) % 2 == 0:
                 color = "white"
             else:
@@ -460,50 +572,47 @@ def draw_board(_=None, highlight_list=[]):
             if (row, col) in highlight_list:
                 color = "blue"
 
-            king_row, king_col = my_king_pos
-
-            if piece and piece.piece_type == "king" and piece.color == my_color and \
-               is_in_mate(king_row, king_col, piece_positions):
-                if is_in_checkmate(piece_positions):
-                    print("Checkmate! You lose.")
+            if status.in_check and (row, col) == king_square:
                 color = "pink"
 
             if (row == clicked_row and col == clicked_col):
                 color = "red"
 
-            canvas.create_rectangle(x1, y1, x2, y2, fill=color, outline="black")
+            item = square_items.get((row, col))
+            if item is None:
+                square_items[(row, col)] = canvas.create_rectangle(x1, y1, x2, y2, fill=color, outline="black")
+                square_fills[(row, col)] = color
+            elif square_fills[(row, col)] != color:
+                canvas.itemconfigure(item, fill=color)
+                square_fills[(row, col)] = color
 
-            if piece:
-                image = piece_images[piece.name]
+            # Draw the chess pieces
+            found = piece_positions.get(divmod(view_square(square(row, col)), board_size))
+            name = IMAGE_KEYS[found[0]][found[1]] if found else None
+            if name == piece_names.get((row, col)):
+                continue
+
+            item = piece_items.pop((row, col), None)
+            piece_names.pop((row, col), None)
+            if item is not None and not name:
+                canvas.delete(item)
+            elif item is not None:
+                canvas.itemconfigure(item, image=piece_images[name])
+            else:
                 x = x1 + new_cell_size // 2
                 y = y1 + new_cell_size // 2
-                canvas.create_image(x, y, image=image)
-
-    if not my_turn:
-        listen_and_decode()
-
-def reverse_piece_map():
-    # reverse the pieces for the "client" side, so that pieces
-    # show on the other side of the board
-    global piece_positions
-    global my_king_pos
-
-    new_map = {}
-    for (row, col), piece in piece_positions.items():
-        row = piece.row = 7 - row
-        new_map[(row, col)] = piece
-    
-    piece_positions = new_map
+                item = canvas.create_image(x, y, image=piece_images[name])
+            if name:
+                piece_items[(row, col)] = item
+                piece_names[(row, col)] = name
 
 def connect():
     global on_title_screen
-    global my_socket
     global my_color
     global my_turn
     
     # If we are connecting, we will be the black color
     my_color = "black"
-    reverse_piece_map()
     on_title_screen = False
     my_turn = False
 
@@ -516,35 +625,79 @@ def connect():
                            text="Trying to connect...", 
                            font=("Arial", 24, "bold"))
     title_label.pack(pady=20)
-    root.update()
-    root.update_idletasks()
+
+    try_connect()
+
+# play white against the engine, no network involved
+def play_computer():
+    global on_title_screen
+    global playing_computer
+    global my_turn
+
+    playing_computer = True
+    on_title_screen = False
+    my_turn = True
+    # start the search processes while the player thinks about their first move
+    warm_up_pool()
+
+    for widget in root.winfo_children():
+        widget.destroy()
+
+    draw_board()
+    root.bind('<Configure>', schedule_redraw)
+    schedule_prepare_moves()
+
+# connect to a relay server and watch its newest game
+def watch():
+    global on_title_screen
+    global spectating
+    global my_turn
+
+    spectating = True
+    on_title_screen = False
+    my_turn = False
+
+    for widget in root.winfo_children():
+        widget.destroy()
+
+    container_frame = tk.Frame(root)
+    container_frame.pack(padx=80, pady=80, fill=tk.BOTH)
+    title_label = tk.Label(container_frame, 
+                           text="Trying to connect...", 
+                           font=("Arial", 24, "bold"))
+    title_label.pack(pady=20)
+
+    try_connect()
+
+# start a non-blocking connect; Tk tells us when the socket becomes writable, which is
+# when the connection either went through or failed
+def try_connect():
+    global my_socket
 
     my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     my_socket.setblocking(False)
     try:
-        my_socket.connect(('localhost', host_port))
+        my_socket.connect((host_ip, host_port))
     except BlockingIOError:
-        pass  # Connection is in progress, will be handled by select
+        pass  # Connection is in progress, finish_connect gets called once it's done
 
-    while True:
-        _, writable, _ = select.select([], [my_socket], [], 0.1)
+    watch_socket(my_socket, tk.WRITABLE, finish_connect)
 
-        if my_socket in writable:
-            print("Connected to server")
-            break
+def finish_connect():
+    unwatch_socket(my_socket)
 
-        root.update()
-        root.update_idletasks()
-        
-    for widget in root.winfo_children():
-        widget.destroy()
+    error = my_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if error:
+        # Nobody is hosting yet, try again in a bit
+        my_socket.close()
+        root.after(500, try_connect)
+        return
 
-    draw_board()
-    root.bind('<Configure>', draw_board)
+    print("Connected to server")
+    start_game()
 
 def host():
     global on_title_screen
-    global my_socket
     on_title_screen = False
     for widget in root.winfo_children():
         widget.destroy()
@@ -559,24 +712,49 @@ def host():
 
     server_sock.setblocking(False)
 
-    server_sock.bind(('localhost', host_port))
+    server_sock.bind((host_ip, host_port))
 
     server_sock.listen()
 
-    while True:
-        readable, _, _ = select.select([server_sock], [], [], 0.1)
-        if server_sock in readable:
-            my_socket, address = server_sock.accept()
-            print(f"Accepted connection from ", address)
-            break
-        root.update()
-        root.update_idletasks()
+    watch_socket(server_sock, tk.READABLE, lambda: accept_opponent(server_sock))
+
+def accept_opponent(server_sock):
+    global my_socket
+
+    try:
+        my_socket, address = server_sock.accept()
+    except BlockingIOError:
+        return
+    print(f"Accepted connection from ", address)
+
+    unwatch_socket(server_sock)
+    server_sock.close()
+    start_game()
+    # we are white, tell the joiner the same way a relay server would
+    outbox.queue(encode_start(BLACK))
+    schedule_flush()
+
+def start_game():
+    # moves are tiny, so don't let Nagle's algorithm hold them back waiting for more data
+    my_socket.setblocking(False)
+    my_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     for widget in root.winfo_children():
         widget.destroy()
 
     draw_board()
-    root.bind('<Configure>', draw_board)
+    root.bind('<Configure>', schedule_redraw)
+    watch_socket(my_socket, tk.READABLE, listen_and_decode)
+    if my_turn and not spectating:
+        schedule_prepare_moves()
+
+    outbox.queue(encode_hello())
+    # a relay server pairs us up or lets us watch depending on which of these it gets
+    if spectating:
+        outbox.queue(encode_watch())
+    else:
+        outbox.queue(encode_join())
+    schedule_flush()
 
 def draw_title_screen():
     container_frame = tk.Frame(root)
@@ -594,7 +772,58 @@ def draw_title_screen():
     host_button = tk.Button(button_frame, text="Host", padx=20, pady=10, command=host)
     host_button.pack(side=tk.LEFT, padx=10)
 
-if __name__ == '__main__':
+    watch_button = tk.Button(button_frame, text="Watch", padx=20, pady=10, command=watch)
+    watch_button.pack(side=tk.LEFT, padx=10)
+
+    computer_button = tk.Button(button_frame, text="Play computer", padx=20, pady=10,
+                                command=play_computer)
+    computer_button.pack(side=tk.LEFT, padx=10)
+
+def start_metrics():
+    import metrics
+
+    metrics.enable(sys.modules[__name__], profile=metrics_mode == "profile")
+    if metrics_port:
+        metrics.serve(metrics_port)
+    root.after(metrics_interval_ms, export_metrics)
+    root.after(ping_interval_ms, send_ping)
+
+# the PONG that answers this brings the time back, for metrics to measure the round trip
+def send_ping():
+    # only once the other side's HELLO is in, which means ours has gone out too
+    if connected() and receive_buffer.greeted:
+        outbox.queue(encode_ping(time.perf_counter_ns()))
+        schedule_flush()
+    root.after(ping_interval_ms, send_ping)
+
+def export_metrics():
+    import metrics
+
+    metrics.write(metrics_file)
+    if metrics_mode == "profile":
+        metrics.write_profile(profile_file)
+    root.after(metrics_interval_ms, export_metrics)
+
+# an unfinished game is saved too, with result "*"
+def close_window():
+    save_game()
+    if metrics_mode:
+        export_metrics()
+    root.destroy()
+
+def start_ui():
+    global root
+
+    root = tk.Tk()
+    root.title("Multiplayer Chess")
+    root.resizable(False, False)
+    root.protocol("WM_DELETE_WINDOW", close_window)
+    if metrics_mode:
+        start_metrics()
+
     draw_board()
     root.mainloop()
 
+if __name__ == '__main__':
+    start_ui()
+
@@ -0,0 +1,280 @@
+# Timers, counters and histograms for the client, for finding out where time goes.
+#
+# Nothing is measured until enable() is called: it swaps the functions listed in
+# TARGETS for timing wrappers (everywhere they were imported, not just in their own
+# module) and disable() puts the originals back. So while metrics are off the code
+# runs exactly as if this module didn't exist.
+#
+#   movegen  Piece.valid_moves, prune_check_moves, is_in_mate and the movegen functions
+#   render   draw_board
+#   network  listen_and_decode, decode_message, flush_outbox
+#   ping     the round trip of a PING frame to the other side and its PONG back
+#
+# Many of these call each other, so a group's histogram only times the outermost call
+# into the group, and each function also gets a histogram of its own time: the time
+# spent inside it minus the time spent in the timed functions it called.
+#
+# Results can be written to a file (Prometheus text format, or JSON if the name ends in
+# .json) or served on http://127.0.0.1:<port>/metrics and /metrics.json. enable(profile=True)
+# also runs cProfile, whose stats write_profile() saves for pstats/snakeviz.
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import threading
+import time
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0]
+
+# (owner module, attribute path) of every function timed, by histogram. "main" is the
+# module passed to enable() as app, which is __main__ when the client runs as a script.
+TARGETS = {
+    "movegen": [("rules", "Piece.valid_moves"), ("rules", "Piece.prune_check_moves"),
+                ("rules", "is_in_mate"), ("movegen", "legal_moves"),
+                ("movegen", "cached_legal_moves"), ("movegen", "move_map"),
+                ("movegen", "position_status")],
+    "render": [("main", "draw_board")],
+    "network": [("main", "listen_and_decode"), ("main", "decode_message"),
+                ("main", "flush_outbox")],
+}
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += seconds
+        self.count += 1
+
+    # the value below which `fraction` of the observations fall, to bucket precision
+    def quantile(self, fraction: float) -> float:
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return BUCKETS[index] if index < len(BUCKETS) else float("inf")
+        return 0.0
+
+histograms = {}
+# function name -> [calls, seconds of its own]
+counters = {}
+# function name -> Histogram of its own time per call
+function_histograms = {}
+
+# time spent in timed callees by each timed call still running, innermost last
+_child_time = []
+# timed calls of each group still running, so a group only times its outermost call
+_group_depth = {}
+
+_patched = []
+_profiler = None
+_started = None
+
+def histogram(name: str) -> Histogram:
+    found = histograms.get(name)
+    if found is None:
+        found = histograms[name] = Histogram()
+    return found
+
+def _timed(function, name: str, group_name: str):
+    counter = counters.setdefault(name, [0, 0.0])
+    own = function_histograms.get(name)
+    if own is None:
+        own = function_histograms[name] = Histogram()
+    group = histogram(group_name)
+    clock = time.perf_counter
+    child_time = _child_time
+    depth = _group_depth
+    depth.setdefault(group_name, 0)
+
+    def timed(*args, **kwargs):
+        outermost = not depth[group_name]
+        depth[group_name] += 1
+        child_time.append(0.0)
+        start = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = clock() - start
+            depth[group_name] -= 1
+            exclusive = elapsed - child_time.pop()
+            if child_time:
+                child_time[-1] += elapsed
+            counter[0] += 1
+            counter[1] += exclusive
+            own.observe(exclusive)
+            if outermost:
+                group.observe(elapsed)
+
+    timed.__wrapped__ = function
+    timed.__name__ = function.__name__
+    timed.__doc__ = function.__doc__
+    return timed
+
+# replace attribute `name` of owner, and of every module that imported the same object
+def _patch(owner, name: str, replacement):
+    original = getattr(owner, name)
+    _patched.append((owner, name, original))
+    setattr(owner, name, replacement)
+    if isinstance(owner, type):
+        return
+    for module in list(sys.modules.values()):
+        if module is not None and module is not owner and getattr(module, name, None) is original:
+            _patched.append((module, name, original))
+            setattr(module, name, replacement)
+
+# a PONG carries back the perf_counter_ns() its PING was sent at, so its round trip is
+# measured as it is decoded
+def _round_trip(app):
+    from protocol import PONG, decode_ping
+
+    ping = histogram("ping")
+    decode = app.decode_message
+
+    def decode_message(kind, payload):
+        if kind == PONG:
+            ping.observe((time.perf_counter_ns() - decode_ping(payload)) / 1e9)
+        return decode(kind, payload)
+
+    _patch(app, "decode_message", decode_message)
+
+def enabled() -> bool:
+    return bool(_patched)
+
+def enable(app=None, profile: bool = False):
+    global _profiler
+    global _started
+
+    if _patched:
+        return
+    _started = time.time()
+    modules = {"main": app} if app is not None else {}
+    if app is not None:
+        _round_trip(app)
+    for group, targets in TARGETS.items():
+        for module_name, path in targets:
+            owner = modules.get(module_name) or sys.modules.get(module_name)
+            if owner is None:
+                continue
+            *parents, name = path.split(".")
+            for parent in parents:
+                owner = getattr(owner, parent)
+            _patch(owner, name, _timed(getattr(owner, name), module_name + "." + path, group))
+    if profile:
+        import cProfile
+
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+def disable():
+    global _profiler
+
+    while _patched:
+        owner, name, original = _patched.pop()
+        setattr(owner, name, original)
+    if _profiler is not None:
+        _profiler.disable()
+
+# zero everything; the wrappers keep their counters and histograms, so clear them in place
+def reset():
+    for counter in counters.values():
+        counter[0], counter[1] = 0, 0.0
+    for found in list(histograms.values()) + list(function_histograms.values()):
+        found.counts = [0] * (len(BUCKETS) + 1)
+        found.total = 0.0
+        found.count = 0
+
+# Export
+
+def as_dict() -> dict:
+    return {
+        "started": _started,
+        "time": time.time(),
+        "functions": {name: {"calls": calls, "seconds": seconds,
+                             "p50": function_histograms[name].quantile(0.5),
+                             "p99": function_histograms[name].quantile(0.99)}
+                      for name, (calls, seconds) in sorted(counters.items())},
+        "histograms": {name: {"count": found.count, "sum": found.total,
+                              "p50": found.quantile(0.5), "p99": found.quantile(0.99),
+                              "buckets": dict(zip([str(bound) for bound in BUCKETS] + ["+Inf"],
+                                                  found.counts))}
+                       for name, found in sorted(histograms.items())},
+    }
+
+def prometheus_text() -> str:
+    lines = ["# TYPE chess_function_calls_total counter"]
+    for name, (calls, _) in sorted(counters.items()):
+        lines.append('chess_function_calls_total{function="%s"} %d' % (name, calls))
+    lines.append("# TYPE chess_function_seconds_total counter")
+    for name, (_, seconds) in sorted(counters.items()):
+        lines.append('chess_function_seconds_total{function="%s"} %.9f' % (name, seconds))
+    for name, found in sorted(histograms.items()):
+        metric = "chess_%s_seconds" % name
+        lines.append("# TYPE %s histogram" % metric)
+        _histogram_lines(lines, metric, "", found)
+    lines.append("# TYPE chess_function_own_seconds histogram")
+    for name, found in sorted(function_histograms.items()):
+        _histogram_lines(lines, "chess_function_own_seconds", 'function="%s",' % name, found)
+    return "\n".join(lines) + "\n"
+
+def _histogram_lines(lines: list, metric: str, labels: str, found: Histogram):
+    cumulative = 0
+    for bound, count in zip([repr(bound) for bound in BUCKETS] + ["+Inf"], found.counts):
+        cumulative += count
+        lines.append('%s_bucket{%sle="%s"} %d' % (metric, labels, bound, cumulative))
+    braces = "{%s}" % labels.rstrip(",") if labels else ""
+    lines.append("%s_sum%s %.9f" % (metric, braces, found.total))
+    lines.append("%s_count%s %d" % (metric, braces, found.count))
+
+# write the metrics to path, as JSON if it ends in .json and Prometheus text otherwise
+def write(path: str):
+    text = json.dumps(as_dict(), indent=1) if path.endswith(".json") else prometheus_text()
+    # written next to the old file and renamed over it, so a scraper never sees half
+    temporary = path + ".tmp"
+    with open(temporary, "w") as output:
+        output.write(text)
+    os.replace(temporary, path)
+
+def write_profile(path: str):
+    if _profiler is not None:
+        _profiler.dump_stats(path)
+
+# answer /metrics (Prometheus text) and /metrics.json on a background thread
+def serve(port: int, host: str = "127.0.0.1"):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, kind = prometheus_text(), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body, kind = json.dumps(as_dict()), "application/json"
+            else:
+                self.send_error(404)
+                return
+            data = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", kind)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *_):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,286 @@
+# Table-driven attack detection and legal move generation on top of Position.
+#
+# Attack tables for knights, kings and pawns and the rays used by sliding pieces are
+# built once when this module is imported. legal_moves finds the checkers and pinned
+# pieces once per position and only ever emits legal moves, so nothing has to be made
+# and taken back to test for check (apart from the odd en passant capture).
+
+from __future__ import annotations
+
+from cache import LRUCache, TranspositionTable
+from position import Position, board_size, encode_move, lowest_square
+from position import WHITE, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING
+
+# pawn directions: UP moves towards row 0, DOWN towards row 7
+UP, DOWN = 0, 1
+
+PROMOTIONS = [QUEEN, ROOK, BISHOP, KNIGHT]
+
+# ray directions as (row, col) steps. the first four increase the square index as
+# they go, the last four decrease it.
+DIRECTIONS = [(1, 0), (0, 1), (1, 1), (1, -1), (-1, 0), (0, -1), (-1, -1), (-1, 1)]
+ROOK_DIRECTIONS = [0, 1, 4, 5]
+BISHOP_DIRECTIONS = [2, 3, 6, 7]
+
+def _bits(bb: int):
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+def _step_table(offsets) -> list[int]:
+    table = []
+    for sq in range(64):
+        row, col = divmod(sq, board_size)
+        bb = 0
+        for (dx, dy) in offsets:
+            if 0 <= row + dx < board_size and 0 <= col + dy < board_size:
+                bb |= 1 << ((row + dx) * board_size + col + dy)
+        table.append(bb)
+    return table
+
+def _ray_table(dx: int, dy: int) -> list[int]:
+    table = []
+    for sq in range(64):
+        row, col = divmod(sq, board_size)
+        bb = 0
+        while 0 <= row + dx < board_size and 0 <= col + dy < board_size:
+            row += dx
+            col += dy
+            bb |= 1 << (row * board_size + col)
+        table.append(bb)
+    return table
+
+KNIGHT_ATTACKS = _step_table([(-2, -1), (-1, -2), (1, -2), (2, -1), (2, 1), (1, 2), (-1, 2), (-2, 1)])
+KING_ATTACKS = _step_table([(-1, -1), (-1, 0), (-1, 1), (0, 1), (0, -1), (1, -1), (1, 0), (1, 1)])
+PAWN_ATTACKS = [_step_table([(-1, -1), (-1, 1)]), _step_table([(1, -1), (1, 1)])]
+RAYS = [_ray_table(dx, dy) for (dx, dy) in DIRECTIONS]
+
+# ROOK_RAYS[sq] / BISHOP_RAYS[sq] are the squares those pieces would see on an empty board
+ROOK_RAYS = [RAYS[0][sq] | RAYS[1][sq] | RAYS[4][sq] | RAYS[5][sq] for sq in range(64)]
+BISHOP_RAYS = [RAYS[2][sq] | RAYS[3][sq] | RAYS[6][sq] | RAYS[7][sq] for sq in range(64)]
+
+def _line_tables():
+    # BETWEEN[a][b] is the squares strictly between a and b, LINE[a][b] is the whole
+    # line through both of them. both are 0 if a and b don't share a rank, file or diagonal.
+    between = [[0] * 64 for _ in range(64)]
+    line = [[0] * 64 for _ in range(64)]
+    for a in range(64):
+        for d in range(8):
+            opposite = (d + 4) % 8
+            full = RAYS[d][a] | RAYS[opposite][a] | (1 << a)
+            for b in _bits(RAYS[d][a]):
+                between[a][b] = RAYS[d][a] & RAYS[opposite][b]
+                line[a][b] = full
+    return between, line
+
+BETWEEN, LINE = _line_tables()
+
+def slider_attacks(sq: int, occupied: int, directions: list[int]) -> int:
+    attacks = 0
+    for d in directions:
+        ray = RAYS[d][sq]
+        blockers = ray & occupied
+        if blockers:
+            if d < 4:
+                blocker = (blockers & -blockers).bit_length() - 1
+            else:
+                blocker = blockers.bit_length() - 1
+            ray ^= RAYS[d][blocker]
+        attacks |= ray
+    return attacks
+
+def rook_attacks(sq: int, occupied: int) -> int:
+    return slider_attacks(sq, occupied, ROOK_DIRECTIONS)
+
+def bishop_attacks(sq: int, occupied: int) -> int:
+    return slider_attacks(sq, occupied, BISHOP_DIRECTIONS)
+
+def pawn_direction(color: int) -> int:
+    return UP if color == WHITE else DOWN
+
+# bitboard of the pieces of color `by` that attack sq, given the occupied squares
+def attackers_to(position: Position, sq: int, by: int, occupied: int | None = None) -> int:
+    if occupied is None:
+        occupied = position.all_occupied()
+    boards = position.boards[by]
+    # a pawn attacks sq if sq's pawn attacks in the other direction land on it
+    pawn_sources = PAWN_ATTACKS[1 - pawn_direction(by)][sq]
+    attackers = (pawn_sources & boards[PAWN]) | \
+                (KNIGHT_ATTACKS[sq] & boards[KNIGHT]) | \
+                (KING_ATTACKS[sq] & boards[KING])
+    straight = boards[ROOK] | boards[QUEEN]
+    if ROOK_RAYS[sq] & straight:
+        attackers |= rook_attacks(sq, occupied) & straight
+    diagonal = boards[BISHOP] | boards[QUEEN]
+    if BISHOP_RAYS[sq] & diagonal:
+        attackers |= bishop_attacks(sq, occupied) & diagonal
+    return attackers
+
+def is_attacked(position: Position, sq: int, by: int) -> bool:
+    return attackers_to(position, sq, by) != 0
+
+def in_check(position: Position, color: int) -> bool:
+    return attackers_to(position, position.king_square(color), 1 - color) != 0
+
+# all legal moves for color (the side to move by default), packed with encode_move
+def legal_moves(position: Position, color: int | None = None) -> list[int]:
+    us = position.turn if color is None else color
+    them = 1 - us
+    own = position.occupied[us]
+    theirs = position.occupied[them]
+    occupied = own | theirs
+    boards = position.boards[us]
+    enemy = position.boards[them]
+    king = position.king_square(us)
+    moves = []
+
+    # the king can go anywhere not attacked once it has stepped off its square
+    without_king = occupied & ~(1 << king)
+    for to in _bits(KING_ATTACKS[king] & ~own):
+        if not attackers_to(position, to, them, without_king):
+            moves.append(king | (to << 6))
+
+    checkers = attackers_to(position, king, them, occupied)
+
+    # castling: king and rook unmoved, nothing between them, and the king neither starts
+    # in, passes through nor lands on an attacked square
+    if not checkers and position.unmoved >> king & 1:
+        row_start = king - king % board_size
+        for rook, step in ((row_start + board_size - 1, 1), (row_start, -1)):
+            if not (position.unmoved & boards[ROOK]) >> rook & 1 or BETWEEN[king][rook] & occupied:
+                continue
+            if attackers_to(position, king + step, them, occupied) or \
+               attackers_to(position, king + 2 * step, them, occupied):
+                continue
+            moves.append(king | ((king + 2 * step) << 6))
+
+    if checkers & (checkers - 1):
+        # double check, only the king can move
+        return moves
+
+    # squares other pieces may move to: anywhere, or only onto/in front of a single checker
+    if checkers:
+        target = checkers | BETWEEN[king][lowest_square(checkers)]
+    else:
+        target = ~own
+
+    # pieces pinned against our king by an enemy slider can only move along the pin
+    pinned = 0
+    snipers = (ROOK_RAYS[king] & (enemy[ROOK] | enemy[QUEEN])) | \
+              (BISHOP_RAYS[king] & (enemy[BISHOP] | enemy[QUEEN]))
+    for sniper in _bits(snipers):
+        blockers = BETWEEN[king][sniper] & occupied
+        if blockers and not blockers & (blockers - 1) and blockers & own:
+            pinned |= blockers
+
+    for sq in _bits(boards[KNIGHT] & ~pinned):
+        for to in _bits(KNIGHT_ATTACKS[sq] & target):
+            moves.append(sq | (to << 6))
+
+    for piece_type, directions in ((BISHOP, BISHOP_DIRECTIONS), (ROOK, ROOK_DIRECTIONS),
+                                   (QUEEN, ROOK_DIRECTIONS + BISHOP_DIRECTIONS)):
+        for sq in _bits(boards[piece_type]):
+            reachable = slider_attacks(sq, occupied, directions) & target
+            if pinned >> sq & 1:
+                reachable &= LINE[king][sq]
+            for to in _bits(reachable):
+                moves.append(sq | (to << 6))
+
+    direction = pawn_direction(us)
+    step = position.pawn_step(us)
+    home_row = position.pawn_home_row(us)
+    promotion_row = 0 if direction == UP else board_size - 1
+    # en passant is only possible for the side to move
+    ep_square = position.ep_square if us == position.turn else None
+    for sq in _bits(boards[PAWN]):
+        allowed = target
+        if pinned >> sq & 1:
+            allowed &= LINE[king][sq]
+
+        to = sq + step
+        if not occupied >> to & 1:
+            if allowed >> to & 1:
+                if to // board_size == promotion_row:
+                    for piece_type in PROMOTIONS:
+                        moves.append(sq | (to << 6) | (piece_type << 12))
+                else:
+                    moves.append(sq | (to << 6))
+            if sq // board_size == home_row:
+                to += step
+                if not occupied >> to & 1 and allowed >> to & 1:
+                    moves.append(sq | (to << 6))
+
+        for to in _bits(PAWN_ATTACKS[direction][sq] & theirs & allowed):
+            if to // board_size == promotion_row:
+                for piece_type in PROMOTIONS:
+                    moves.append(sq | (to << 6) | (piece_type << 12))
+            else:
+                moves.append(sq | (to << 6))
+
+        # en passant is rare enough to just try it: taking the pawn can uncover a check
+        # along the row, which the pin test above can't see.
+        if ep_square is not None and PAWN_ATTACKS[direction][sq] >> ep_square & 1:
+            move = encode_move(sq, ep_square)
+            position.make_move(move)
+            if not in_check(position, us):
+                moves.append(move)
+            position.unmake_move()
+
+    return moves
+
+# legal move lists (and anything else worth keeping per position) by Zobrist hash
+transposition_table = TranspositionTable()
+
+# legal_moves for the side to move, reused whenever the same position comes up again
+def cached_legal_moves(position: Position) -> list[int]:
+    entry = transposition_table.probe(position.zobrist)
+    if entry is not None and entry.moves is not None:
+        return entry.moves
+    moves = legal_moves(position)
+    transposition_table.store_moves(position.zobrist, moves)
+    return moves
+
+# the legal moves of the side to move grouped by the square they start from, so the UI
+# can highlight and check a move with one lookup. promotions to different pieces share
+# a destination, which is listed once.
+move_map_cache = LRUCache(256)
+
+def move_map(position: Position) -> dict[int, list[int]]:
+    key = position.key()
+    moves = move_map_cache.get(key)
+    if moves is None:
+        moves = {}
+        for move in cached_legal_moves(position):
+            targets = moves.setdefault(move & 63, [])
+            to = (move >> 6) & 63
+            if not targets or targets[-1] != to:
+                targets.append(to)
+        move_map_cache.put(key, moves)
+    return moves
+
+class Status:
+    __slots__ = ("in_check", "checkmate", "stalemate")
+
+    def __init__(self, in_check: bool, checkmate: bool, stalemate: bool):
+        self.in_check = in_check
+        self.checkmate = checkmate
+        self.stalemate = stalemate
+
+# check/checkmate/stalemate for each recently seen (position, color), so redraws don't
+# regenerate every move of the side just to color the king's square
+status_cache = LRUCache(4096)
+
+def position_status(position: Position, color: int | None = None) -> Status:
+    color = position.turn if color is None else color
+    key = (position.key(), color)
+    status = status_cache.get(key)
+    if status is None:
+        checked = in_check(position, color)
+        # only the side to move can be mated or stalemated
+        stuck = color == position.turn and len(cached_legal_moves(position)) == 0
+        status = Status(checked, checked and stuck, stuck and not checked)
+        status_cache.put(key, status)
+        if color == position.turn:
+            transposition_table.store_status(position.zobrist, status)
+    return status
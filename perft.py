@@ -0,0 +1,138 @@
+# Perft: count the leaf nodes of the move tree to a fixed depth.
+#
+# The counts for well-known positions are published, so any difference points at a
+# move generation bug, and the time taken is a straightforward speed benchmark.
+#
+#   python3 perft.py --depth 4                      startpos, bitboard generator
+#   python3 perft.py --fen "<fen>" --depth 3 --divide
+#   python3 perft.py --suite --backend pieces       check every reference position
+#
+# The "bitboard" backend uses movegen.legal_moves; "pieces" goes through Piece.valid_moves
+# and its check pruning, i.e. what the board UI uses to highlight moves.
+
+import argparse
+import sys
+import time
+
+from position import Position, encode_move, move_from, move_to, move_promotion, square
+from position import square_name, board_size, PAWN, FEN_PIECES
+from movegen import legal_moves, PROMOTIONS
+from rules import piece_map
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# (name, fen, known node counts for depth 1, 2, ...). from the chessprogramming wiki
+# "Perft Results" page.
+REFERENCE_POSITIONS = [
+    ("startpos", START_FEN, [20, 400, 8902, 197281, 4865609]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     [48, 2039, 97862, 4085603]),
+    ("position3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     [14, 191, 2812, 43238, 674624]),
+    ("position4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     [6, 264, 9467, 422333]),
+    ("position5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     [44, 1486, 62379, 2103487]),
+    ("position6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     [46, 2079, 89890, 3894594]),
+]
+
+def bitboard_moves(position: Position) -> list:
+    return legal_moves(position)
+
+# the same moves, found one Piece at a time the way the UI does it
+def piece_moves(position: Position) -> list:
+    color = position.turn
+    moves = []
+    for (row, col), piece in piece_map(position).items():
+        if piece.color != color:
+            continue
+        from_sq = square(row, col)
+        for (to_row, to_col) in piece.valid_moves(position):
+            to_sq = square(to_row, to_col)
+            if piece.piece_type == PAWN and to_row in (0, board_size - 1):
+                moves.extend(encode_move(from_sq, to_sq, promotion) for promotion in PROMOTIONS)
+            else:
+                moves.append(encode_move(from_sq, to_sq))
+    return moves
+
+BACKENDS = {"bitboard": bitboard_moves, "pieces": piece_moves}
+
+def perft(position: Position, depth: int, generate=bitboard_moves) -> int:
+    moves = generate(position)
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+    nodes = 0
+    for move in moves:
+        position.make_move(move)
+        nodes += perft(position, depth - 1, generate)
+        position.unmake_move()
+    return nodes
+
+# node counts below each root move, for tracking down which move a bug is under
+def divide(position: Position, depth: int, generate=bitboard_moves) -> dict:
+    counts = {}
+    for move in generate(position):
+        position.make_move(move)
+        counts[move_name(move)] = perft(position, depth - 1, generate)
+        position.unmake_move()
+    return counts
+
+# long algebraic name of a move ("e2e4", "e7e8q") as printed by most engines' divide
+def move_name(move: int) -> str:
+    name = square_name(move_from(move)) + square_name(move_to(move))
+    if move_promotion(move):
+        name += FEN_PIECES[move_promotion(move)]
+    return name
+
+def run(name: str, fen: str, depth: int, generate, expected=None) -> bool:
+    position = Position.from_fen(fen)
+    start = time.perf_counter()
+    nodes = perft(position, depth, generate)
+    elapsed = time.perf_counter() - start
+    rate = nodes / elapsed if elapsed > 0 else float("inf")
+    line = "%-10s depth %d  %10d nodes  %7.2fs  %9.0f nodes/s" % (name, depth, nodes, elapsed, rate)
+    ok = expected is None or nodes == expected
+    if expected is not None:
+        line += "  ok" if ok else "  FAIL (expected %d)" % expected
+    print(line)
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Count move tree leaf nodes (perft).")
+    parser.add_argument("--fen", default=START_FEN)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="bitboard")
+    parser.add_argument("--divide", action="store_true", help="show counts per root move")
+    parser.add_argument("--suite", action="store_true",
+                        help="run every reference position and compare with the known counts")
+    parser.add_argument("--max-nodes", type=int, default=100000,
+                        help="in --suite, the deepest depth whose known count is below this")
+    args = parser.parse_args()
+    generate = BACKENDS[args.backend]
+
+    if args.suite:
+        ok = True
+        for name, fen, counts in REFERENCE_POSITIONS:
+            depth = max(d for d, count in enumerate(counts, 1) if d == 1 or count <= args.max_nodes)
+            ok = run(name, fen, depth, generate, counts[depth - 1]) and ok
+        sys.exit(0 if ok else 1)
+
+    if args.divide:
+        position = Position.from_fen(args.fen)
+        counts = divide(position, args.depth, generate)
+        for name in sorted(counts):
+            print("%s: %d" % (name, counts[name]))
+        print()
+        print("moves: %d" % len(counts))
+        print("nodes: %d" % sum(counts.values()))
+        return
+
+    expected = None
+    for name, fen, counts in REFERENCE_POSITIONS:
+        if fen == args.fen and args.depth <= len(counts):
+            expected = counts[args.depth - 1]
+    run("perft", args.fen, args.depth, generate, expected)
+
+if __name__ == "__main__":
+    main()
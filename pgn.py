@@ -0,0 +1,216 @@
+# Standard Algebraic Notation and PGN reading/writing.
+#
+# Moves are the packed ints from position.encode_move. read_games streams games
+# out of any iterable of lines, so huge PGN files never have to be read whole.
+
+from __future__ import annotations
+
+import re
+
+from position import Position, WHITE, PAWN, KING, FEN_PIECES
+from position import square_name, square_from_name, move_from, move_to, move_promotion
+from movegen import legal_moves, in_check
+
+RESULTS = ["*", "1-0", "0-1", "1/2-1/2"]
+
+_SAN = re.compile(r"^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$")
+_TAG = re.compile(r'^\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]\s*$')
+_MOVE_NUMBER = re.compile(r"^\d+\.+$")
+
+# SAN of a legal move in the position, e.g. "Nbd7", "exd6", "e8=Q+", "O-O-O#"
+def move_to_san(position: Position, move: int) -> str:
+    from_sq, to_sq, promotion = move_from(move), move_to(move), move_promotion(move)
+    color, piece_type = position.piece_at(from_sq)
+
+    if piece_type == KING and abs(to_sq - from_sq) == 2:
+        san = "O-O" if to_sq > from_sq else "O-O-O"
+    else:
+        capture = position.piece_at(to_sq) is not None or \
+                  (piece_type == PAWN and to_sq == position.ep_square)
+        if piece_type == PAWN:
+            san = square_name(from_sq)[0] + "x" if capture else ""
+        else:
+            san = FEN_PIECES[piece_type].upper()
+            # other pieces of the same kind that could go to the same square
+            rivals = [other for other in legal_moves(position)
+                      if move_to(other) == to_sq and move_from(other) != from_sq and
+                      position.piece_at(move_from(other)) == (color, piece_type)]
+            if rivals:
+                name = square_name(from_sq)
+                if all(square_name(move_from(other))[0] != name[0] for other in rivals):
+                    san += name[0]
+                elif all(square_name(move_from(other))[1] != name[1] for other in rivals):
+                    san += name[1]
+                else:
+                    san += name
+            if capture:
+                san += "x"
+        san += square_name(to_sq)
+        if promotion:
+            san += "=" + FEN_PIECES[promotion].upper()
+
+    position.make_move(move)
+    if in_check(position, position.turn):
+        san += "#" if not legal_moves(position) else "+"
+    position.unmake_move()
+    return san
+
+# the legal move a SAN string stands for; raises ValueError if there isn't exactly one
+def san_to_move(position: Position, san: str) -> int:
+    text = san.rstrip("+#!?")
+    moves = legal_moves(position)
+    if text in ("O-O", "0-0", "O-O-O", "0-0-0"):
+        long = len(text) > 3
+        for move in moves:
+            from_sq, to_sq = move_from(move), move_to(move)
+            if position.piece_at(from_sq)[1] == KING and abs(to_sq - from_sq) == 2 and \
+               (to_sq < from_sq) == long:
+                return move
+        raise ValueError("illegal castling " + repr(san))
+
+    match = _SAN.match(text)
+    if not match:
+        raise ValueError("bad SAN move " + repr(san))
+    piece, from_file, from_rank, to_name, promotion = match.groups()
+    piece_type = FEN_PIECES.index(piece.lower()) if piece else PAWN
+    to_sq = square_from_name(to_name)
+    promotion = FEN_PIECES.index(promotion.lower()) if promotion else 0
+
+    found = []
+    for move in moves:
+        from_sq = move_from(move)
+        if move_to(move) != to_sq or move_promotion(move) != promotion or \
+           position.piece_at(from_sq)[1] != piece_type:
+            continue
+        name = square_name(from_sq)
+        if (from_file and name[0] != from_file) or (from_rank and name[1] != from_rank):
+            continue
+        found.append(move)
+    if len(found) != 1:
+        raise ValueError("%s move %r in %s" % ("ambiguous" if found else "illegal", san, position.to_fen()))
+    return found[0]
+
+# Streams (tags, san_moves, result) for every game in the lines of a PGN file.
+# Comments, variations and numeric annotation glyphs are skipped.
+def read_games(lines):
+    tags = {}
+    tokens = []
+    depth = 0
+    in_comment = False
+    for line in lines:
+        line = line.strip()
+        if not in_comment and depth == 0 and line.startswith("["):
+            if tokens:
+                # a game without a result marker at the end
+                yield tags, tokens, tags.get("Result", "*")
+                tags, tokens = {}, []
+            match = _TAG.match(line)
+            if match:
+                tags[match.group(1)] = match.group(2).replace('\\"', '"').replace("\\\\", "\\")
+            continue
+        if line.startswith("%"):
+            continue
+
+        position = 0
+        while position < len(line):
+            if in_comment:
+                end = line.find("}", position)
+                if end < 0:
+                    break
+                in_comment = False
+                position = end + 1
+                continue
+            char = line[position]
+            if char == "{":
+                in_comment = True
+                position += 1
+                continue
+            if char == ";":
+                break
+            if char == "(":
+                depth += 1
+                position += 1
+                continue
+            if char == ")":
+                depth = max(0, depth - 1)
+                position += 1
+                continue
+            if char.isspace():
+                position += 1
+                continue
+            end = position
+            while end < len(line) and not line[end].isspace() and line[end] not in "{}();":
+                end += 1
+            token = line[position:end]
+            position = end
+            if depth:
+                continue
+            if token in RESULTS:
+                yield tags, tokens, token
+                tags, tokens = {}, []
+                continue
+            if token.startswith("$") or _MOVE_NUMBER.match(token):
+                continue
+            # "12.e4" and "12...e5" glue the move number to the move
+            token = token.rsplit(".", 1)[-1]
+            if token:
+                tokens.append(token)
+    if tokens or tags:
+        yield tags, tokens, tags.get("Result", "*")
+
+# the starting position of a game with these tags
+def start_position(tags: dict) -> Position:
+    if "FEN" in tags:
+        return Position.from_fen(tags["FEN"])
+    from rules import new_position
+    return new_position()
+
+# the moves of a game read by read_games, as packed ints
+def parse_moves(tags: dict, san_moves: list[str]) -> list[int]:
+    position = start_position(tags)
+    moves = []
+    for san in san_moves:
+        move = san_to_move(position, san)
+        position.make_move(move)
+        moves.append(move)
+    return moves
+
+# PGN text for one game. the Seven Tag Roster comes first, in its usual order.
+def write_game(tags: dict, moves: list[int], result: str = "*", start: Position | None = None) -> str:
+    if start is None:
+        start = start_position(tags)
+    position = start.copy()
+
+    roster = ["Event", "Site", "Date", "Round", "White", "Black", "Result"]
+    defaults = {"Event": "?", "Site": "?", "Date": "????.??.??", "Round": "?",
+                "White": "?", "Black": "?"}
+    tags = dict(tags)
+    tags["Result"] = result
+    if start.to_fen() != start_position({}).to_fen():
+        tags["SetUp"] = "1"
+        tags["FEN"] = start.to_fen()
+    lines = []
+    for key in roster + sorted(key for key in tags if key not in roster):
+        value = tags.get(key, defaults.get(key, "?"))
+        lines.append('[%s "%s"]' % (key, value.replace("\\", "\\\\").replace('"', '\\"')))
+    lines.append("")
+
+    words = []
+    for index, move in enumerate(moves):
+        if position.turn == WHITE:
+            words.append("%d." % position.fullmove_number)
+        elif index == 0:
+            words.append("%d..." % position.fullmove_number)
+        words.append(move_to_san(position, move))
+        position.make_move(move)
+    words.append(result)
+
+    line = ""
+    for word in words:
+        if line and len(line) + 1 + len(word) > 79:
+            lines.append(line)
+            line = word
+        else:
+            line = line + " " + word if line else word
+    lines.append(line)
+    return "\n".join(lines) + "\n\n"
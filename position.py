@@ -0,0 +1,513 @@
+# Bitboard-backed chess position.
+#
+# Squares are numbered row * 8 + col with white at the bottom: row 0 is the eighth rank
+# and col 0 the a file, so square 0 is a8. Every client, the server and the tools all
+# use this one orientation; a board shown the other way up only changes how squares
+# are drawn (see main.py), never the position itself. Every piece type of every color
+# gets its own 64-bit integer, with bit n set when square n holds such a piece.
+
+from __future__ import annotations
+
+import struct
+
+board_size = 8
+
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+
+COLOR_NAMES = ["white", "black"]
+PIECE_NAMES = ["pawn", "knight", "bishop", "rook", "queen", "king"]
+
+def square(row: int, col: int) -> int:
+    return row * board_size + col
+
+# layout of Position.pack()
+_PACKED = struct.Struct(">12QQBBHH")
+
+FEN_PIECES = "pnbrqk"
+# castling letter -> (color, column of the rook)
+FEN_CASTLING = {"K": (WHITE, 7), "Q": (WHITE, 0), "k": (BLACK, 7), "q": (BLACK, 0)}
+
+# algebraic name ("e4") of a square with white at the bottom, and back
+def square_name(sq: int) -> str:
+    row, col = divmod(sq, board_size)
+    return "abcdefgh"[col] + str(board_size - row)
+
+def square_from_name(name: str) -> int:
+    if len(name) != 2 or name[0] not in "abcdefgh" or name[1] not in "12345678":
+        raise ValueError("bad square " + repr(name))
+    return square(board_size - int(name[1]), "abcdefgh".index(name[0]))
+
+# bit for the square at (row, col), or 0 if it is off the board so that callers can
+# test squares without bounds checking first.
+def square_bit(row: int, col: int) -> int:
+    if 0 <= row < board_size and 0 <= col < board_size:
+        return 1 << (row * board_size + col)
+    return 0
+
+def lowest_square(bb: int) -> int:
+    return (bb & -bb).bit_length() - 1
+
+# moves are packed into an int: the from square in the low 6 bits, the to square in the
+# next 6 and the piece type a pawn promotes to (0 for none) above that. castling is the
+# king moving two squares towards the rook.
+def encode_move(from_sq: int, to_sq: int, promotion: int = 0) -> int:
+    return from_sq | (to_sq << 6) | (promotion << 12)
+
+def move_from(move: int) -> int:
+    return move & 63
+
+def move_to(move: int) -> int:
+    return (move >> 6) & 63
+
+def move_promotion(move: int) -> int:
+    return move >> 12
+
+# random keys for Zobrist hashing: a position's hash is the xor of the keys of every
+# piece on its square, the unmoved king/rook squares, the en passant square (when a pawn
+# can take there) and the side to move. the keys come from a fixed-seed splitmix64
+# sequence so every process agrees on hashes (and importing this module doesn't pull
+# in `random`).
+def _splitmix64(count: int, seed: int = 0x5EED) -> list[int]:
+    mask = (1 << 64) - 1
+    keys = []
+    for _ in range(count):
+        seed = (seed + 0x9E3779B97F4A7C15) & mask
+        z = seed
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & mask
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & mask
+        keys.append(z ^ (z >> 31))
+    return keys
+
+_zobrist_keys = _splitmix64(2 * 6 * 64 + 64 + 64 + 1)
+ZOBRIST_PIECES = [[_zobrist_keys[(color * 6 + piece_type) * 64:(color * 6 + piece_type + 1) * 64]
+                   for piece_type in range(6)] for color in range(2)]
+ZOBRIST_UNMOVED = _zobrist_keys[768:832]
+ZOBRIST_EP = _zobrist_keys[832:896]
+ZOBRIST_BLACK_TO_MOVE = _zobrist_keys[896]
+
+def _unmoved_hash(unmoved: int) -> int:
+    h = 0
+    while unmoved:
+        low = unmoved & -unmoved
+        h ^= ZOBRIST_UNMOVED[low.bit_length() - 1]
+        unmoved ^= low
+    return h
+
+class Position:
+    def __init__(self):
+        # boards[color][piece_type] is the bitboard for that piece
+        self.boards = [[0] * 6, [0] * 6]
+        self.occupied = [0, 0]
+        self.turn = WHITE
+        # squares of kings and rooks that haven't moved yet (for castling)
+        self.unmoved = 0
+        # square a pawn skipped over with its double step, if it can be taken en passant
+        self.ep_square: int | None = None
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+        self.king_squares = [-1, -1]
+        # undo records for every move made, so they can be taken back with unmake_move
+        self.history = []
+        # Zobrist hash of the position, kept up to date as pieces move
+        self.zobrist = 0
+        # how many times each hash has come up in this game, for repetition draws
+        self.repetitions: dict[int, int] = {}
+
+    @classmethod
+    def from_piece_map(cls, piece_map, turn: int = WHITE) -> "Position":
+        # build a position from a dict of (row, col) -> Piece, the layout main.py uses
+        position = cls()
+        position.turn = turn
+        for (row, col), piece in piece_map.items():
+            color, piece_type = piece.color, piece.piece_type
+            position.add_piece(color, piece_type, square(row, col))
+            if piece_type in (KING, ROOK) and piece.first_move:
+                position.unmoved |= square_bit(row, col)
+            if piece_type == PAWN and piece.en_passant:
+                position.ep_square = square(row, col) - position.pawn_step(color)
+        position.unmoved = position._castling_squares(position.unmoved)
+        position.reset_hash()
+        return position
+
+    # set up a position from Forsyth-Edwards Notation. white is at the bottom, so rank 8
+    # is row 0 and the a file is col 0.
+    @classmethod
+    def from_fen(cls, fen: str) -> "Position":
+        fields = fen.split()
+        if len(fields) < 4:
+            raise ValueError("FEN needs at least 4 fields: " + fen)
+        placement, turn, castling, ep = fields[:4]
+
+        position = cls()
+        rows = placement.split("/")
+        if len(rows) != board_size:
+            raise ValueError("FEN needs 8 ranks: " + fen)
+        for row, text in enumerate(rows):
+            col = 0
+            for char in text:
+                if char.isdigit():
+                    col += int(char)
+                    continue
+                piece_type = FEN_PIECES.find(char.lower())
+                if piece_type < 0 or col >= board_size:
+                    raise ValueError("bad FEN rank " + repr(text))
+                color = WHITE if char.isupper() else BLACK
+                position.add_piece(color, piece_type, square(row, col))
+                col += 1
+            if col != board_size:
+                raise ValueError("bad FEN rank " + repr(text))
+        if any(position.boards[color][KING].bit_count() != 1 for color in (WHITE, BLACK)):
+            raise ValueError("FEN needs exactly one king per side: " + fen)
+
+        if turn not in ("w", "b"):
+            raise ValueError("bad side to move " + repr(turn))
+        position.turn = WHITE if turn == "w" else BLACK
+
+        for char in castling.replace("-", ""):
+            if char not in FEN_CASTLING:
+                raise ValueError("bad castling rights " + repr(castling))
+            color, rook_col = FEN_CASTLING[char]
+            row = board_size - 1 if color == WHITE else 0
+            king_sq, rook_sq = square(row, 4), square(row, rook_col)
+            if position.boards[color][KING] >> king_sq & 1 and \
+               position.boards[color][ROOK] >> rook_sq & 1:
+                position.unmoved |= (1 << king_sq) | (1 << rook_sq)
+
+        if ep != "-":
+            position.ep_square = square_from_name(ep)
+
+        if len(fields) > 4:
+            position.halfmove_clock = int(fields[4])
+        if len(fields) > 5:
+            position.fullmove_number = int(fields[5])
+
+        position._check_legal(fen)
+        position.reset_hash()
+        return position
+
+    # refuse positions the move generator can't make sense of, so a bad FEN fails here
+    # with a ValueError rather than somewhere inside legal_moves
+    def _check_legal(self, fen: str):
+        from movegen import in_check
+
+        last_rows = (0xFF << (board_size - 1) * board_size) | 0xFF
+        if (self.boards[WHITE][PAWN] | self.boards[BLACK][PAWN]) & last_rows:
+            raise ValueError("FEN has a pawn on the first or last rank: " + fen)
+        white_king, black_king = self.king_squares
+        if max(abs(white_king // board_size - black_king // board_size),
+               abs(white_king % board_size - black_king % board_size)) <= 1:
+            raise ValueError("FEN has the kings next to each other: " + fen)
+        if in_check(self, 1 - self.turn):
+            raise ValueError("FEN has the side not to move in check: " + fen)
+        if self.ep_square is not None:
+            # the square a pawn of the side that just moved skipped over, with the pawn past it
+            mover = 1 - self.turn
+            skipped_row = self.pawn_home_row(mover) + self.pawn_step(mover) // board_size
+            pawn = self.ep_pawn_square()
+            if self.ep_square // board_size != skipped_row or \
+               self.all_occupied() >> self.ep_square & 1 or \
+               not self.boards[mover][PAWN] >> pawn & 1:
+                raise ValueError("bad en passant square " + repr(square_name(self.ep_square)))
+        if self.halfmove_clock < 0 or self.fullmove_number < 1:
+            raise ValueError("FEN has a negative move counter: " + fen)
+
+    # Forsyth-Edwards Notation for the position
+    def to_fen(self) -> str:
+        rows = []
+        for row in range(board_size):
+            text = ""
+            empty = 0
+            for col in range(board_size):
+                piece = self.piece_at(square(row, col))
+                if piece is None:
+                    empty += 1
+                    continue
+                if empty:
+                    text += str(empty)
+                    empty = 0
+                color, piece_type = piece
+                text += FEN_PIECES[piece_type].upper() if color == WHITE else FEN_PIECES[piece_type]
+            if empty:
+                text += str(empty)
+            rows.append(text)
+
+        castling = ""
+        for char, (color, rook_col) in FEN_CASTLING.items():
+            row = board_size - 1 if color == WHITE else 0
+            king_sq, rook_sq = square(row, 4), square(row, rook_col)
+            if self.unmoved >> king_sq & 1 and self.unmoved >> rook_sq & 1 and \
+               self.boards[color][KING] >> king_sq & 1 and self.boards[color][ROOK] >> rook_sq & 1:
+                castling += char
+
+        ep = "-" if self.ep_square is None else square_name(self.ep_square)
+        return " ".join(["/".join(rows), "w" if self.turn == WHITE else "b", castling or "-", ep,
+                         str(self.halfmove_clock), str(self.fullmove_number)])
+
+    # compact binary form of the position (no history): the twelve bitboards, unmoved
+    # squares, en passant square, side to move and clocks in 110 bytes.
+    def pack(self) -> bytes:
+        flags = self.turn
+        ep = 255 if self.ep_square is None else self.ep_square
+        return _PACKED.pack(*self.boards[WHITE], *self.boards[BLACK], self.unmoved, ep, flags,
+                            self.halfmove_clock, self.fullmove_number)
+
+    @classmethod
+    def unpack(cls, data: bytes) -> "Position":
+        if len(data) != _PACKED.size:
+            raise ValueError("packed position must be %d bytes" % _PACKED.size)
+        fields = _PACKED.unpack(data)
+        seen = 0
+        for bb in fields[:12]:
+            if bb & seen:
+                raise ValueError("packed position has two pieces on one square")
+            seen |= bb
+        if any(fields[color * 6 + KING].bit_count() != 1 for color in (WHITE, BLACK)):
+            raise ValueError("packed position needs exactly one king per side")
+        if fields[13] != 255 and fields[13] >= 64:
+            raise ValueError("bad en passant square in packed position")
+
+        position = cls()
+        for color in (WHITE, BLACK):
+            for piece_type in range(6):
+                bb = fields[color * 6 + piece_type]
+                while bb:
+                    sq = lowest_square(bb)
+                    position.add_piece(color, piece_type, sq)
+                    bb &= bb - 1
+        position.unmoved, ep, flags, position.halfmove_clock, position.fullmove_number = fields[12:]
+        position.ep_square = None if ep == 255 else ep
+        position.turn = flags & 1
+        position.unmoved = position._castling_squares(position.unmoved)
+        position.reset_hash()
+        return position
+
+    def copy(self) -> "Position":
+        other = Position.__new__(Position)
+        other.boards = [self.boards[WHITE][:], self.boards[BLACK][:]]
+        other.occupied = self.occupied[:]
+        other.turn = self.turn
+        other.unmoved = self.unmoved
+        other.ep_square = self.ep_square
+        other.halfmove_clock = self.halfmove_clock
+        other.fullmove_number = self.fullmove_number
+        other.king_squares = self.king_squares[:]
+        other.history = self.history[:]
+        other.zobrist = self.zobrist
+        other.repetitions = dict(self.repetitions)
+        return other
+
+    # hash of everything that decides what can happen next. two positions with the same
+    # key have the same legal moves and the same check status.
+    def key(self) -> int:
+        return self.zobrist
+
+    # recompute the hash from scratch and start counting repetitions again from here.
+    # only needed after setting up a position; moves update it incrementally.
+    def reset_hash(self):
+        h = _unmoved_hash(self.unmoved)
+        for color in (WHITE, BLACK):
+            for piece_type in range(6):
+                bb = self.boards[color][piece_type]
+                while bb:
+                    low = bb & -bb
+                    h ^= ZOBRIST_PIECES[color][piece_type][low.bit_length() - 1]
+                    bb ^= low
+        h ^= self._ep_key()
+        if self.turn == BLACK:
+            h ^= ZOBRIST_BLACK_TO_MOVE
+        self.zobrist = h
+        self.repetitions = {h: 1}
+
+    # the en passant square only counts towards the hash when a pawn of the side to move
+    # stands next to the pawn that can be taken. a double step nobody can capture then
+    # hashes the same as any other way of reaching the position, as FIDE counts it.
+    def _ep_key(self) -> int:
+        ep = self.ep_square
+        if ep is None:
+            return 0
+        pawn = ep + self.pawn_step(1 - self.turn)
+        col = pawn % board_size
+        beside = (1 << pawn - 1 if col else 0) | (1 << pawn + 1 if col < board_size - 1 else 0)
+        return ZOBRIST_EP[ep] if self.boards[self.turn][PAWN] & beside else 0
+
+    # the unmoved squares that still matter for castling: a king's only while one of its
+    # rooks is unmoved too, and a rook's only while its king is. dropping the rest keeps
+    # positions with the same castling rights hashing the same.
+    def _castling_squares(self, unmoved: int) -> int:
+        for color in (WHITE, BLACK):
+            boards = self.boards[color]
+            if not boards[KING] & unmoved or not boards[ROOK] & unmoved:
+                unmoved &= ~(boards[KING] | boards[ROOK])
+        return unmoved
+
+    def add_piece(self, color: int, piece_type: int, sq: int):
+        bit = 1 << sq
+        self.boards[color][piece_type] |= bit
+        self.occupied[color] |= bit
+        self.zobrist ^= ZOBRIST_PIECES[color][piece_type][sq]
+        if piece_type == KING:
+            self.king_squares[color] = sq
+
+    # remove whatever is on the square and return it as (color, piece_type)
+    def remove_piece(self, sq: int) -> tuple[int, int] | None:
+        found = self.piece_at(sq)
+        if found:
+            color, piece_type = found
+            bit = 1 << sq
+            self.boards[color][piece_type] &= ~bit
+            self.occupied[color] &= ~bit
+            self.zobrist ^= ZOBRIST_PIECES[color][piece_type][sq]
+        return found
+
+    def piece_at(self, sq: int) -> tuple[int, int] | None:
+        bit = 1 << sq
+        for color in (WHITE, BLACK):
+            if self.occupied[color] & bit:
+                boards = self.boards[color]
+                for piece_type in range(6):
+                    if boards[piece_type] & bit:
+                        return color, piece_type
+        return None
+
+    def color_at(self, row: int, col: int) -> int | None:
+        bit = square_bit(row, col)
+        if self.occupied[WHITE] & bit:
+            return WHITE
+        if self.occupied[BLACK] & bit:
+            return BLACK
+        return None
+
+    def all_occupied(self) -> int:
+        return self.occupied[WHITE] | self.occupied[BLACK]
+
+    def king_square(self, color: int) -> int:
+        return self.king_squares[color]
+
+    # how the square index changes when a pawn of this color steps forward: white pawns
+    # move towards row 0, black pawns towards row 7
+    @staticmethod
+    def pawn_step(color: int) -> int:
+        return -board_size if color == WHITE else board_size
+
+    @staticmethod
+    def pawn_home_row(color: int) -> int:
+        return board_size - 2 if color == WHITE else 1
+
+    # square of the pawn that can currently be captured en passant
+    def ep_pawn_square(self) -> int | None:
+        if self.ep_square is None:
+            return None
+        # the pawn belongs to the side that just moved, and stepped past ep_square
+        return self.ep_square + self.pawn_step(1 - self.turn)
+
+    # make a move, handling captures (including en passant) and updating the turn,
+    # castling, en passant, clock and hash state. everything needed to take the move
+    # back is pushed onto the history stack, so legality can be tested without copying.
+    def make_move(self, move: int):
+        from_sq, to_sq = move_from(move), move_to(move)
+        old_hash = self.zobrist
+        ep_key = self._ep_key()
+        color, piece_type = self.remove_piece(from_sq)
+
+        captured_sq = to_sq
+        if piece_type == PAWN and to_sq == self.ep_square:
+            captured_sq = self.ep_pawn_square()
+        captured = self.remove_piece(captured_sq)
+
+        self.history.append((move, color, piece_type, captured, captured_sq,
+                             self.ep_square, self.unmoved, self.halfmove_clock, old_hash))
+
+        promotion = move >> 12
+        self.add_piece(color, promotion or piece_type, to_sq)
+
+        moved = (1 << from_sq) | (1 << to_sq)
+        if piece_type == KING and abs(to_sq - from_sq) == 2:
+            # castling, bring the rook over to the other side of the king
+            rook_from, rook_to = self.castling_rook_squares(from_sq, to_sq)
+            self.remove_piece(rook_from)
+            self.add_piece(color, ROOK, rook_to)
+            moved |= 1 << rook_from
+
+        unmoved = self.unmoved & ~moved
+        if unmoved != self.unmoved:
+            # a king that moves (or castles) takes its rooks' rights with it
+            unmoved = self._castling_squares(unmoved)
+            self.zobrist ^= _unmoved_hash(unmoved ^ self.unmoved)
+            self.unmoved = unmoved
+
+        self.zobrist ^= ep_key
+        if piece_type == PAWN and abs(to_sq - from_sq) == 2 * board_size:
+            self.ep_square = (from_sq + to_sq) // 2
+        else:
+            self.ep_square = None
+
+        if piece_type == PAWN or captured:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if color == BLACK:
+            self.fullmove_number += 1
+        if color != self.turn:
+            self.zobrist ^= ZOBRIST_BLACK_TO_MOVE
+        self.turn = 1 - color
+        self.zobrist ^= ZOBRIST_BLACK_TO_MOVE
+        self.zobrist ^= self._ep_key()
+
+        self.repetitions[self.zobrist] = self.repetitions.get(self.zobrist, 0) + 1
+
+    # take back the last move made with make_move
+    def unmake_move(self):
+        move, color, piece_type, captured, captured_sq, ep_square, unmoved, halfmove_clock, \
+            old_hash = self.history.pop()
+
+        count = self.repetitions[self.zobrist] - 1
+        if count:
+            self.repetitions[self.zobrist] = count
+        else:
+            del self.repetitions[self.zobrist]
+
+        from_sq, to_sq = move_from(move), move_to(move)
+        self.remove_piece(to_sq)
+        self.add_piece(color, piece_type, from_sq)
+        if piece_type == KING and abs(to_sq - from_sq) == 2:
+            rook_from, rook_to = self.castling_rook_squares(from_sq, to_sq)
+            self.remove_piece(rook_to)
+            self.add_piece(color, ROOK, rook_from)
+        if captured:
+            self.add_piece(captured[0], captured[1], captured_sq)
+
+        self.ep_square = ep_square
+        self.unmoved = unmoved
+        self.halfmove_clock = halfmove_clock
+        if color == BLACK:
+            self.fullmove_number -= 1
+        self.turn = color
+        self.zobrist = old_hash
+
+    # where the rook starts and ends up when the king castles from from_sq to to_sq
+    def castling_rook_squares(self, from_sq: int, to_sq: int) -> tuple[int, int]:
+        row_start = from_sq - from_sq % board_size
+        if to_sq > from_sq:
+            return row_start + board_size - 1, to_sq - 1
+        return row_start, to_sq + 1
+
+    # the current position has come up at least three times this game
+    def is_threefold_repetition(self) -> bool:
+        return self.repetitions.get(self.zobrist, 0) >= 3
+
+    # fifty moves by each side without a capture or a pawn move
+    def is_fifty_move_draw(self) -> bool:
+        return self.halfmove_clock >= 100
+
+    # dict of (row, col) -> (color, piece_type) for every occupied square
+    def piece_squares(self) -> dict[tuple[int, int], tuple[int, int]]:
+        squares = {}
+        for color in (WHITE, BLACK):
+            for piece_type in range(6):
+                bb = self.boards[color][piece_type]
+                while bb:
+                    sq = lowest_square(bb)
+                    bb &= bb - 1
+                    squares[divmod(sq, board_size)] = (color, piece_type)
+        return squares
@@ -0,0 +1,190 @@
+# Wire protocol between clients (and the server).
+#
+# Everything on the wire is a frame: a 2-byte big-endian length of what follows, a
+# 1-byte message type and the payload. Each side opens with a HELLO frame carrying the
+# protocol version, and frames may arrive split across reads or several to a read, so
+# the receiving side runs everything through a FrameBuffer. After the HELLO a client
+# says what it came for: JOIN to play or WATCH to spectate. A relay server acts on
+# neither until one arrives; another client just ignores the JOIN.
+#
+# Squares on the wire are numbered as in position.py, with white at the bottom (square 0
+# is a8), the same as every board is stored. Moves use the same 16-bit packing as
+# position.encode_move, so promotions and castling come along free.
+
+import struct
+
+from position import Position
+
+PROTOCOL_VERSION = 3
+MAGIC = b"CHS"
+
+# message types
+HELLO = 1      # MAGIC + version byte
+START = 2      # color byte (0 white, 1 black) the receiver plays
+MOVES = 3      # one or more 16-bit moves, in the order they were played
+CLOCK = 4      # white's and black's remaining time in milliseconds, 32 bits each
+POSITION = 5   # Position.pack() snapshot, to (re)synchronise a board
+RESYNC = 6     # no payload, asks the other side for a POSITION
+ERROR = 7      # utf-8 text explaining why a message was refused
+WATCH = 8      # 32-bit game id to spectate (0 for the newest game), sent after HELLO
+JOIN = 9       # no payload, asks to be paired with an opponent, sent after HELLO
+PING = 10      # 64-bit value for the other side to send straight back in a PONG
+PONG = 11      # the payload of the PING it answers
+
+MESSAGE_NAMES = {HELLO: "HELLO", START: "START", MOVES: "MOVES", CLOCK: "CLOCK",
+                 POSITION: "POSITION", RESYNC: "RESYNC", ERROR: "ERROR", WATCH: "WATCH",
+                 JOIN: "JOIN", PING: "PING", PONG: "PONG"}
+
+MAX_PAYLOAD = 0xFFFF - 1
+
+_HEADER = struct.Struct(">HB")
+_CLOCK = struct.Struct(">II")
+_WATCH = struct.Struct(">I")
+_PING = struct.Struct(">Q")
+
+class ProtocolError(Exception):
+    pass
+
+def encode_frame(kind: int, payload: bytes = b"") -> bytes:
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError("payload too large: %d bytes" % len(payload))
+    return _HEADER.pack(len(payload) + 1, kind) + payload
+
+def encode_hello() -> bytes:
+    return encode_frame(HELLO, MAGIC + bytes([PROTOCOL_VERSION]))
+
+def encode_start(color: int) -> bytes:
+    return encode_frame(START, bytes([color]))
+
+def encode_moves(moves) -> bytes:
+    return encode_frame(MOVES, struct.pack(">%dH" % len(moves), *moves))
+
+def encode_clock(white_ms: int, black_ms: int) -> bytes:
+    return encode_frame(CLOCK, _CLOCK.pack(white_ms, black_ms))
+
+def encode_position(position: Position) -> bytes:
+    return encode_frame(POSITION, position.pack())
+
+def encode_resync() -> bytes:
+    return encode_frame(RESYNC)
+
+def encode_error(text: str) -> bytes:
+    return encode_frame(ERROR, text.encode("utf-8")[:MAX_PAYLOAD])
+
+def encode_watch(game_id: int = 0) -> bytes:
+    return encode_frame(WATCH, _WATCH.pack(game_id))
+
+def encode_join() -> bytes:
+    return encode_frame(JOIN)
+
+def encode_ping(value: int) -> bytes:
+    return encode_frame(PING, _PING.pack(value))
+
+def encode_pong(payload: bytes) -> bytes:
+    return encode_frame(PONG, payload)
+
+def decode_hello(payload: bytes) -> int:
+    if len(payload) != len(MAGIC) + 1 or not payload.startswith(MAGIC):
+        raise ProtocolError("not a chess connection")
+    return payload[-1]
+
+def decode_start(payload: bytes) -> int:
+    if len(payload) != 1 or payload[0] > 1:
+        raise ProtocolError("bad START payload")
+    return payload[0]
+
+def decode_moves(payload: bytes) -> list:
+    if not payload or len(payload) % 2:
+        raise ProtocolError("bad MOVES payload")
+    return list(struct.unpack(">%dH" % (len(payload) // 2), payload))
+
+def decode_clock(payload: bytes) -> tuple:
+    if len(payload) != _CLOCK.size:
+        raise ProtocolError("bad CLOCK payload")
+    return _CLOCK.unpack(payload)
+
+def decode_position(payload: bytes) -> Position:
+    try:
+        return Position.unpack(payload)
+    except ValueError as error:
+        raise ProtocolError(str(error))
+
+def decode_error(payload: bytes) -> str:
+    return payload.decode("utf-8", "replace")
+
+def decode_watch(payload: bytes) -> int:
+    if len(payload) != _WATCH.size:
+        raise ProtocolError("bad WATCH payload")
+    return _WATCH.unpack(payload)[0]
+
+# the value of a PING, or of the PONG answering it
+def decode_ping(payload: bytes) -> int:
+    if len(payload) != _PING.size:
+        raise ProtocolError("bad PING payload")
+    return _PING.unpack(payload)[0]
+
+# Collects bytes as they are read off a socket and hands back every complete frame.
+# The first frame must be a HELLO with our version.
+class FrameBuffer:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.greeted = False
+
+    # add newly read bytes and return the complete frames as (type, payload) pairs
+    def feed(self, data: bytes) -> list:
+        self.buffer += data
+        frames = []
+        start = 0
+        buffer = self.buffer
+        while len(buffer) - start >= _HEADER.size:
+            length, kind = _HEADER.unpack_from(buffer, start)
+            if length == 0:
+                raise ProtocolError("empty frame")
+            end = start + 2 + length
+            if end > len(buffer):
+                break
+            payload = bytes(buffer[start + _HEADER.size:end])
+            start = end
+
+            if not self.greeted:
+                if kind != HELLO:
+                    raise ProtocolError("expected HELLO, got type %d" % kind)
+                version = decode_hello(payload)
+                if version != PROTOCOL_VERSION:
+                    raise ProtocolError("protocol version %d, expected %d" % (version, PROTOCOL_VERSION))
+                self.greeted = True
+            elif kind not in MESSAGE_NAMES:
+                raise ProtocolError("unknown message type %d" % kind)
+            frames.append((kind, payload))
+        del buffer[:start]
+        return frames
+
+# Frames waiting to go out. Everything queued before the next flush is written with a
+# single send, so moves played back to back share one packet.
+class Outbox:
+    def __init__(self):
+        self.frames = []
+        self.moves = []
+
+    def queue(self, frame: bytes):
+        self.flush_moves()
+        self.frames.append(frame)
+
+    # consecutive moves are merged into one MOVES frame
+    def queue_move(self, move: int):
+        self.moves.append(move)
+
+    def flush_moves(self):
+        if self.moves:
+            self.frames.append(encode_moves(self.moves))
+            self.moves = []
+
+    def pending(self) -> bool:
+        return bool(self.frames or self.moves)
+
+    # everything queued so far, as one chunk of bytes
+    def take(self) -> bytes:
+        self.flush_moves()
+        data = b"".join(self.frames)
+        self.frames = []
+        return data
@@ -0,0 +1,302 @@
+# Headless rules of the game: the Piece view used by the UI, the starting layout and
+# the check/checkmate tests. Nothing here needs tkinter, so servers, analysis tools and
+# tests can import it without opening a window.
+
+from __future__ import annotations
+
+from position import Position, board_size, square, square_bit, encode_move
+from position import WHITE, BLACK, COLOR_NAMES, PIECE_NAMES
+from position import PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING
+from movegen import attackers_to, position_status
+
+# image/display key of every (color, piece type), e.g. IMAGE_KEYS[WHITE][KING] == "king_white"
+IMAGE_KEYS = [[name + "_" + color for name in PIECE_NAMES] for color in COLOR_NAMES]
+
+# A Piece is a read-only view of one square of a Position (see piece_at below). The
+# position itself only stores bitboards; pieces are created on demand for the UI.
+# piece_type and color are the small ints from position.py (PAWN..KING, WHITE/BLACK),
+# so every test on them is an int comparison, and __slots__ keeps each one small.
+class Piece:
+    __slots__ = ("piece_type", "color", "row", "col", "first_move", "en_passant")
+
+    def __init__(self, piece_type: int, color: int, row: int, col: int):
+        self.piece_type = piece_type
+        self.color = color
+        self.row = row
+        self.col = col
+        self.first_move = True
+        self.en_passant = False
+        assert(color == WHITE or color == BLACK)
+
+    # "king_white" and so on, the key of the piece's image
+    @property
+    def name(self) -> str:
+        return IMAGE_KEYS[self.color][self.piece_type]
+
+    # return all valid moves for this piece
+    def valid_moves(self, position: Position) -> list[tuple[int, int]]:
+        piece_type = self.piece_type
+        if piece_type == PAWN:
+            moves = self.pawn_moves(position)
+        elif piece_type == KNIGHT:
+            moves = self.knight_moves(position)
+        elif piece_type == BISHOP:
+            moves = self.bishop_moves(position)
+        elif piece_type == ROOK:
+            moves = self.rook_moves(position)
+        elif piece_type == QUEEN:
+            moves = self.rook_moves(position) + self.bishop_moves(position)
+        else:
+            moves = self.king_moves(position)
+
+        moves = self.prune_check_moves(moves, position)
+        return moves
+
+    # prune any moves that would result in a check so that we don't display them when trying
+    # to make a move.
+    # 
+    # unfortunately, there's no better way to do this than brute forcing all next positions and
+    # seeing if they would result in a check. but since the upper bound of moves is low, this 
+    # isn't a huge deal. each move is made and then taken back on the position itself, so
+    # nothing gets copied.
+    def prune_check_moves(self, moves: list[tuple[int, int]], position: Position) -> list[tuple[int, int]]:
+        final_moves = []
+
+        color = self.color
+        from_sq = square(self.row, self.col)
+
+        for (row, col) in moves:
+            # skip anything off the edge of the board
+            if not square_bit(row, col):
+                continue
+
+            position.make_move(encode_move(from_sq, square(row, col)))
+
+            king_row, king_col = divmod(position.king_square(color), board_size)
+
+            if not is_in_mate(king_row, king_col, position):
+                final_moves.append((row, col))
+
+            position.unmake_move()
+
+        return final_moves
+    
+    # all the proceeding code "X"_moves is just for getting the valid moves of the 
+    # given piece type "X"
+    def rook_moves(self, position: Position) -> list[tuple[int, int]]:
+        moves = []
+        dxs_dys = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+        own, theirs = self.occupancy(position)
+
+        for (dx, dy) in dxs_dys:
+            row, col = self.row, self.col
+            while 0 <= row + dx < board_size and 0 <= col + dy < board_size:
+                row += dx
+                col += dy
+                bit = square_bit(row, col)
+                if bit & own:
+                    break
+                moves.append((row, col))
+                if bit & theirs:
+                    break
+
+        return moves
+
+    def knight_moves(self, position: Position) -> list[tuple[int, int]]:
+        moves = []
+
+        offsets = [
+            (-2, -1), (-1, -2), (1, -2), (2, -1),
+            (2, 1), (1, 2), (-1, 2), (-2, 1)
+        ]
+
+        own, _ = self.occupancy(position)
+
+        for (dx, dy) in offsets:
+            new_row, new_col = self.row + dx, self.col + dy
+
+            if 0 <= new_row < board_size and 0 <= new_col < board_size:
+                if not square_bit(new_row, new_col) & own:
+                    moves.append((new_row, new_col))
+
+        return moves
+
+    def bishop_moves(self, position: Position) -> list[tuple[int, int]]:
+        moves = []
+
+        dxs_dys = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+        own, theirs = self.occupancy(position)
+
+        for (dx, dy) in dxs_dys:
+            row, col = self.row, self.col
+            while 0 <= row + dx < board_size and 0 <= col + dy < board_size:
+                row += dx
+                col += dy
+                bit = square_bit(row, col)
+                if bit & own:
+                    break
+                moves.append((row, col))
+                if bit & theirs:
+                    break
+
+        return moves
+
+    def king_moves(self, position: Position) -> list[tuple[int, int]]:
+        moves = []
+
+        offsets = [
+            (-1, -1), (-1, 0), (-1, 1),
+            (0, 1), (0, -1),
+            (1, -1), (1, 0), (1, 1),
+        ]
+
+        own, _ = self.occupancy(position)
+
+        for (dx, dy) in offsets:
+            new_row, new_col = self.row + dx, self.col + dy
+
+            if 0 <= new_row < board_size and 0 <= new_col < board_size:
+                if not square_bit(new_row, new_col) & own:
+                    moves.append((new_row, new_col))
+
+        # Castling: the king moves two squares towards a rook that hasn't moved either, if
+        # nothing is in between and the king isn't in check or passing over an attacked
+        # square. Landing in check is pruned like any other move.
+        color = self.color
+        if self.first_move and not attackers_to(position, square(self.row, self.col), 1 - color):
+            rooks = position.unmoved & position.boards[color][ROOK]
+            occupied = position.all_occupied()
+            for rook_col, step in ((board_size - 1, 1), (0, -1)):
+                if not rooks & square_bit(self.row, rook_col):
+                    continue
+                if any(occupied & square_bit(self.row, col)
+                       for col in range(min(self.col, rook_col) + 1, max(self.col, rook_col))):
+                    continue
+                if attackers_to(position, square(self.row, self.col + step), 1 - color):
+                    continue
+                moves.append((self.row, self.col + 2 * step))
+
+        return moves
+
+    def pawn_moves(self, position: Position) -> list[tuple[int, int]]:
+        moves = []
+        occupied = position.all_occupied()
+        _, theirs = self.occupancy(position)
+
+        # White pawns move up the board, black pawns move down.
+        forward = position.pawn_step(self.color) // board_size
+        row = self.row + forward
+
+        if not square_bit(row, self.col) & occupied:
+            moves.append((row, self.col))
+            if self.first_move and not square_bit(row + forward, self.col) & occupied:
+                moves.append((row + forward, self.col))
+
+        for col in (self.col - 1, self.col + 1):
+            if square_bit(row, col) & theirs:
+                moves.append((row, col))
+
+        # Check for en passant
+        ep_pawn = position.ep_pawn_square()
+        if ep_pawn is not None:
+            ep_row, ep_col = divmod(ep_pawn, board_size)
+            if ep_row == self.row and abs(ep_col - self.col) == 1 and (1 << ep_pawn) & theirs:
+                moves.append((row, ep_col))
+            
+        return moves
+    
+    def is_valid_move(self, row: int, col: int, position: Position) -> bool:
+        return (row, col) in self.valid_moves(position)
+
+    # bitboards of the squares held by this piece's side and by the other side
+    def occupancy(self, position: Position) -> tuple[int, int]:
+        return position.occupied[self.color], position.occupied[1 - self.color]
+
+# look up the piece on (row, col) of the position, or None if the square is empty
+def piece_at(position: Position, row: int, col: int) -> Piece | None:
+    found = position.piece_at(square(row, col)) if square_bit(row, col) else None
+    if not found:
+        return None
+    color, piece_type = found
+    piece = Piece(piece_type, color, row, col)
+    if piece_type == PAWN:
+        piece.first_move = row == position.pawn_home_row(color)
+        piece.en_passant = position.ep_pawn_square() == square(row, col)
+    else:
+        piece.first_move = bool(position.unmoved & square_bit(row, col))
+    return piece
+
+# dict view of the position, (row, col) -> Piece, for drawing the board
+def piece_map(position: Position) -> dict[tuple[int, int], Piece]:
+    return {(row, col): piece_at(position, row, col)
+            for (row, col) in position.piece_squares()}
+
+starting_piece_positions = {
+    (0, 0): Piece(ROOK, BLACK, 0, 0),
+    (0, 1): Piece(KNIGHT, BLACK, 0, 1),
+    (0, 2): Piece(BISHOP, BLACK, 0, 2),
+    (0, 3): Piece(QUEEN, BLACK, 0, 3),
+    (0, 4): Piece(KING, BLACK, 0, 4),
+    (0, 5): Piece(BISHOP, BLACK, 0, 5),
+    (0, 6): Piece(KNIGHT, BLACK, 0, 6),
+    (0, 7): Piece(ROOK, BLACK, 0, 7),
+    (1, 0): Piece(PAWN, BLACK, 1, 0),
+    (1, 1): Piece(PAWN, BLACK, 1, 1),
+    (1, 2): Piece(PAWN, BLACK, 1, 2),
+    (1, 3): Piece(PAWN, BLACK, 1, 3),
+    (1, 4): Piece(PAWN, BLACK, 1, 4),
+    (1, 5): Piece(PAWN, BLACK, 1, 5),
+    (1, 6): Piece(PAWN, BLACK, 1, 6),
+    (1, 7): Piece(PAWN, BLACK, 1, 7),
+    (7, 0): Piece(ROOK, WHITE, 7, 0),
+    (7, 1): Piece(KNIGHT, WHITE, 7, 1),
+    (7, 2): Piece(BISHOP, WHITE, 7, 2),
+    (7, 3): Piece(QUEEN, WHITE, 7, 3),
+    (7, 4): Piece(KING, WHITE, 7, 4),
+    (7, 5): Piece(BISHOP, WHITE, 7, 5),
+    (7, 6): Piece(KNIGHT, WHITE, 7, 6),
+    (7, 7): Piece(ROOK, WHITE, 7, 7),
+    (6, 0): Piece(PAWN, WHITE, 6, 0),
+    (6, 1): Piece(PAWN, WHITE, 6, 1),
+    (6, 2): Piece(PAWN, WHITE, 6, 2),
+    (6, 3): Piece(PAWN, WHITE, 6, 3),
+    (6, 4): Piece(PAWN, WHITE, 6, 4),
+    (6, 5): Piece(PAWN, WHITE, 6, 5),
+    (6, 6): Piece(PAWN, WHITE, 6, 6),
+    (6, 7): Piece(PAWN, WHITE, 6, 7),
+}
+
+
+# the move that takes whatever is on from_sq to to_sq. pawns reaching the last row
+# always become queens, since the board has no way to pick another piece.
+def board_move(position: Position, from_sq: int, to_sq: int) -> int:
+    found = position.piece_at(from_sq)
+    if found and found[1] == PAWN and to_sq // board_size in (0, board_size - 1):
+        return encode_move(from_sq, to_sq, QUEEN)
+    return encode_move(from_sq, to_sq)
+
+# a fresh position with the pieces where they start
+def new_position() -> Position:
+    return Position.from_piece_map(starting_piece_positions)
+
+def is_in_mate(king_row, king_col, position: Position) -> bool:
+    king = piece_at(position, king_row, king_col)
+    assert(king and king.piece_type == KING)
+
+    # Look up every enemy piece that could reach the king in the precomputed attack tables.
+    enemy = 1 - king.color
+    return attackers_to(position, square(king_row, king_col), enemy) != 0
+
+# whether color ("white" or "black", the side to move by default) has no moves left.
+# always False for the side that just moved, since only the side to move can be stuck.
+def is_in_checkmate(position: Position, color: str | None = None) -> bool:
+    side = position.turn if color is None else COLOR_NAMES.index(color)
+    status = position_status(position, side)
+    return status.checkmate or status.stalemate
+
+# draws that depend on how the game got here rather than just the position. both are
+# O(1) thanks to the repetition counts and clock the position keeps as moves are made.
+def is_draw(position: Position) -> bool:
+    return position.is_threefold_repetition() or position.is_fifty_move_draw()
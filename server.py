@@ -0,0 +1,274 @@
+# Headless relay server: players connect with the normal client, get paired into games
+# two at a time and have every move checked against the rules before it is passed on.
+#
+#   python3 server.py [--host 0.0.0.0] [--port 12345]
+#
+# Clients use the protocol in protocol.py. A client that sends JOIN after its HELLO
+# waits in the lobby for an opponent, and the first player of each pair is white. One
+# that sends WATCH becomes a spectator instead: it gets a POSITION snapshot of the game
+# and then the same MOVES frames the players exchange. A connection that has sent
+# neither is never paired.
+
+import argparse
+import asyncio
+import time
+from array import array
+
+from position import WHITE, BLACK
+from movegen import cached_legal_moves, position_status
+from protocol import FrameBuffer, ProtocolError, HELLO, MOVES, RESYNC, WATCH, JOIN, PING
+from protocol import encode_hello, encode_start, encode_moves, encode_position, encode_error
+from protocol import encode_pong, decode_moves, decode_watch, decode_ping
+from rules import new_position, is_draw
+
+# Spectators are never waited on. Once more than spectator_high_water bytes are queued
+# for one we stop sending it moves; when its queue has drained below
+# spectator_low_water it gets a fresh snapshot instead of the moves it missed, and if
+# it is still stuck after spectator_timeout seconds it is disconnected. Lagging
+# spectators are checked every spectator_check_interval seconds as well as on each move.
+spectator_high_water = 64 * 1024
+spectator_low_water = 16 * 1024
+spectator_timeout = 30.0
+spectator_check_interval = 1.0
+
+class Player:
+    __slots__ = ("writer", "frames", "game", "color", "address", "watching", "lagging_since")
+
+    def __init__(self, writer, address):
+        self.writer = writer
+        self.frames = FrameBuffer()
+        self.game = None
+        self.color = None
+        self.address = address
+        # the game this connection spectates, if it is a spectator
+        self.watching = None
+        self.lagging_since = None
+
+    def send(self, data: bytes):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def queued(self) -> int:
+        return self.writer.transport.get_write_buffer_size()
+
+class Game:
+    __slots__ = ("id", "players", "position", "moves", "over", "spectators", "snapshot")
+
+    def __init__(self, game_id: int, white: Player, black: Player):
+        self.id = game_id
+        self.players = [white, black]
+        self.position = new_position()
+        # every move of the game, 2 bytes each
+        self.moves = array("H")
+        self.over = False
+        self.spectators = set()
+        # encoded POSITION frame for the current position, shared by every spectator
+        # that needs one until the next move
+        self.snapshot = None
+
+    def opponent(self, player: Player) -> Player:
+        return self.players[1 - player.color]
+
+    # make a move the rules allow, dropping undo records the server will never use
+    def play(self, move: int):
+        self.position.make_move(move)
+        self.position.history.clear()
+        self.moves.append(move)
+        self.snapshot = None
+
+        status = position_status(self.position)
+        if status.checkmate or status.stalemate or is_draw(self.position):
+            self.over = True
+
+    def position_frame(self) -> bytes:
+        if self.snapshot is None:
+            self.snapshot = encode_position(self.position)
+        return self.snapshot
+
+    # send a frame the players just exchanged to every spectator. the same bytes object
+    # goes to all of them, so a move is only ever encoded once.
+    def broadcast(self, frame: bytes):
+        now = time.monotonic()
+        for spectator in list(self.spectators):
+            if spectator.lagging_since is None:
+                if spectator.queued() < spectator_high_water:
+                    spectator.send(frame)
+                    continue
+                spectator.lagging_since = now
+            if self.over:
+                # no later move will bring them up to date, so send the final position
+                # now rather than leave them on whatever they last saw
+                spectator.send(self.position_frame())
+            self.catch_up(spectator, now)
+
+    # called for a lagging spectator on every move and every spectator_check_interval
+    # seconds, so one that drains or gets stuck between moves, or after the game is
+    # over, isn't left waiting for a move that may never come
+    def catch_up(self, spectator: Player, now: float):
+        if spectator.queued() < spectator_low_water:
+            # caught up: skip what they missed and send where the game is now. once the
+            # game is over broadcast has already queued the final position.
+            spectator.lagging_since = None
+            if not self.over:
+                spectator.send(self.position_frame())
+        elif now - spectator.lagging_since > spectator_timeout:
+            self.spectators.discard(spectator)
+            spectator.watching = None
+            spectator.writer.transport.abort()
+
+class Server:
+    def __init__(self):
+        self.waiting = None
+        self.games = {}
+        self.next_game_id = 1
+        self.connections = 0
+
+    # give every lagging spectator its snapshot or its timeout, then check again later
+    def check_spectators(self):
+        now = time.monotonic()
+        for game in list(self.games.values()):
+            for spectator in list(game.spectators):
+                if spectator.lagging_since is not None:
+                    game.catch_up(spectator, now)
+        asyncio.get_running_loop().call_later(spectator_check_interval, self.check_spectators)
+
+    async def handle_connection(self, reader, writer):
+        player = Player(writer, writer.get_extra_info("peername"))
+        self.connections += 1
+        player.send(encode_hello())
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                for kind, payload in player.frames.feed(data):
+                    self.handle_frame(player, kind, payload)
+                if player.watching is None:
+                    await writer.drain()
+        except ProtocolError as error:
+            player.send(encode_error(str(error)))
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            self.leave(player)
+            writer.close()
+
+    # pair the player with whoever is waiting, or make them wait for the next one
+    def join_lobby(self, player: Player):
+        waiting = self.waiting
+        if waiting is None or waiting.writer.is_closing():
+            self.waiting = player
+            return
+
+        self.waiting = None
+        game = Game(self.next_game_id, waiting, player)
+        self.next_game_id += 1
+        self.games[game.id] = game
+        for color, member in ((WHITE, waiting), (BLACK, player)):
+            member.game = game
+            member.color = color
+            member.send(encode_start(color))
+
+    def leave(self, player: Player):
+        if self.waiting is player:
+            self.waiting = None
+        if player.watching is not None:
+            player.watching.spectators.discard(player)
+            player.watching = None
+        game = player.game
+        if game is None:
+            return
+        self.games.pop(game.id, None)
+        opponent = game.opponent(player)
+        opponent.game = None
+        if not game.over:
+            opponent.send(encode_error("opponent left the game"))
+        opponent.writer.close()
+        for spectator in game.spectators:
+            spectator.watching = None
+            spectator.writer.close()
+        game.spectators.clear()
+
+    # start sending a game's moves to this connection, beginning with a snapshot
+    def watch(self, player: Player, game_id: int):
+        if player.game is not None or player.watching is not None or self.waiting is player:
+            player.send(encode_error("already in a game"))
+            return
+        if game_id == 0 and self.games:
+            game_id = max(self.games)
+        game = self.games.get(game_id)
+        if game is None:
+            player.send(encode_error("no such game: %d" % game_id))
+            player.writer.close()
+            return
+        player.watching = game
+        game.spectators.add(player)
+        player.send(game.position_frame())
+
+    def handle_frame(self, player: Player, kind: int, payload: bytes):
+        game = player.game
+        if kind == HELLO:
+            return
+        if kind == PING:
+            decode_ping(payload)
+            player.send(encode_pong(payload))
+            return
+        if kind == WATCH:
+            self.watch(player, decode_watch(payload))
+            return
+        if kind == JOIN:
+            if player.game is not None or player.watching is not None or self.waiting is player:
+                player.send(encode_error("already in a game"))
+            else:
+                self.join_lobby(player)
+            return
+        if player.watching is not None:
+            if kind == RESYNC:
+                if player.queued() < spectator_high_water:
+                    player.send(player.watching.position_frame())
+            else:
+                player.send(encode_error("spectators can't play moves"))
+            return
+        if game is None:
+            player.send(encode_error("no game yet, waiting for an opponent"))
+            return
+
+        if kind == RESYNC:
+            player.send(game.position_frame())
+        elif kind == MOVES:
+            relayed = []
+            for move in decode_moves(payload):
+                if game.over or game.position.turn != player.color or \
+                   move not in cached_legal_moves(game.position):
+                    # tell them why and put their board back in line with ours
+                    player.send(encode_error("illegal move"))
+                    player.send(game.position_frame())
+                    break
+                game.play(move)
+                relayed.append(move)
+            if relayed:
+                frame = encode_moves(relayed)
+                game.opponent(player).send(frame)
+                game.broadcast(frame)
+
+async def serve(host: str, port: int):
+    server = Server()
+    listener = await asyncio.start_server(server.handle_connection, host, port, backlog=1024)
+    server.check_spectators()
+    print("Serving on", ", ".join(str(sock.getsockname()) for sock in listener.sockets), flush=True)
+    async with listener:
+        await listener.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Chess relay server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=12345)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
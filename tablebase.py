@@ -0,0 +1,366 @@
+# Endgame tablebases: perfect play for a king and one other piece against a lone king
+# (KQK, KRK, KBK, KNK and KPK), made by retrograde analysis on top of movegen.
+#
+# A table has one byte for every placement of the two kings and the extra piece with
+# either side to move, the extra piece being white's (black's are looked up mirrored):
+#
+#   index   ((side to move * 64 + white king) * 64 + black king) * 64 + piece square
+#   value   0 draw, 1..127 the side to move mates in that many plies,
+#           128 + n the side to move is mated in n plies, 255 an illegal placement
+#
+# Building a table first generates the legal moves of every placement, split by white
+# king square across a pool of processes. The successors of each placement are worked
+# out from the moves themselves rather than by playing them, and captures and
+# promotions lead out of the table (to a draw, or into the table of the promoted
+# piece). Then values are spread backwards from the mates one ply at a time: a
+# placement with a successor lost in n plies is won in n + 1, and one whose successors
+# are all won is lost in one more than the longest of them.
+#
+# Tables are memory-mapped when first probed, so a probe is an index calculation and a
+# one-byte read. Placements where castling is still possible aren't covered.
+#
+#   python3 tablebase.py build [--directory tablebases] [--workers N] [KQK KRK ...]
+#   python3 tablebase.py probe --fen FEN
+
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+from array import array
+
+from position import Position, WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING
+from position import FEN_PIECES
+
+TABLEBASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tablebases")
+
+# every table, in an order where promotions only lead into tables already built
+TABLES = ["KQK", "KRK", "KBK", "KNK", "KPK"]
+
+MAGIC = b"CHTB"
+VERSION = 1
+DRAW, ILLEGAL = 0, 255
+LOSS = 128
+
+WIN_RESULT, DRAW_RESULT, LOSS_RESULT = 1, 0, -1
+
+_HEADER = struct.Struct(">4sB3s8x")
+TABLE_SIZE = 2 * 64 * 64 * 64
+
+def _index(turn: int, white_king: int, black_king: int, piece_sq: int) -> int:
+    return ((turn * 64 + white_king) * 64 + black_king) * 64 + piece_sq
+
+def _piece_type(name: str) -> int:
+    return FEN_PIECES.index(name[1].lower())
+
+def table_path(directory: str, name: str) -> str:
+    return os.path.join(directory, name + ".tb")
+
+# (result, plies) for a table value from the side to move's point of view
+def _decode(value: int):
+    if value == DRAW:
+        return DRAW_RESULT, 0
+    if value < LOSS:
+        return WIN_RESULT, value
+    return LOSS_RESULT, value - LOSS
+
+def _open_table(path: str):
+    with open(path, "rb") as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, _ = _HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC or version != VERSION or len(mapped) != _HEADER.size + TABLE_SIZE:
+        mapped.close()
+        raise ValueError("%s is not a version %d tablebase" % (path, VERSION))
+    return mapped
+
+# Generation
+
+# runs in a worker: the moves of every placement with the white king on white_king.
+# returns the legal indices, per index flags (1 in check, 2 can draw by leaving the
+# table), the best win and worst loss reachable by leaving the table (0 for none, else
+# plies + 1), and the successors inside the table as counts plus one flat array.
+def _generate(name: str, white_king: int, directory: str):
+    from movegen import legal_moves, in_check
+
+    piece_type = _piece_type(name)
+    promotions = {}
+    if piece_type == PAWN:
+        for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+            promotions[promotion] = _open_table(table_path(directory, "K%sK" % FEN_PIECES[promotion].upper()))
+
+    indices, flags, exit_wins, exit_losses = array("I"), bytearray(), bytearray(), bytearray()
+    counts, successors = array("H"), array("I")
+    for turn in (WHITE, BLACK):
+        for black_king in range(64):
+            if black_king == white_king or \
+               max(abs(black_king // 8 - white_king // 8), abs(black_king % 8 - white_king % 8)) <= 1:
+                continue
+            for piece_sq in range(64):
+                if piece_sq in (white_king, black_king) or \
+                   (piece_type == PAWN and piece_sq // 8 in (0, 7)):
+                    continue
+                position = Position()
+                position.add_piece(WHITE, KING, white_king)
+                position.add_piece(BLACK, KING, black_king)
+                position.add_piece(WHITE, piece_type, piece_sq)
+                position.turn = turn
+                # the side that just moved can't be in check
+                if in_check(position, 1 - turn):
+                    continue
+
+                flag = 1 if in_check(position, turn) else 0
+                exit_win = exit_loss = 0
+                count = 0
+                for move in legal_moves(position):
+                    from_sq, to_sq, promotion = move & 63, (move >> 6) & 63, move >> 12
+                    if turn == BLACK:
+                        if to_sq == piece_sq:
+                            # the lone kings left can only draw
+                            flag |= 2
+                            continue
+                        successors.append(_index(WHITE, white_king, to_sq, piece_sq))
+                    elif from_sq == white_king:
+                        successors.append(_index(BLACK, to_sq, black_king, piece_sq))
+                    elif promotion:
+                        table = promotions[promotion]
+                        result, plies = _decode(table[_HEADER.size + _index(BLACK, white_king, black_king, to_sq)])
+                        if result == DRAW_RESULT:
+                            flag |= 2
+                        elif result == LOSS_RESULT:
+                            exit_win = plies + 1 if not exit_win else min(exit_win, plies + 1)
+                        else:
+                            exit_loss = max(exit_loss, plies + 1)
+                        continue
+                    else:
+                        successors.append(_index(BLACK, white_king, black_king, to_sq))
+                    count += 1
+                indices.append(_index(turn, white_king, black_king, piece_sq))
+                flags.append(flag)
+                exit_wins.append(exit_win)
+                exit_losses.append(exit_loss)
+                counts.append(count)
+    for table in promotions.values():
+        table.close()
+    return indices, flags, exit_wins, exit_losses, counts, successors
+
+# build one table, with the move generation spread over `workers` processes
+def build_table(name: str, directory: str = TABLEBASE_DIR, workers: int | None = None) -> dict:
+    values = bytearray([ILLEGAL]) * TABLE_SIZE
+    remaining = array("H", bytes(2 * TABLE_SIZE))
+    # the longest loss each placement can be dragged out to so far, in plies
+    longest = bytearray(TABLE_SIZE)
+    can_draw = bytearray(TABLE_SIZE)
+    can_win = bytearray(TABLE_SIZE)
+    resolved = bytearray(TABLE_SIZE)
+    edges = []
+    buckets = [[] for _ in range(LOSS)]
+
+    if workers == 1:
+        chunks = map(_generate, [name] * 64, range(64), [directory] * 64)
+        pool = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        pool = ProcessPoolExecutor(workers)
+        chunks = pool.map(_generate, [name] * 64, range(64), [directory] * 64)
+
+    legal = 0
+    for indices, flags, exit_wins, exit_losses, counts, successors in chunks:
+        edges.append((indices, counts, successors))
+        legal += len(indices)
+        for index, flag, exit_win, exit_loss, count in zip(indices, flags, exit_wins, exit_losses, counts):
+            values[index] = DRAW
+            remaining[index] = count
+            longest[index] = exit_loss
+            can_draw[index] = flag & 2
+            if exit_win:
+                can_win[index] = 1
+                buckets[exit_win].append((index, True))
+            elif count == 0:
+                if exit_loss and not flag & 2:
+                    buckets[exit_loss].append((index, False))
+                elif not exit_loss and not flag & 2:
+                    # no moves at all: mate, or stalemate (which stays a draw)
+                    if flag & 1:
+                        buckets[0].append((index, False))
+                    else:
+                        resolved[index] = 1
+    if pool is not None:
+        pool.shutdown()
+
+    # predecessors of every placement, in one flat array with offsets
+    starts = array("I", bytes(4 * (TABLE_SIZE + 1)))
+    for _, _, successors in edges:
+        for successor in successors:
+            starts[successor + 1] += 1
+    for index in range(TABLE_SIZE):
+        starts[index + 1] += starts[index]
+    fill = array("I", starts)
+    predecessors = array("I", bytes(4 * starts[TABLE_SIZE]))
+    for indices, counts, successors in edges:
+        at = 0
+        for index, count in zip(indices, counts):
+            for successor in successors[at:at + count]:
+                predecessors[fill[successor]] = index
+                fill[successor] += 1
+            at += count
+    del edges, fill
+
+    longest_mate = 0
+    for plies in range(LOSS):
+        for index, win in buckets[plies]:
+            if resolved[index]:
+                continue
+            resolved[index] = 1
+            values[index] = plies if win else LOSS + plies
+            longest_mate = plies
+            for predecessor in predecessors[starts[index]:starts[index + 1]]:
+                if resolved[predecessor]:
+                    continue
+                if not win:
+                    buckets[plies + 1].append((predecessor, True))
+                    continue
+                remaining[predecessor] -= 1
+                if plies + 1 > longest[predecessor]:
+                    longest[predecessor] = plies + 1
+                if not remaining[predecessor] and not can_draw[predecessor] and not can_win[predecessor]:
+                    buckets[longest[predecessor]].append((predecessor, False))
+        buckets[plies] = None
+
+    os.makedirs(directory, exist_ok=True)
+    path = table_path(directory, name)
+    with open(path + ".tmp", "wb") as output:
+        output.write(_HEADER.pack(MAGIC, VERSION, name.encode()))
+        output.write(values)
+    os.replace(path + ".tmp", path)
+    return {"table": name, "legal": legal, "wins": sum(1 for value in values if 0 < value < LOSS),
+            "longest_mate": longest_mate}
+
+# Probing
+
+class Tablebases:
+    def __init__(self, directory: str = TABLEBASE_DIR):
+        self.directory = directory
+        self.tables = {}
+
+    def close(self):
+        for table in self.tables.values():
+            if table is not None:
+                table.close()
+        self.tables.clear()
+
+    def _table(self, name: str):
+        if name not in self.tables:
+            path = table_path(self.directory, name)
+            self.tables[name] = _open_table(path) if os.path.exists(path) else None
+        return self.tables[name]
+
+    # (result, plies to mate) for the side to move, or None if no table covers the position.
+    # result is WIN_RESULT, DRAW_RESULT or LOSS_RESULT; plies is 0 for draws.
+    def probe(self, position: Position):
+        white, black = position.occupied
+        occupied = white | black
+        if occupied.bit_count() > 3:
+            return None
+        # a king and rook that haven't moved might still castle
+        rooks = position.boards[WHITE][ROOK] | position.boards[BLACK][ROOK]
+        kings = position.boards[WHITE][KING] | position.boards[BLACK][KING]
+        if position.unmoved & rooks and position.unmoved & kings:
+            return None
+        if occupied.bit_count() == 2:
+            return DRAW_RESULT, 0
+        strong = WHITE if white.bit_count() == 2 else BLACK
+        boards = position.boards[strong]
+        for piece_type in (PAWN, KNIGHT, BISHOP, ROOK, QUEEN):
+            if boards[piece_type]:
+                break
+        table = self._table("K%sK" % FEN_PIECES[piece_type].upper())
+        if table is None:
+            return None
+
+        # tables have white holding the extra piece; black's is the same table with the
+        # board turned top to bottom
+        mirror = 56 if strong == BLACK else 0
+        strong_king = position.king_squares[strong] ^ mirror
+        weak_king = position.king_squares[1 - strong] ^ mirror
+        piece_sq = (boards[piece_type].bit_length() - 1) ^ mirror
+        turn = WHITE if position.turn == strong else BLACK
+        value = table[_HEADER.size + _index(turn, strong_king, weak_king, piece_sq)]
+        if value == ILLEGAL:
+            return None
+        return _decode(value)
+
+    # the move that wins fastest, holds the draw, or loses slowest; None if not covered
+    def best_move(self, position: Position):
+        from movegen import legal_moves
+
+        if self.probe(position) is None:
+            return None
+        best, best_rank = None, None
+        for move in legal_moves(position):
+            position.make_move(move)
+            found = self.probe(position)
+            position.unmake_move()
+            if found is None:
+                continue
+            result, plies = found
+            # rank from the mover's side: quick wins first, then draws, then slow losses
+            if result == LOSS_RESULT:
+                rank = (0, plies)
+            elif result == DRAW_RESULT:
+                rank = (1, 0)
+            else:
+                rank = (2, -plies)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = move, rank
+        return best
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Build or probe endgame tablebases.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="generate tables")
+    build.add_argument("tables", nargs="*", default=TABLES, help="any of " + " ".join(TABLES))
+    build.add_argument("--directory", default=TABLEBASE_DIR)
+    build.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    probe = commands.add_parser("probe", help="look a position up")
+    probe.add_argument("--fen", required=True)
+    probe.add_argument("--directory", default=TABLEBASE_DIR)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        for name in args.tables:
+            if name not in TABLES:
+                parser.error("unknown table %s, choose from %s" % (name, " ".join(TABLES)))
+        # promotions need the tables of the pieces a pawn can become
+        wanted = set(args.tables)
+        if "KPK" in wanted:
+            wanted |= {"KQK", "KRK", "KBK", "KNK"}
+        for name in TABLES:
+            if name in wanted:
+                start = time.perf_counter()
+                stats = build_table(name, args.directory, args.workers)
+                print("%s: %d legal placements, %d won for the side to move, longest mate %d plies, %.1fs"
+                      % (name, stats["legal"], stats["wins"], stats["longest_mate"],
+                         time.perf_counter() - start))
+        return
+
+    from perft import move_name
+
+    position = Position.from_fen(args.fen)
+    tablebases = Tablebases(args.directory)
+    found = tablebases.probe(position)
+    if found is None:
+        print("not in the tablebases")
+        return
+    result, plies = found
+    print({WIN_RESULT: "win", DRAW_RESULT: "draw", LOSS_RESULT: "loss"}[result] +
+          (" in %d plies" % plies if result != DRAW_RESULT else ""))
+    move = tablebases.best_move(position)
+    if move is not None:
+        print("bestmove", move_name(move))
+
+if __name__ == "__main__":
+    main()